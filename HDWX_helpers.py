@@ -2,16 +2,1028 @@
 # Helper functions for python-based HDWX
 # Created 9 July 2022 by Sam Gardner <stgardner4@tamu.edu>
 
-from datetime import datetime as dt, timedelta
-from os import path, chmod, remove, urandom
+from datetime import datetime as dt, timedelta, timezone
+from os import path, chmod, remove, urandom, stat, fstat, getpid, kill, listdir, environ, fsync, replace
 from pathlib import Path
+from tempfile import NamedTemporaryFile
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from socket import gethostname
+import atexit
+import fcntl
+import gzip
+import hashlib
 import json
-from atomicwrites import atomic_write
-from natsort import natsorted
+import math
+import sys
+import threading
+import weakref
+import time
+
+
+class ProductRecord(namedtuple("ProductRecord", ["productID", "productDescription", "productPath", "isForecast", "fileExtension", "displayFrames", "productTypeID", "totalFrameCount", "runPathExtension", "longRunHours", "longRunFrameCount", "publishLatencyTargetSeconds"], defaults=(None, (), None, None))):
+    """
+    Immutable definition of a single product, as stored in productRegistry.json
+    runPathExtension: fixed pathExtension for products that don't store runs by time, None to use the run's time
+    totalFrameCount: -1 if the number of frames in a run isn't known ahead of time
+    longRunHours/longRunFrameCount: runs initialized at these hours have longRunFrameCount frames instead of totalFrameCount
+    publishLatencyTargetSeconds: the p95 publish latency the product should stay under, None if it doesn't have a target
+    """
+    __slots__ = ()
+
+    def pathExtensionForRun(self, runTime):
+        if self.runPathExtension is not None:
+            return self.runPathExtension
+        return runTime.strftime("%Y/%m/%d/%H00/")
+
+    def totalFrameCountForRun(self, runTime):
+        if runTime.hour in self.longRunHours:
+            return self.longRunFrameCount
+        return self.totalFrameCount
+
+
+ProductTypeRecord = namedtuple("ProductTypeRecord", ["productTypeID", "productTypeDescription"])
+
+
+def loadProductRegistry(registryPath=None):
+    """
+    Reads product and productType definitions from a registry file
+    Parameters:
+    ----------
+    registryPath: path to the registry json, if None, productRegistry.json is searched for next to this file and in the parent directory (the hdwx-operational clone)
+    Returns a tuple of (dict of productTypeID to ProductTypeRecord, dict of productID to ProductRecord)
+
+    """
+    if registryPath is None:
+        candidatePaths = [path.join(path.dirname(path.abspath(__file__)), "productRegistry.json"), path.join(path.dirname(path.dirname(path.abspath(__file__))), "productRegistry.json")]
+        registryPath = next((candidate for candidate in candidatePaths if path.exists(candidate)), candidatePaths[0])
+    with open(registryPath, "r") as jsonRead:
+        registryData = json.load(jsonRead)
+    productTypes = {productType["productTypeID"] : ProductTypeRecord(**productType) for productType in registryData["productTypes"]}
+    products = dict()
+    for product in registryData["products"]:
+        if "longRunHours" in product:
+            product = dict(product, longRunHours=tuple(product["longRunHours"]))
+        products[product["productID"]] = ProductRecord(**product)
+    return productTypes, products
+
+
+productTypeRegistry, productRegistry = loadProductRegistry()
+
+
+def getProduct(productID):
+    """
+    Returns the ProductRecord for a productID, raises ValueError for products that aren't in the registry
+    """
+    try:
+        return productRegistry[productID]
+    except KeyError:
+        raise ValueError(f"productID {productID} is not defined in the product registry") from None
+
+
+def exportProductCatalog(outputPath=None):
+    """
+    Returns the full product catalog as a dict, optionally writing it to outputPath as JSON
+    Parameters:
+    ----------
+    outputPath: where to write the catalog, or None to only return it
+
+    """
+    catalog = {
+        "productTypes" : [productType._asdict() for productType in sorted(productTypeRegistry.values())],
+        "products" : [product._asdict() for product in sorted(productRegistry.values())]
+    }
+    if outputPath is not None:
+        with open(outputPath, "w") as jsonWrite:
+            json.dump(catalog, jsonWrite, indent=4, ensure_ascii=False)
+        chmod(outputPath, 0o644)
+    return catalog
+
+
+# How metadata json is written. "compact" drops the indentation and whitespace, "precompress" lists encodings ("gz", "br") to also write next to every json,
+# so that the web server can send precompressed bytes. Configured with the HDWX_METADATA_COMPACT=1 and HDWX_METADATA_PRECOMPRESS=gz,br environment variables.
+metadataOutput = {
+    "compact" : environ.get("HDWX_METADATA_COMPACT", "0") == "1",
+    "precompress" : [encoding for encoding in environ.get("HDWX_METADATA_PRECOMPRESS", "").split(",") if encoding != ""]
+}
+metadataSiblingExtensions = ["gz", "br"]
+
+
+def atomicWriteBytes(outputPath, outputBytes, skipUnchanged=False):
+    """
+    Writes to a temporary file in the same directory and renames it over outputPath, so readers never see a partial file
+    Parameters:
+    ----------
+    outputPath: the file to write
+    outputBytes: the new contents of the file
+    skipUnchanged: if True and outputPath already contains exactly outputBytes, leave it (and its mtime) alone
+    Returns True if the file was written
+
+    """
+    if skipUnchanged:
+        try:
+            with open(outputPath, "rb") as existingRead:
+                if existingRead.read() == outputBytes:
+                    return False
+        except FileNotFoundError:
+            pass
+    with NamedTemporaryFile(dir=path.dirname(outputPath), delete=False) as tmpWrite:
+        try:
+            tmpWrite.write(outputBytes)
+            tmpWrite.flush()
+            fsync(tmpWrite.fileno())
+            chmod(tmpWrite.name, 0o644)
+            replace(tmpWrite.name, outputPath)
+        except BaseException:
+            remove(tmpWrite.name)
+            raise
+    return True
+
+
+def _compress(outputBytes, encoding):
+    if encoding == "gz":
+        # mtime=0 so that the same json always compresses to the same bytes
+        return gzip.compress(outputBytes, compresslevel=9, mtime=0)
+    elif encoding == "br":
+        import brotli
+        return brotli.compress(outputBytes, mode=brotli.MODE_TEXT)
+    raise ValueError(f"Unknown metadata precompression encoding {encoding}, must be one of {metadataSiblingExtensions}")
+
+
+def writeMetadataJson(jsonPath, jsonData, skipUnchanged=False):
+    """
+    Atomically writes metadata json readable by the web server, in the format configured by metadataOutput
+    Parameters:
+    ----------
+    jsonPath: where to write the json, its directory must already exist
+    jsonData: the dict to write
+    skipUnchanged: don't rewrite files that are already byte-identical to the new output
+    Returns True if the json or any of its precompressed siblings was written
+
+    """
+    return _writeMetadataBytes(jsonPath, _metadataJsonBytes(jsonData), skipUnchanged)
+
+
+def _metadataJsonBytes(jsonData):
+    if metadataOutput["compact"]:
+        return json.dumps(jsonData, separators=(",", ":")).encode()
+    return json.dumps(jsonData, indent=4).encode()
+
+
+# Precompressed siblings in each metadata directory, listed the first time this process writes json there and kept up to date with what it writes
+# and removes afterwards, so that disabled encodings' siblings don't have to be removed (or looked for) on every write
+_siblingNames = dict()
+
+
+def _knownSiblings(jsonDir):
+    siblingNames = _siblingNames.get(jsonDir)
+    if siblingNames is None:
+        siblingSuffixes = tuple("."+encoding for encoding in metadataSiblingExtensions)
+        siblingNames = {entryName for entryName in listdir(jsonDir) if entryName.endswith(siblingSuffixes)}
+        _siblingNames[jsonDir] = siblingNames
+    return siblingNames
+
+
+def _writeMetadataBytes(jsonPath, outputBytes, skipUnchanged=False):
+    # writeMetadataJson for json that's already been serialized
+    wroteAnything = atomicWriteBytes(jsonPath, outputBytes, skipUnchanged)
+    jsonDir, jsonName = path.split(jsonPath)
+    siblingNames = _knownSiblings(jsonDir)
+    for encoding in metadataSiblingExtensions:
+        siblingName = jsonName+"."+encoding
+        if encoding in metadataOutput["precompress"]:
+            wroteAnything = atomicWriteBytes(jsonPath+"."+encoding, _compress(outputBytes, encoding), skipUnchanged) or wroteAnything
+            siblingNames.add(siblingName)
+        elif siblingName in siblingNames:
+            # A sibling left from when precompression was enabled would be served instead of the current json
+            siblingNames.discard(siblingName)
+            try:
+                remove(jsonPath+"."+encoding)
+            except FileNotFoundError:
+                pass
+    return wroteAnything
+
+
+# Lock wait/hold times for every runLock acquired by this process
+lockStats = {"acquisitions" : 0, "waitSeconds" : 0.0, "maxWaitSeconds" : 0.0, "holdSeconds" : 0.0, "maxHoldSeconds" : 0.0, "staleLocksBroken" : 0}
+
+
+def _lockIsStale(lockFile, staleAfter):
+    # Lock files contain "<pid> <hostname> <unix time>" of the writer holding them
+    lockFile.seek(0)
+    try:
+        holderPid, holderHost, lockedAt = lockFile.read().split()
+        holderPid = int(holderPid)
+        lockedAt = float(lockedAt)
+    except ValueError:
+        # The holder hasn't written its info yet (or this is a lock left by an older version of HDWX_helpers), fall back to the file's age
+        holderPid, holderHost, lockedAt = None, None, fstat(lockFile.fileno()).st_mtime
+    if holderPid is not None and holderHost == gethostname():
+        try:
+            kill(holderPid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return time.time() - lockedAt > staleAfter
+
+
+@contextmanager
+def runLock(lockPath, timeout=120, staleAfter=120):
+    """
+    Holds an exclusive fcntl lock on lockPath for the duration of a with block. The lock file is removed on release, and because the
+    kernel drops the lock when its holder dies, a crashed writer can't block the next one.
+    Parameters:
+    ----------
+    lockPath: path to the lock file, its directory must already exist
+    timeout: seconds to wait for the lock before raising TimeoutError, or None to wait forever
+    staleAfter: seconds after which a held lock is considered abandoned and broken. Locks held by a dead PID on this host are broken immediately.
+
+    """
+    waitStart = time.monotonic()
+    retryDelay = 0.005
+    while True:
+        lockFile = open(lockPath, "a+")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if _lockIsStale(lockFile, staleAfter):
+                try:
+                    if stat(lockPath).st_ino == fstat(lockFile.fileno()).st_ino:
+                        remove(lockPath)
+                        lockStats["staleLocksBroken"] += 1
+                except FileNotFoundError:
+                    pass
+                lockFile.close()
+                continue
+            lockFile.close()
+            if timeout is not None and time.monotonic() - waitStart > timeout:
+                raise TimeoutError(f"Timed out after {timeout} seconds waiting for {lockPath}")
+            time.sleep(retryDelay)
+            retryDelay = min(retryDelay * 2, 0.05)
+            continue
+        # The previous holder may have removed (or a waiter may have broken) the lock file while we were waiting for it, in which case we hold a lock on a file no one else can see
+        try:
+            stillCurrent = stat(lockPath).st_ino == fstat(lockFile.fileno()).st_ino
+        except FileNotFoundError:
+            stillCurrent = False
+        if stillCurrent:
+            break
+        lockFile.close()
+    lockedAt = time.monotonic()
+    waitSeconds = lockedAt - waitStart
+    lockStats["acquisitions"] += 1
+    lockStats["waitSeconds"] += waitSeconds
+    lockStats["maxWaitSeconds"] = max(lockStats["maxWaitSeconds"], waitSeconds)
+    try:
+        lockFile.seek(0)
+        lockFile.truncate()
+        lockFile.write(f"{getpid()} {gethostname()} {time.time()}")
+        lockFile.flush()
+        yield lockFile
+    finally:
+        try:
+            if stat(lockPath).st_ino == fstat(lockFile.fileno()).st_ino:
+                remove(lockPath)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+        holdSeconds = time.monotonic() - lockedAt
+        lockStats["holdSeconds"] += holdSeconds
+        lockStats["maxHoldSeconds"] = max(lockStats["maxHoldSeconds"], holdSeconds)
+
+
+# Timing spans, aggregated per script, span, and productID. Off unless HDWX_METRICS_DIR is set, in which case every process adds its spans to <name>.json and <name>.prom
+# in that directory at most every flushSeconds and at exit. Point it at node_exporter's textfile collector directory to have Prometheus scrape them.
+metrics = {
+    "dir" : environ.get("HDWX_METRICS_DIR"),
+    "name" : environ.get("HDWX_METRICS_NAME", "hdwx"),
+    "flushSeconds" : 60
+}
+# Spans recorded since the last flush, as (script, span, productID) : [count, total seconds, max seconds]
+_metricsState = {"pid" : getpid(), "spans" : dict(), "lastFlushed" : time.monotonic(), "lock" : threading.Lock()}
+_disabledSpan = nullcontext()
+
+
+def recordSpan(spanName, seconds, productID=None):
+    """
+    Adds one timed span to this process's metrics, does nothing if metrics are off
+    Parameters:
+    ----------
+    spanName: what was timed, like "writeJson.compact"
+    seconds: how long it took
+    productID: the product it was timed for, if any
+
+    """
+    if metrics["dir"] is None:
+        return
+    with _metricsState["lock"]:
+        if _metricsState["pid"] != getpid():
+            # Forked from a process with spans of its own, which that process will flush. multiprocessing workers exit without running atexit, so they flush from a finalizer.
+            _metricsState.update({"pid" : getpid(), "spans" : dict(), "lastFlushed" : time.monotonic()})
+            if "multiprocessing" in sys.modules.keys():
+                from multiprocessing import util
+                util.Finalize(None, flushMetrics, exitpriority=0)
+        scriptName = path.splitext(path.basename(sys.argv[0]))[0]
+        spanKey = ("python" if scriptName in ["", "-", "-c"] else scriptName, spanName, "" if productID is None else str(productID))
+        spanStats = _metricsState["spans"].setdefault(spanKey, [0, 0.0, 0.0])
+        spanStats[0] += 1
+        spanStats[1] += seconds
+        spanStats[2] = max(spanStats[2], seconds)
+        flushDue = time.monotonic() - _metricsState["lastFlushed"] >= metrics["flushSeconds"]
+    if flushDue:
+        flushMetrics()
+
+
+@contextmanager
+def _timedSpan(spanName, productID):
+    spanStart = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordSpan(spanName, time.perf_counter() - spanStart, productID)
+
+
+def timingSpan(spanName, productID=None):
+    """
+    Times the body of a with block as a span, see recordSpan. Costs one dict lookup if metrics are off.
+    """
+    if metrics["dir"] is None:
+        return _disabledSpan
+    return _timedSpan(spanName, productID)
+
+
+def _prometheusLabel(labelValue):
+    return labelValue.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def flushMetrics():
+    """
+    Adds the spans this process recorded since the last flush to the metrics json and Prometheus textfile. Registered to run at exit.
+    """
+    with _metricsState["lock"]:
+        if metrics["dir"] is None or _metricsState["pid"] != getpid() or len(_metricsState["spans"]) == 0:
+            return
+        pendingSpans = _metricsState["spans"]
+        _metricsState["spans"] = dict()
+        _metricsState["lastFlushed"] = time.monotonic()
+    Path(metrics["dir"]).mkdir(parents=True, exist_ok=True)
+    summaryPath = path.join(metrics["dir"], metrics["name"]+".json")
+    # Every HDWX process adds to the same files, so they're read, updated, and rewritten under a lock
+    with runLock(path.join(metrics["dir"], metrics["name"]+".lock")):
+        try:
+            with open(summaryPath, "r") as summaryRead:
+                metricsSummary = json.load(summaryRead)
+        except (FileNotFoundError, ValueError):
+            metricsSummary = {"spans" : dict()}
+        for (scriptName, spanName, productID), (spanCount, spanSeconds, spanMaxSeconds) in pendingSpans.items():
+            summaryStats = metricsSummary["spans"].setdefault(scriptName, dict()).setdefault(spanName, dict()).setdefault(productID, {"count" : 0, "totalSeconds" : 0.0, "maxSeconds" : 0.0})
+            summaryStats["count"] += spanCount
+            summaryStats["totalSeconds"] += spanSeconds
+            summaryStats["maxSeconds"] = max(summaryStats["maxSeconds"], spanMaxSeconds)
+            summaryStats["meanSeconds"] = summaryStats["totalSeconds"] / summaryStats["count"]
+        metricsSummary["updated"] = dt.utcnow().strftime("%Y%m%d%H%M%S")
+        promLines = {"hdwx_span_seconds_total" : ["# HELP hdwx_span_seconds_total Time spent in each instrumented span", "# TYPE hdwx_span_seconds_total counter"],
+                        "hdwx_span_count_total" : ["# HELP hdwx_span_count_total Number of times each instrumented span ran", "# TYPE hdwx_span_count_total counter"],
+                        "hdwx_span_max_seconds" : ["# HELP hdwx_span_max_seconds Longest run of each instrumented span", "# TYPE hdwx_span_max_seconds gauge"]}
+        for scriptName, scriptSpans in sorted(metricsSummary["spans"].items()):
+            for spanName, productSpans in sorted(scriptSpans.items()):
+                for productID, summaryStats in sorted(productSpans.items()):
+                    promLabels = '{script="'+_prometheusLabel(scriptName)+'",span="'+_prometheusLabel(spanName)+'",productID="'+_prometheusLabel(productID)+'"}'
+                    promLines["hdwx_span_seconds_total"].append("hdwx_span_seconds_total"+promLabels+" "+repr(summaryStats["totalSeconds"]))
+                    promLines["hdwx_span_count_total"].append("hdwx_span_count_total"+promLabels+" "+str(summaryStats["count"]))
+                    promLines["hdwx_span_max_seconds"].append("hdwx_span_max_seconds"+promLabels+" "+repr(summaryStats["maxSeconds"]))
+        atomicWriteBytes(summaryPath, json.dumps(metricsSummary, indent=4).encode())
+        atomicWriteBytes(path.join(metrics["dir"], metrics["name"]+".prom"), ("\n".join([promLine for metricLines in promLines.values() for promLine in metricLines])+"\n").encode())
+
+
+atexit.register(flushMetrics)
+
+
+# Frames are appended to a per-run journal and the productRun json is only rebuilt from it ("compacted") at most once every journalCompactInterval seconds per run.
+# A run left pending is compacted by a timer once journalCompactInterval has passed, as soon as its writer moves on to another run of the product, and when the process exits.
+# The productRun json can lag the product json by up to journalCompactInterval, and a process that publishes a single frame and exits still compacts (rebuilds the whole run) on exit.
+journalCompactInterval = 10
+# "lock" guards lastCompacted and pending, which the timer's thread uses too. "timer" is the armed threading.Timer, if any.
+_journalState = {"pid" : getpid(), "lastCompacted" : dict(), "pending" : dict(), "lock" : threading.Lock(), "timer" : None}
+
+
+def _journalStateForProcess():
+    # Forked children leave their parent's pending journals to the parent, and don't inherit its timer thread. multiprocessing workers exit without running atexit,
+    # so they compact from a finalizer instead. A worker killed before that (Pool.terminate) leaves its journal on disk for the next compaction of the run, or cleanupModules.py.
+    if _journalState["pid"] != getpid():
+        _journalState.update({"pid" : getpid(), "lastCompacted" : dict(), "pending" : dict(), "lock" : threading.Lock(), "timer" : None})
+        if "multiprocessing" in sys.modules.keys():
+            from multiprocessing import util
+            util.Finalize(None, compactPendingJournals, exitpriority=0)
+
+
+def _scheduleJournalFlush():
+    # Arms the timer for when the first pending journal may be compacted, unless it's already armed. The caller holds _journalState["lock"].
+    if _journalState["timer"] is not None or len(_journalState["pending"]) == 0:
+        return
+    dueAt = min([_journalState["lastCompacted"].get(journalPath, float("-inf")) + journalCompactInterval for journalPath in _journalState["pending"].keys()])
+    flushTimer = threading.Timer(max(0, dueAt - time.monotonic()), _compactDueJournals)
+    flushTimer.daemon = True
+    _journalState["timer"] = flushTimer
+    flushTimer.start()
+
+
+def _compactDueJournals():
+    # Runs on the timer's thread: compacts every pending journal whose run hasn't been compacted for journalCompactInterval seconds, then re-arms for the rest
+    with _journalState["lock"]:
+        _journalState["timer"] = None
+        now = time.monotonic()
+        dueJournals = [(journalPath, productRunDictPath) for journalPath, productRunDictPath in _journalState["pending"].items() if now - _journalState["lastCompacted"].get(journalPath, float("-inf")) >= journalCompactInterval]
+    try:
+        for journalPath, productRunDictPath in dueJournals:
+            _compactPendingJournal(journalPath, productRunDictPath)
+    finally:
+        with _journalState["lock"]:
+            _scheduleJournalFlush()
+
+
+def _compactPendingJournal(journalPath, productRunDictPath):
+    # The state is updated while the run's lock is still held, so a frame appended right after this compaction can't be dropped from pending
+    with runLock(path.splitext(productRunDictPath)[0]+".lock"):
+        _compactJournal(productRunDictPath, journalPath)
+        with _journalState["lock"]:
+            _journalState["lastCompacted"][journalPath] = time.monotonic()
+            _journalState["pending"].pop(journalPath, None)
+
+
+def _runJournalPath(basePath, productID, runTime):
+    # Journals are kept outside of output/ so that they never get rsynced to the server
+    return path.join(basePath, "journal", str(productID), runTime.strftime("%Y%m%d%H00")+".jsonl")
+
+
+def _compactJournal(productRunDictPath, journalPath):
+    # Materializes the journal into the productRun json and removes the journal, the caller must hold the run's lock
+    if not path.exists(journalPath):
+        return
+    productID = path.basename(path.dirname(productRunDictPath))
+    framesByName = dict()
+    imageDigests = dict()
+    lastEntry = None
+    with timingSpan("writeJson.read", productID):
+        if path.exists(productRunDictPath):
+            with open(productRunDictPath, "r") as jsonRead:
+                for frame in json.load(jsonRead)["productFrames"]:
+                    framesByName[frame["filename"]] = frame
+        if publishManifestsEnabled:
+            imageDigests = _manifestImageDigests(_manifestPath(productRunDictPath))
+        with open(journalPath, "r") as journalRead:
+            journalLines = journalRead.readlines()
+    with timingSpan("writeJson.merge", productID):
+        for journalLine in journalLines:
+            try:
+                journalEntry = json.loads(journalLine)
+            except ValueError:
+                # Partial line left by a writer that died mid-append
+                continue
+            # Re-publishing a frame replaces it and moves it to the end, same as a fresh append
+            framesByName.pop(journalEntry["frame"]["filename"], None)
+            framesByName[journalEntry["frame"]["filename"]] = journalEntry["frame"]
+            if "image" in journalEntry.keys():
+                imageDigests[journalEntry["frame"]["filename"]] = journalEntry["image"]
+            lastEntry = journalEntry
+        if lastEntry is not None:
+            totalFrameCount = lastEntry["totalFrameCount"]
+            if totalFrameCount == -1:
+                totalFrameCount = len(framesByName)
+            productRunDict = {
+                "publishTime" : lastEntry["frame"]["publishTime"],
+                "pathExtension" : lastEntry["pathExtension"],
+                "runName" : lastEntry["runName"],
+                "availableFrameCount" : len(framesByName),
+                "totalFrameCount" : totalFrameCount,
+                "productFrames" : sorted(framesByName.values(), key=lambda dict: int(dict["valid"])) # productFramesArray, sorted by increasing valid Time
+            }
+    if lastEntry is not None:
+        runJsonBytes = _metadataJsonBytes(productRunDict)
+        changedFiles = list()
+        # Written before the run's json, so the manifest never lists less than the json does
+        if publishManifestsEnabled:
+            with timingSpan("writeJson.manifest", productID):
+                changedFiles.append(_writeManifest(productRunDictPath, productRunDict, imageDigests, runJsonBytes))
+        with timingSpan("writeJson.write", productID):
+            _writeMetadataBytes(productRunDictPath, runJsonBytes)
+        # productRunDictPath is <basePath>/output/metadata/products/<productID>/<run>.json
+        outputDir = path.dirname(path.dirname(path.dirname(path.dirname(productRunDictPath))))
+        changedFiles.extend(_metadataJsonFiles(productRunDictPath))
+        recordChangedPaths(path.dirname(outputDir), [path.relpath(runFile, outputDir) for runFile in changedFiles])
+    remove(journalPath)
+
+
+def compactRunJournal(basePath, productID, runTime):
+    """
+    Immediately rebuilds the productRun json of a run from any frames still waiting in its journal
+    Parameters:
+    ----------
+    basePath: the path of the calling module
+    productID: the productID of the product
+    runTime: the run to compact
+
+    """
+    productRunDictPath = path.join(basePath, "output", "metadata", "products", str(productID), runTime.strftime("%Y%m%d%H00")+".json")
+    journalPath = _runJournalPath(basePath, productID, runTime)
+    if path.exists(journalPath):
+        Path(path.dirname(productRunDictPath)).mkdir(parents=True, exist_ok=True)
+        _compactPendingJournal(journalPath, productRunDictPath)
+    else:
+        with _journalState["lock"]:
+            _journalState["pending"].pop(journalPath, None)
+
+
+def compactPendingJournals():
+    """
+    Compacts every run journal this process has appended to but not yet compacted. Registered to run at exit.
+    """
+    with _journalState["lock"]:
+        pendingJournals = list(_journalState["pending"].items())
+    for journalPath, productRunDictPath in pendingJournals:
+        _compactPendingJournal(journalPath, productRunDictPath)
+
+
+def compactAllJournals(basePath):
+    """
+    Compacts every run journal under basePath, including ones abandoned by a writer that crashed before compacting
+    Parameters:
+    ----------
+    basePath: the path of the module whose journals should be compacted
+
+    """
+    journalTopDir = path.join(basePath, "journal")
+    if not path.exists(journalTopDir):
+        return
+    for productID in listdir(journalTopDir):
+        for journalFileName in listdir(path.join(journalTopDir, productID)):
+            if journalFileName.endswith(".jsonl"):
+                compactRunJournal(basePath, productID, dt.strptime(journalFileName, "%Y%m%d%H00.jsonl"))
+
+
+atexit.register(compactPendingJournals)
+
+
+# Files written to a module's output/ are appended (as paths relative to output/) to <basePath>/sync/changed.log, so that syncHDWX.py only has to ship what changed
+# instead of rescanning the whole output tree. Enabled with the HDWX_SYNC_LOG=1 environment variable.
+syncLogEnabled = environ.get("HDWX_SYNC_LOG", "0") == "1"
+
+
+def syncLogPath(basePath):
+    """
+    Returns the path of the changed path log of the module at basePath. Kept outside of output/ like the journals.
+    """
+    return path.join(basePath, "sync", "changed.log")
+
+
+def _metadataJsonFiles(jsonPath):
+    # A metadata json and the precompressed siblings writeMetadataJson writes next to it
+    return [jsonPath] + [jsonPath+"."+encoding for encoding in metadataSiblingExtensions if encoding in metadataOutput["precompress"]]
+
+
+def recordChangedPaths(basePath, changedPaths):
+    """
+    Adds files to the module's changed path log, to be shipped by the next syncHDWX.py pass. writeJson already records each frame's image and metadata,
+    call this for any other file written to output/. Does nothing unless HDWX_SYNC_LOG=1.
+    Parameters:
+    ----------
+    basePath: the path of the calling module
+    changedPaths: paths of the files, relative to basePath/output
+
+    """
+    if not syncLogEnabled or len(changedPaths) == 0:
+        return
+    logPath = syncLogPath(basePath)
+    Path(path.dirname(logPath)).mkdir(parents=True, exist_ok=True)
+    logLines = "".join([changedPath+"\n" for changedPath in changedPaths])
+    while True:
+        with open(logPath, "a") as logWrite:
+            # syncHDWX.py claims the log by renaming it while holding this lock, after which anything appended to the old file would never be shipped
+            fcntl.flock(logWrite, fcntl.LOCK_EX)
+            try:
+                stillCurrent = stat(logPath).st_ino == fstat(logWrite.fileno()).st_ino
+            except FileNotFoundError:
+                stillCurrent = False
+            if stillCurrent:
+                logWrite.write(logLines)
+                return
+
+
+# Per-run publish manifests, at <basePath>/output/metadata/manifests/<productID>/<run>.json, listing the size and sha256 of every image of the run and of the run's json.
+# Rewritten whenever the run's json is, just before it. A mirror can compare a run's new manifest with the copy it already has to only fetch what changed, see manifestChanges.
+# Enabled with the HDWX_PUBLISH_MANIFESTS=1 environment variable.
+publishManifestsEnabled = environ.get("HDWX_PUBLISH_MANIFESTS", "0") == "1"
+
+
+def fileDigest(filePath):
+    """
+    Returns {"size", "sha256"} of a file, or None if it doesn't exist
+    """
+    fileHash = hashlib.sha256()
+    fileSize = 0
+    try:
+        with open(filePath, "rb") as fileRead:
+            while True:
+                fileChunk = fileRead.read(1048576)
+                if len(fileChunk) == 0:
+                    break
+                fileHash.update(fileChunk)
+                fileSize += len(fileChunk)
+    except FileNotFoundError:
+        return None
+    return {"size" : fileSize, "sha256" : fileHash.hexdigest()}
+
+
+def _manifestPath(productRunDictPath):
+    # <basePath>/output/metadata/products/<productID>/<run>.json's manifest is <basePath>/output/metadata/manifests/<productID>/<run>.json
+    return path.join(path.dirname(path.dirname(path.dirname(productRunDictPath))), "manifests", path.basename(path.dirname(productRunDictPath)), path.basename(productRunDictPath))
+
+
+def _manifestImageDigests(manifestPath):
+    # Digests of the images in a run's current manifest, by filename
+    try:
+        with open(manifestPath, "r") as jsonRead:
+            manifest = json.load(jsonRead)
+    except (FileNotFoundError, ValueError):
+        return dict()
+    return {path.basename(filePath) : fileInfo for filePath, fileInfo in manifest["files"].items() if not filePath.startswith("metadata/")}
+
+
+def _writeManifest(productRunDictPath, productRunDict, imageDigests, runJsonBytes):
+    # Writes the manifest of a run about to be written as runJsonBytes, returns the manifest's path
+    productID = path.basename(path.dirname(productRunDictPath))
+    outputDir = path.dirname(path.dirname(path.dirname(path.dirname(productRunDictPath))))
+    imageDir = path.join(getProduct(int(productID)).productPath, productRunDict["pathExtension"])
+    # Images first and the run's json last, the order mirrors should fetch them in. Frames published without their image on disk aren't listed.
+    manifestFiles = {path.join(imageDir, frame["filename"]) : imageDigests[frame["filename"]] for frame in productRunDict["productFrames"] if imageDigests.get(frame["filename"]) is not None}
+    manifestFiles[path.relpath(productRunDictPath, outputDir)] = {"size" : len(runJsonBytes), "sha256" : hashlib.sha256(runJsonBytes).hexdigest()}
+    manifest = {
+        "productID" : int(productID),
+        "run" : path.splitext(path.basename(productRunDictPath))[0],
+        "publishTime" : productRunDict["publishTime"],
+        "files" : manifestFiles
+    }
+    manifestPath = _manifestPath(productRunDictPath)
+    Path(path.dirname(manifestPath)).mkdir(parents=True, exist_ok=True)
+    atomicWriteBytes(manifestPath, json.dumps(manifest, separators=(",", ":")).encode())
+    return manifestPath
+
+
+def manifestChanges(manifest, previousManifest=None):
+    """
+    Lists the files of a run that are new or changed since a previous version of its publish manifest
+    Parameters:
+    ----------
+    manifest: the run's new manifest
+    previousManifest: the version of the manifest a mirror already has, or None if it has none
+    Returns paths relative to the HDWX server root, images first and the run's json last, which is the order they should be fetched in
+
+    """
+    previousFiles = dict() if previousManifest is None else previousManifest["files"]
+    return [filePath for filePath, fileInfo in manifest["files"].items() if previousFiles.get(filePath) != fileInfo]
+
+
+# Optional SQLite index of every product, run, and frame written by a module, kept at basePath/metadataIndex.sqlite3 (outside of output/, like the journals).
+# Enabled with the HDWX_METADATA_INDEX=1 environment variable. The metadata json is still written either way, the index only saves readers from walking it.
+metadataIndexEnabled = environ.get("HDWX_METADATA_INDEX", "0") == "1"
+metadataIndexName = "metadataIndex.sqlite3"
+_metadataIndexSchema = """
+CREATE TABLE IF NOT EXISTS products (productID INTEGER PRIMARY KEY, productTypeID INTEGER NOT NULL, productJson TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS runs (productID INTEGER NOT NULL, runTime TEXT NOT NULL, pathExtension TEXT NOT NULL, runName TEXT NOT NULL, totalFrameCount INTEGER NOT NULL, publishTime TEXT NOT NULL, PRIMARY KEY (productID, runTime));
+CREATE INDEX IF NOT EXISTS runsByTime ON runs (runTime);
+CREATE TABLE IF NOT EXISTS frames (productID INTEGER NOT NULL, runTime TEXT NOT NULL, filename TEXT NOT NULL, fhour INTEGER NOT NULL, valid TEXT NOT NULL, publishTime TEXT NOT NULL, gisInfo TEXT NOT NULL, PRIMARY KEY (productID, runTime, filename));
+"""
+# Connections can't be shared with forked children, so they're cached per process
+_metadataIndexConnections = dict()
+
+
+def openMetadataIndex(indexPath):
+    """
+    Returns a connection to the metadata index at indexPath, creating it if needed. The index is in WAL mode so that readers never block the writer.
+    Transactions (with connection:) take the write lock immediately, so concurrent writers queue up instead of deadlocking.
+    """
+    connectionKey = (getpid(), path.abspath(indexPath))
+    if connectionKey not in _metadataIndexConnections.keys():
+        import sqlite3
+        connection = sqlite3.connect(indexPath, timeout=120, isolation_level="IMMEDIATE")
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_metadataIndexSchema)
+        _metadataIndexConnections[connectionKey] = connection
+    return _metadataIndexConnections[connectionKey]
+
+
+def _indexProducts(connection, productDicts):
+    connection.executemany("INSERT OR REPLACE INTO products (productID, productTypeID, productJson) VALUES (?, ?, ?)",
+        [(productDict["productID"], productTypeID, json.dumps(productDict)) for productTypeID, productDict in productDicts])
+
+
+def _indexRun(connection, productID, runKey, lastEntry, frames):
+    connection.executemany("INSERT OR REPLACE INTO frames (productID, runTime, filename, fhour, valid, publishTime, gisInfo) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(productID, runKey, frame["filename"], frame["fhour"], frame["valid"], frame["publishTime"], json.dumps(frame["gisInfo"])) for frame in frames])
+    totalFrameCount = lastEntry["totalFrameCount"]
+    if totalFrameCount == -1:
+        # Same as the productRun json, runs of unknown length count the frames they have
+        totalFrameCount = connection.execute("SELECT count(*) FROM frames WHERE productID = ? AND runTime = ?", (productID, runKey)).fetchone()[0]
+    connection.execute("INSERT OR REPLACE INTO runs (productID, runTime, pathExtension, runName, totalFrameCount, publishTime) VALUES (?, ?, ?, ?, ?, ?)",
+        (productID, runKey, lastEntry["pathExtension"], lastEntry["runName"], totalFrameCount, lastEntry["frame"]["publishTime"]))
+
+
+def _indexFrames(productDicts, runEntries):
+    # Mirrors one flush into the metadata index of every module it touched, one transaction per module, after the json has been written
+    for basePath in set([basePath for basePath, productID in productDicts.keys()]):
+        connection = openMetadataIndex(path.join(basePath, metadataIndexName))
+        with connection:
+            _indexProducts(connection, [(getProduct(productID).productTypeID, productDict) for (productBasePath, productID), productDict in productDicts.items() if productBasePath == basePath])
+            for (runBasePath, productID, runTime), journalEntries in runEntries.items():
+                if runBasePath == basePath:
+                    _indexRun(connection, productID, runTime.strftime("%Y%m%d%H00"), journalEntries[-1], [journalEntry["frame"] for journalEntry in journalEntries])
+
+
+def rebuildMetadataIndex(basePath):
+    """
+    Replaces the contents of a module's metadata index with what's currently in its output/metadata json. Run this when turning the index on for a module that already has output.
+    Parameters:
+    ----------
+    basePath: the path of the module whose index should be rebuilt
+
+    """
+    compactAllJournals(basePath)
+    metadataDir = path.join(basePath, "output", "metadata")
+    connection = openMetadataIndex(path.join(basePath, metadataIndexName))
+    with connection:
+        connection.execute("DELETE FROM products")
+        connection.execute("DELETE FROM runs")
+        connection.execute("DELETE FROM frames")
+        productTypesDir = path.join(metadataDir, "productTypes")
+        for productTypeFile in (listdir(productTypesDir) if path.exists(productTypesDir) else list()):
+            if not productTypeFile.endswith(".json"):
+                continue
+            with open(path.join(productTypesDir, productTypeFile), "r") as jsonRead:
+                productTypeDict = json.load(jsonRead)
+            _indexProducts(connection, [(productTypeDict["productTypeID"], productDict) for productDict in productTypeDict["products"]])
+        runsDir = path.join(metadataDir, "products")
+        for productID in (listdir(runsDir) if path.exists(runsDir) else list()):
+            for runFile in listdir(path.join(runsDir, productID)):
+                if not runFile.endswith(".json"):
+                    continue
+                with open(path.join(runsDir, productID, runFile), "r") as jsonRead:
+                    productRunDict = json.load(jsonRead)
+                lastEntry = {"pathExtension" : productRunDict["pathExtension"], "runName" : productRunDict["runName"], "totalFrameCount" : productRunDict["totalFrameCount"], "frame" : {"publishTime" : productRunDict["publishTime"]}}
+                _indexRun(connection, int(productID), path.splitext(runFile)[0], lastEntry, productRunDict["productFrames"])
+
+
+def indexedProductTypes(connection):
+    """
+    Returns a dict of productTypeID to the list of product dicts of that productType in the metadata index, in productID order
+    """
+    productTypes = dict()
+    for productTypeID, productJson in connection.execute("SELECT productTypeID, productJson FROM products ORDER BY productTypeID, productID"):
+        productTypes.setdefault(productTypeID, list()).append(json.loads(productJson))
+    return productTypes
+
+
+def indexedRuns(connection):
+    """
+    Returns a dict of productID to a list of (run time as %Y%m%d%H%M, pathExtension) of every run in the metadata index, oldest first
+    """
+    runs = dict()
+    for productID, runKey, pathExtension in connection.execute("SELECT productID, runTime, pathExtension FROM runs ORDER BY productID, runTime"):
+        runs.setdefault(productID, list()).append((runKey, pathExtension))
+    return runs
+
+
+def indexedFrames(connection, productID, runTime):
+    """
+    Returns the frames of one run in the metadata index in the same form as the productRun json's productFrames, sorted by valid time
+    """
+    frames = connection.execute("SELECT fhour, filename, gisInfo, valid, publishTime FROM frames WHERE productID = ? AND runTime = ? ORDER BY valid", (productID, runTime.strftime("%Y%m%d%H00")))
+    return [{"fhour" : fhour, "filename" : filename, "gisInfo" : json.loads(gisInfo), "valid" : valid, "publishTime" : publishTime} for fhour, filename, gisInfo, valid, publishTime in frames]
+
+
+def removeIndexedRuns(connection, productID, runKeys):
+    """
+    Removes runs (given as run time strings, %Y%m%d%H%M) and their frames from the metadata index, once they've been purged from disk
+    """
+    with connection:
+        connection.executemany("DELETE FROM frames WHERE productID = ? AND runTime = ?", [(productID, runKey) for runKey in runKeys])
+        connection.executemany("DELETE FROM runs WHERE productID = ? AND runTime = ?", [(productID, runKey) for runKey in runKeys])
+
+
+# Data-to-publish latency of every frame: seconds from the frame's valid time (or its run's initialization, for forecasts) until writeJson.
+# The last "window" latencies of each product are kept in <basePath>/latency/<productID>.json along with their p50, p95, and max. Latencies are added to it
+# at most every flushSeconds per product (every frame in forked worker processes, which don't run atexit), and when the process exits.
+publishLatency = {"window" : 500, "flushSeconds" : 10}
+_latencyState = {"pid" : getpid(), "forked" : False, "pending" : dict(), "lastFlushed" : dict()}
+
+
+def _latencyStateForProcess():
+    # Forked children start without their parent's pending latencies, which the parent still adds itself
+    if _latencyState["pid"] != getpid():
+        _latencyState.update({"pid" : getpid(), "forked" : True, "pending" : dict(), "lastFlushed" : dict()})
+
+
+def _latencyPath(basePath, productID):
+    # Kept outside of output/ like the journals, so that it never gets rsynced to the server
+    return path.join(basePath, "latency", str(productID)+".json")
+
+
+def _percentile(sortedValues, fraction):
+    # Nearest rank
+    return sortedValues[max(math.ceil(fraction*len(sortedValues)) - 1, 0)]
+
+
+def _recordPublishLatency(basePath, productID, latencySeconds):
+    recordSpan("publishLatency", latencySeconds, productID)
+    _latencyStateForProcess()
+    _latencyState["pending"].setdefault((basePath, productID), list()).append(latencySeconds)
+    flushInterval = 0 if _latencyState["forked"] else publishLatency["flushSeconds"]
+    if time.monotonic() - _latencyState["lastFlushed"].get((basePath, productID), float("-inf")) >= flushInterval:
+        _flushPublishLatency(basePath, productID)
+
+
+def _flushPublishLatency(basePath, productID):
+    # Adds a product's pending latencies to its latency file and recomputes its percentiles
+    pendingLatencies = _latencyState["pending"].pop((basePath, productID), list())
+    _latencyState["lastFlushed"][(basePath, productID)] = time.monotonic()
+    if len(pendingLatencies) == 0:
+        return
+    latencyPath = _latencyPath(basePath, productID)
+    Path(path.dirname(latencyPath)).mkdir(parents=True, exist_ok=True)
+    with runLock(path.splitext(latencyPath)[0]+".lock"):
+        try:
+            with open(latencyPath, "r") as jsonRead:
+                previousStats = json.load(jsonRead)
+        except (FileNotFoundError, ValueError):
+            previousStats = {"frames" : 0, "latencies" : list()}
+        latencies = (previousStats["latencies"] + [round(latencySeconds, 1) for latencySeconds in pendingLatencies])[-publishLatency["window"]:]
+        sortedLatencies = sorted(latencies)
+        targetSeconds = getProduct(productID).publishLatencyTargetSeconds if productID in productRegistry.keys() else None
+        latencyStats = {
+            "productID" : productID,
+            "updated" : dt.utcnow().strftime("%Y%m%d%H%M%S"),
+            "frames" : previousStats["frames"] + len(pendingLatencies),
+            "p50Seconds" : _percentile(sortedLatencies, 0.5),
+            "p95Seconds" : _percentile(sortedLatencies, 0.95),
+            "maxSeconds" : sortedLatencies[-1],
+            "targetSeconds" : targetSeconds,
+            "meetingTarget" : None if targetSeconds is None else _percentile(sortedLatencies, 0.95) <= targetSeconds,
+            "latencies" : latencies
+        }
+        atomicWriteBytes(latencyPath, json.dumps(latencyStats, separators=(",", ":")).encode())
+
+
+def flushPublishLatencies():
+    """
+    Writes every publish latency this process has recorded but not yet added to its product's latency file. Registered to run at exit.
+    """
+    _latencyStateForProcess()
+    for basePath, productID in list(_latencyState["pending"].keys()):
+        _flushPublishLatency(basePath, productID)
+
+
+atexit.register(flushPublishLatencies)
+
+
+def publishLatencySummary(basePath):
+    """
+    Reads the publish latency stats of every product a module has published
+    Parameters:
+    ----------
+    basePath: the path of the module
+    Returns a dict of productID to its stats (frames, p50Seconds, p95Seconds, maxSeconds, targetSeconds, meetingTarget, updated), without the individual latencies
+
+    """
+    latencyDir = path.join(basePath, "latency")
+    latencySummary = dict()
+    if not path.exists(latencyDir):
+        return latencySummary
+    for latencyFileName in sorted(listdir(latencyDir)):
+        if not latencyFileName.endswith(".json"):
+            continue
+        try:
+            with open(path.join(latencyDir, latencyFileName), "r") as jsonRead:
+                latencyStats = json.load(jsonRead)
+        except ValueError:
+            continue
+        latencyStats.pop("latencies", None)
+        latencySummary[latencyStats["productID"]] = latencyStats
+    return latencySummary
+
+
+# While a writeJsonBatch is open, writeJson only queues its frames here
+_batchState = {"depth" : 0, "frames" : list()}
+
+
+@contextmanager
+def writeJsonBatch():
+    """
+    Collects every writeJson call made inside the with block and writes each affected product, productRun, and productType json exactly once
+    when the block exits. The files written are the same as if writeJson had been called without a batch. Batches can be nested, only the outermost one flushes.
+    """
+    _batchState["depth"] += 1
+    try:
+        yield
+    finally:
+        _batchState["depth"] -= 1
+        if _batchState["depth"] == 0:
+            queuedFrames = _batchState["frames"]
+            _batchState["frames"] = list()
+            _flushFrames(queuedFrames)
+
+
+def _flushFrames(queuedFrames):
+    # Writes the metadata for a list of (basePath, productDict, runTime, journalEntry) tuples, touching every file only once
+    from natsort import natsorted
+    _journalStateForProcess()
+    productDicts = dict()
+    runEntries = dict()
+    changedPaths = dict()
+    for basePath, productDict, runTime, journalEntry in queuedFrames:
+        # Later frames win for the product json, so lastReloadTime ends up being the time of the last frame
+        productDicts[(basePath, productDict["productID"])] = productDict
+        runEntries.setdefault((basePath, productDict["productID"], runTime), list()).append(journalEntry)
+        # The frame's image, which is on disk by the time it's published
+        changedPaths.setdefault(basePath, list()).append(path.join(productDict["productPath"], journalEntry["pathExtension"], journalEntry["frame"]["filename"]))
+
+    for (basePath, productID), productDict in productDicts.items():
+        productDictJsonPath = path.join(basePath, "output", "metadata", str(productID)+".json")
+        Path(path.dirname(productDictJsonPath)).mkdir(parents=True, exist_ok=True)
+        with timingSpan("writeJson.productJson", productID):
+            writeMetadataJson(productDictJsonPath, productDict)
+        changedPaths[basePath].extend([path.relpath(productFile, path.join(basePath, "output")) for productFile in _metadataJsonFiles(productDictJsonPath)])
+
+    for (basePath, productID, runTime), journalEntries in runEntries.items():
+        productRunDictPath = path.join(basePath, "output", "metadata", "products", str(productID), runTime.strftime("%Y%m%d%H00")+".json")
+        productRunLockPath = path.join(basePath, "output", "metadata", "products", str(productID), runTime.strftime("%Y%m%d%H00")+".lock")
+        journalPath = _runJournalPath(basePath, productID, runTime)
+        Path(path.dirname(productRunDictPath)).mkdir(parents=True, exist_ok=True)
+        Path(path.dirname(journalPath)).mkdir(parents=True, exist_ok=True)
+        lockWaitStart = time.perf_counter()
+        with runLock(productRunLockPath):
+            recordSpan("writeJson.lockWait", time.perf_counter() - lockWaitStart, productID)
+            # Appending is constant-time no matter how many frames the run already has, the productRun json is rebuilt from the journal later
+            with timingSpan("writeJson.journalAppend", productID):
+                with open(journalPath, "a") as journalWrite:
+                    journalWrite.write("".join([json.dumps(journalEntry)+"\n" for journalEntry in journalEntries]))
+            with _journalState["lock"]:
+                compactNow = len(queuedFrames) > 1 or time.monotonic() - _journalState["lastCompacted"].get(journalPath, float("-inf")) >= journalCompactInterval
+                if not compactNow:
+                    _journalState["pending"][journalPath] = productRunDictPath
+                    _scheduleJournalFlush()
+            if compactNow:
+                _compactJournal(productRunDictPath, journalPath)
+                with _journalState["lock"]:
+                    _journalState["lastCompacted"][journalPath] = time.monotonic()
+                    _journalState["pending"].pop(journalPath, None)
+
+    # A writer that has moved on to another run of a product won't add to the runs it left pending, so those are compacted now instead of waiting for the timer.
+    # Done once every run lock above is released, as holding two runs' locks at once could deadlock with another writer.
+    writtenJournals = set([_runJournalPath(basePath, productID, runTime) for basePath, productID, runTime in runEntries.keys()])
+    with _journalState["lock"]:
+        leftJournals = [(journalPath, productRunDictPath) for journalPath, productRunDictPath in _journalState["pending"].items()
+                        if journalPath not in writtenJournals and path.dirname(journalPath) in [path.dirname(writtenJournal) for writtenJournal in writtenJournals]]
+    for journalPath, productRunDictPath in leftJournals:
+        _compactPendingJournal(journalPath, productRunDictPath)
+
+    productTypeUpdates = dict()
+    for (basePath, productID), productDict in productDicts.items():
+        productTypeUpdates.setdefault((basePath, getProduct(productID).productTypeID), dict())[productID] = productDict
+    for (basePath, productTypeID), updatedProducts in productTypeUpdates.items():
+        productTypeDesc = productTypeRegistry[productTypeID].productTypeDescription
+        productTypeDictPath = path.join(basePath, "output", "metadata", "productTypes", str(productTypeID)+".json")
+        Path(path.dirname(productTypeDictPath)).mkdir(parents=True, exist_ok=True)
+        productsInType = list()
+        if path.exists(productTypeDictPath):
+            with open(productTypeDictPath, "r") as jsonRead:
+                oldProductTypeDict = json.load(jsonRead)
+            for productInOldDict in oldProductTypeDict["products"]:
+                if productInOldDict["productID"] not in updatedProducts.keys():
+                    productsInType.append(productInOldDict)
+        productsInType.extend(updatedProducts.values())
+        productTypeDict = {
+            "productTypeID" : productTypeID,
+            "productTypeDescription" : productTypeDesc,
+            "products" : natsorted(productsInType, key=lambda dict: dict["productID"])
+        }
+        with timingSpan("writeJson.productTypeJson"):
+            writeMetadataJson(productTypeDictPath, productTypeDict)
+
+    # The productRun json is recorded when its journal is compacted. The productType json isn't shipped, productTypeJsonManager.py merges every module's copy on the server.
+    for basePath, basePathChanges in changedPaths.items():
+        recordChangedPaths(basePath, basePathChanges)
+
+    if metadataIndexEnabled:
+        with timingSpan("writeJson.index"):
+            _indexFrames(productDicts, runEntries)
+
 
 def writeJson(basePath, productID, runTime, fileName, validTime, gisInfo, reloadInterval):
     """
     Updates the JSON data required for the server to provide API data to users. When adding a new frame to a product, this function should be called.
+    Inside a writeJsonBatch block, the frame is queued and written when the batch exits.
     Parameters:
     ----------
     basePath: the path of the calling module
@@ -23,1424 +1035,8 @@ def writeJson(basePath, productID, runTime, fileName, validTime, gisInfo, reload
 
     """
     publishTime = dt.utcnow()
-    runPathExtension = runTime.strftime("%Y/%m/%d/%H00/")
-    if productID == 0:
-        productDesc = "MRMS Reflectivity At Lowest Altitude"
-        productPath = "gisproducts/radar/RALA/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 30
-        productTypeID = 0
-        totalFrameCount = -1
-    elif productID == 1:
-        productDesc = "MRMS National Reflectivity At Lowest Altitude"
-        productPath = "products/radar/national/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 30
-        productTypeID = 0
-        totalFrameCount = -1
-    elif productID == 2:
-        productDesc = "MRMS Regional Reflectivity At Lowest Altitude"
-        productPath = "products/radar/regional/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 30
-        productTypeID = 0
-        totalFrameCount = -1
-    elif productID == 3:
-        productDesc = "MRMS Local Reflectivity At Lowest Altitude"
-        productPath = "products/radar/local/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 30
-        productTypeID = 0
-        totalFrameCount = -1
-    elif productID == 4:
-        productDesc = "CONUS GeoColor"
-        productPath = "gisproducts/satellite/goes16/geocolor/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 24
-        productTypeID = 0
-        totalFrameCount = -1
-    elif productID == 5:
-        productDesc = "GOES-16 CONUS GeoColor"
-        productPath = "products/satellite/goes16/geocolor/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 24
-        productTypeID = 0
-        totalFrameCount = -1
-    elif productID == 100:
-        productDesc = "Mesonet Farm WxCenter"
-        productPath = "products/mesonet/Farm/wxcenter/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 1
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 101:
-        productDesc = "Mesonet Farm Timeseries"
-        productPath = "products/mesonet/Farm/timeseries/"
-        runPathExtension = "last24hrs"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 1
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 102:
-        productDesc = "Mesonet Gardens WxCenter"
-        productPath = "products/mesonet/Gardens/wxcenter/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 1
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 103:
-        productDesc = "Mesonet Gardens Timeseries"
-        productPath = "products/mesonet/Gardens/timeseries/"
-        runPathExtension = "last24hrs"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 1
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 120:
-        productDesc = "ADRAD 0.5° Reflectivity PPI"
-        productPath = "gisproducts/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 121:
-        productDesc = "ADRAD 0.5° Reflectivity PPI"
-        productPath = "products/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 122:
-        productDesc = "ADRAD 0.5° Reflectivity PPI (Quality-controlled)"
-        productPath = "gisproducts/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 123:
-        productDesc = "ADRAD 0.5° Reflectivity PPI (Quality-controlled)"
-        productPath = "products/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 124:
-        productDesc = "ADRAD 0.5° Signal Quality Index"
-        productPath = "products/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 125:
-        productDesc = "ADRAD 0.5° Velocity PPI"
-        productPath = "gisproducts/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 126:
-        productDesc = "ADRAD 0.5° Velocity PPI"
-        productPath = "products/radar/ADRAD/"+str(productID)
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 140:
-        productDesc = "HLMA VHF 1-minute Sources"
-        productPath = "gisproducts/hlma/vhf-1min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 141:
-        productDesc = "HLMA VHF 1-minute Sources"
-        productPath = "products/hlma/vhf-1min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 142:
-        productDesc = "GR2Analyst HLMA VHF Sources (1 minute)"
-        productPath = "gr2a/"
-        isFcst = False
-        fileExt = "php"
-        dispFrames = 1
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 143:
-        productDesc = "HLMA VHF 10-minute Sources"
-        productPath = "gisproducts/hlma/vhf-10min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 144:
-        productDesc = "HLMA VHF 10-minute Sources"
-        productPath = "products/hlma/vhf-10min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 145:
-        productDesc = "GR2Analyst HLMA VHF Sources (10 minutes)"
-        productPath = "gr2a/"
-        isFcst = False
-        fileExt = "php"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 146:
-        productDesc = "HLMA 1-minute Flash Extent Density"
-        productPath = "gisproducts/hlma/flash-1min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 147:
-        productDesc = "HLMA 1-minute Flash Extent Density"
-        productPath = "products/hlma/flash-1min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 148:
-        productDesc = "HLMA 10-minute Flash Extent Density"
-        productPath = "gisproducts/hlma/flash-10min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 149:
-        productDesc = "HLMA 10-minute Flash Extent Density"
-        productPath = "products/hlma/flash-10min/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 150:
-        productDesc = "HLMA VHF 1-minute Sources + ADRAD Reflectivity"
-        productPath = "products/hlma/adrad-src/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 151:
-        productDesc = "HLMA VHF 1-minute Sources + MRMS Reflectivity At Lowest Altitude"
-        productPath = "products/hlma/mrms-src/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 30
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 152:
-        productDesc = "HLMA 1-minute Flash Extent Density + ADRAD Reflectivity"
-        productPath = "products/hlma/adrad-flash/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 153:
-        productDesc = "HLMA 1-minute Flash Extent Density + MRMS Reflectivity At Lowest Altitude"
-        productPath = "products/hlma/mrms-flash/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 30
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 154:
-        productDesc = "HLMA VHF 1-minute Sources Analysis Plot"
-        productPath = "products/hlma/vhf-1min-analysis/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 155:
-        productDesc = "HLMA VHF 1-minute Sources Analysis Plot"
-        productPath = "products/hlma/vhf-10min-analysis/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 156:
-        productDesc = "HLMA VHF 1-minute Sources Analysis Plot + MRMS Reflectivity At Lowest Altitude"
-        productPath = "products/hlma/mrms-src-analysis/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 157:
-        productDesc = "HLMA Flash Flood Analysis"
-        productPath = "products/hlma/ffanalysis/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 60
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 190:
-        productDesc = "TASC Location"
-        productPath = "gisproducts/tasc/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 191:
-        productDesc = "TASC Location + MRMS Reflectivity"
-        productPath = "products/tasc/rala/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 192:
-        productDesc = "TASC Location + GeoColor"
-        productPath = "products/tasc/geocolor/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 1
-        totalFrameCount = -1
-    elif productID == 300:
-        productDesc = "GFS Surface Temperature"
-        productPath = "gisproducts/gfs/sfcT/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 301:
-        productDesc = "GFS Surface Winds"
-        productPath = "gisproducts/gfs/sfcWnd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 302:
-        productDesc = "GFS Surface MSLP"
-        productPath = "gisproducts/gfs/sfcMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 303:
-        productDesc = "GFS Surface Temperature, Winds, MSLP"
-        productPath = "products/gfs/sfcTWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 304:
-        productDesc = "GFS Surface Dew Point"
-        productPath = "gisproducts/gfs/sfcTd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 305:
-        productDesc = "GFS Surface Dew Point, Winds, MSLP"
-        productPath = "products/gfs/sfcTdWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 308:
-        productDesc = "GFS Simulated Composite Reflectivity"
-        productPath = "gisproducts/gfs/simrefc/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 309:
-        productDesc = "GFS 1hr Max Updraft Helicity"
-        productPath = "gisproducts/gfs/udhelicity/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 310:
-        productDesc = "GFS Simulated Composite Reflectivity"
-        productPath = "products/gfs/refccomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 316:
-        productDesc = "GFS 500 hPa Winds"
-        productPath = "gisproducts/gfs/500wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 318:
-        productDesc = "GFS 500 hPa Heights"
-        productPath = "gisproducts/gfs/500hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 320:
-        productDesc = "GFS 500 hPa Heights, Winds, Vorticity"
-        productPath = "products/gfs/500staticvort/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 321:
-        productDesc = "GFS 250 hPa Winds"
-        productPath = "gisproducts/gfs/250wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 322:
-        productDesc = "GFS 250 hPa Heights"
-        productPath = "gisproducts/gfs/250hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 324:
-        productDesc = "GFS 250 hPa Heights, Winds, Isotachs"
-        productPath = "products/gfs/250staticjet/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 325:
-        productDesc = "GFS 850 hPa Winds"
-        productPath = "gisproducts/gfs/850wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 326:
-        productDesc = "GFS 850 hPa Heights"
-        productPath = "gisproducts/gfs/850hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 327:
-        productDesc = "GFS 850 hPa Temperatures"
-        productPath = "gisproducts/gfs/850temps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 328:
-        productDesc = "GFS 850 hPa Heights, Winds, Temperatures"
-        productPath = "products/gfs/850statictemps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 329:
-        productDesc = "GFS 700 hPa Relative Humidity"
-        productPath = "gisproducts/gfs/700rh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 331:
-        productDesc = "GFS 700 hPa Relative Humidity, MSLP, 1000->500 hPa Thickness"
-        productPath = "products/gfs/700staticrh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 332:
-        productDesc = "GFS 4-Panel"
-        productPath = "products/gfs/4pnl/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 380:
-        productDesc = "GFS Simulated 1km AGL Reflectivity"
-        productPath = "gisproducts/gfs/simrefd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 381:
-        productDesc = "GFS Simulated 1km AGL Reflectivity"
-        productPath = "products/gfs/refdcomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 3
-        totalFrameCount = 129
-    elif productID == 500:
-        productDesc = "NAM Surface Temperature"
-        productPath = "gisproducts/nam/sfcT/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 501:
-        productDesc = "NAM Surface Winds"
-        productPath = "gisproducts/nam/sfcWnd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 502:
-        productDesc = "NAM Surface MSLP"
-        productPath = "gisproducts/nam/sfcMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 503:
-        productDesc = "NAM Surface Temperature, Winds, MSLP"
-        productPath = "products/nam/sfcTWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 504:
-        productDesc = "NAM Surface Dew Point"
-        productPath = "gisproducts/nam/sfcTd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 505:
-        productDesc = "NAM Surface Dew Point, Winds, MSLP"
-        productPath = "products/nam/sfcTdWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 508:
-        productDesc = "NAM Simulated Composite Reflectivity"
-        productPath = "gisproducts/nam/simrefc/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 509:
-        productDesc = "NAM 1hr Max Updraft Helicity"
-        productPath = "gisproducts/nam/udhelicity/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 510:
-        productDesc = "NAM Simulated Composite Reflectivity"
-        productPath = "products/nam/refccomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 516:
-        productDesc = "NAM 500 hPa Winds"
-        productPath = "gisproducts/nam/500wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 518:
-        productDesc = "NAM 500 hPa Heights"
-        productPath = "gisproducts/nam/500hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 520:
-        productDesc = "NAM 500 hPa Heights, Winds, Vorticity"
-        productPath = "products/nam/500staticvort/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 521:
-        productDesc = "NAM 250 hPa Winds"
-        productPath = "gisproducts/nam/250wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 522:
-        productDesc = "NAM 250 hPa Heights"
-        productPath = "gisproducts/nam/250hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 524:
-        productDesc = "NAM 250 hPa Heights, Winds, Isotachs"
-        productPath = "products/nam/250staticjet/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 525:
-        productDesc = "NAM 850 hPa Winds"
-        productPath = "gisproducts/nam/850wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 526:
-        productDesc = "NAM 850 hPa Heights"
-        productPath = "gisproducts/nam/850hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 527:
-        productDesc = "NAM 850 hPa Temperatures"
-        productPath = "gisproducts/nam/850temps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 528:
-        productDesc = "NAM 850 hPa Heights, Winds, Temperatures"
-        productPath = "products/nam/850statictemps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 529:
-        productDesc = "NAM 700 hPa Relative Humidity"
-        productPath = "gisproducts/nam/700rh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 531:
-        productDesc = "NAM 700 hPa Relative Humidity, MSLP, 1000->500 hPa Thickness"
-        productPath = "products/nam/700staticrh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 532:
-        productDesc = "NAM 4-panel"
-        productPath = "products/nam/4pnl/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 580:
-        productDesc = "NAM Simulated 1km AGL Reflectivity"
-        productPath = "gisproducts/nam/simrefd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 581:
-        productDesc = "NAM Simulated 1km AGL Reflectivity"
-        productPath = "products/nam/refdcomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 5
-        totalFrameCount = 53
-    elif productID == 600:
-        productDesc = "NAM NEST Surface Temperature"
-        productPath = "gisproducts/namnest/sfcT/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 601:
-        productDesc = "NAM NEST Surface Winds"
-        productPath = "gisproducts/namnest/sfcWnd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 602:
-        productDesc = "NAM NEST Surface MSLP"
-        productPath = "gisproducts/namnest/sfcMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 603:
-        productDesc = "NAM NEST Surface Temperature, Winds, MSLP"
-        productPath = "products/namnest/sfcTWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 604:
-        productDesc = "NAM NEST Surface Dew Point"
-        productPath = "gisproducts/namnest/sfcTd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 605:
-        productDesc = "NAM NEST Surface Dew Point, Winds, MSLP"
-        productPath = "products/namnest/sfcTdWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 608:
-        productDesc = "NAM NEST Simulated Composite Reflectivity"
-        productPath = "gisproducts/namnest/simrefc/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 609:
-        productDesc = "NAM NEST 1hr Max Updraft Helicity"
-        productPath = "gisproducts/namnest/udhelicity/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 610:
-        productDesc = "NAM NEST Simulated Composite Reflectivity"
-        productPath = "products/namnest/refccomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 616:
-        productDesc = "NAM NEST 500 hPa Winds"
-        productPath = "gisproducts/namnest/500wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 618:
-        productDesc = "NAM NEST 500 hPa Heights"
-        productPath = "gisproducts/namnest/500hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 620:
-        productDesc = "NAM NEST 500 hPa Heights, Winds, Vorticity"
-        productPath = "products/namnest/500staticvort/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 621:
-        productDesc = "NAM NEST 250 hPa Winds"
-        productPath = "gisproducts/namnest/250wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 622:
-        productDesc = "NAM NEST 250 hPa Heights"
-        productPath = "gisproducts/namnest/250hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 624:
-        productDesc = "NAM NEST 250 hPa Heights, Winds, Isotachs"
-        productPath = "products/namnest/250staticjet/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 625:
-        productDesc = "NAM NEST 850 hPa Winds"
-        productPath = "gisproducts/namnest/850wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 626:
-        productDesc = "NAM NEST 850 hPa Heights"
-        productPath = "gisproducts/namnest/850hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 627:
-        productDesc = "NAM NEST 850 hPa Temperatures"
-        productPath = "gisproducts/namnest/850temps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 628:
-        productDesc = "NAM NEST 850 hPa Heights, Winds, Temperatures"
-        productPath = "products/namnest/850statictemps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 629:
-        productDesc = "NAM NEST 700 hPa Relative Humidity"
-        productPath = "gisproducts/namnest/700rh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 631:
-        productDesc = "NAM NEST 700 hPa Relative Humidity, MSLP, 1000->500 hPa Thickness"
-        productPath = "products/namnest/700staticrh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 632:
-        productDesc = "NAM NEST 4-panel"
-        productPath = "products/namnest/4pnl/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 680:
-        productDesc = "NAM NEST Simulated 1km AGL Reflectivity"
-        productPath = "gisproducts/namnest/simrefd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 681:
-        productDesc = "NAM NEST Simulated 1km AGL Reflectivity"
-        productPath = "products/namnest/refdcomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 6
-        totalFrameCount = 61
-    elif productID == 800:
-        productDesc = "HRRR Surface Temperature"
-        productPath = "gisproducts/hrrr/sfcT/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 801:
-        productDesc = "HRRR Surface Winds"
-        productPath = "gisproducts/hrrr/sfcWnd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 802:
-        productDesc = "HRRR Surface MSLP"
-        productPath = "gisproducts/hrrr/sfcMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 803:
-        productDesc = "HRRR Surface Temperature, Winds, MSLP"
-        productPath = "products/hrrr/sfcTWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 804:
-        productDesc = "HRRR Surface Dew Point"
-        productPath = "gisproducts/hrrr/sfcTd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 805:
-        productDesc = "HRRR Surface Dew Point, Winds, MSLP"
-        productPath = "products/hrrr/sfcTdWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 808:
-        productDesc = "HRRR Simulated Composite Reflectivity"
-        productPath = "gisproducts/hrrr/simrefc/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 809:
-        productDesc = "HRRR 1hr Max Updraft Helicity"
-        productPath = "gisproducts/hrrr/udhelicity/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 810:
-        productDesc = "HRRR Simulated Composite Reflectivity"
-        productPath = "products/hrrr/refccomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 816:
-        productDesc = "HRRR 500 hPa Winds"
-        productPath = "gisproducts/hrrr/500wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 818:
-        productDesc = "HRRR 500 hPa Heights"
-        productPath = "gisproducts/hrrr/500hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 820:
-        productDesc = "HRRR 500 hPa Heights, Winds, Vorticity"
-        productPath = "products/hrrr/500staticvort/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 821:
-        productDesc = "HRRR 250 hPa Winds"
-        productPath = "gisproducts/hrrr/250wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 824:
-        productDesc = "HRRR 250 hPa Winds, Isotachs"
-        productPath = "products/hrrr/250staticjet/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 825:
-        productDesc = "HRRR 850 hPa Winds"
-        productPath = "gisproducts/hrrr/850wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 826:
-        productDesc = "HRRR 850 hPa Heights"
-        productPath = "gisproducts/hrrr/850hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 827:
-        productDesc = "HRRR 850 hPa Temperatures"
-        productPath = "gisproducts/hrrr/850temps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 828:
-        productDesc = "HRRR 850 hPa Heights, Winds, Temperatures"
-        productPath = "products/hrrr/850statictemps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 829:
-        productDesc = "HRRR 700 hPa Relative Humidity"
-        productPath = "gisproducts/hrrr/700rh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 831:
-        productDesc = "HRRR 700 hPa Relative Humidity, MSLP, 1000->500 hPa Thickness"
-        productPath = "products/hrrr/700staticrh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 832:
-        productDesc = "HRRR 4-panel"
-        productPath = "products/hrrr/4pnl/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 880:
-        productDesc = "HRRR Simulated 1km AGL Reflectivity"
-        productPath = "gisproducts/hrrr/simrefd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 881:
-        productDesc = "HRRR Simulated 1km AGL Reflectivity"
-        productPath = "products/hrrr/refdcomposite/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 8
-        if runTime.hour in [0, 6, 12, 18]:
-            totalFrameCount = 49
-        else:
-            totalFrameCount = 19
-    elif productID == 1000:
-        productDesc = "ECMWF-HRES Surface Temperature"
-        productPath = "gisproducts/ecmwf-hres/sfcT/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1001:
-        productDesc = "ECMWF-HRES Surface Winds"
-        productPath = "gisproducts/ecmwf-hres/sfcWnd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1002:
-        productDesc = "ECMWF-HRES Surface MSLP"
-        productPath = "gisproducts/ecmwf-hres/sfcMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1003:
-        productDesc = "ECMWF-HRES Surface Temperature, Winds, MSLP"
-        productPath = "products/ecmwf-hres/sfcTWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1004:
-        productDesc = "ECMWF-HRES Surface Dew Point"
-        productPath = "gisproducts/ecmwf-hres/sfcTd/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1005:
-        productDesc = "ECMWF-HRES Surface Dew Point, Winds, MSLP"
-        productPath = "products/ecmwf-hres/sfcTdWndMSLP/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1016:
-        productDesc = "ECMWF-HRES 500 hPa Winds"
-        productPath = "gisproducts/ecmwf-hres/500wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1018:
-        productDesc = "ECMWF-HRES 500 hPa Heights"
-        productPath = "gisproducts/ecmwf-hres/500hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1020:
-        productDesc = "ECMWF-HRES 500 hPa Heights, Winds, Vorticity"
-        productPath = "products/ecmwf-hres/500staticvort/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1021:
-        productDesc = "ECMWF-HRES 250 hPa Winds"
-        productPath = "gisproducts/ecmwf-hres/250wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1022:
-        productDesc = "ECMWF-HRES 250 hPa Heights"
-        productPath = "gisproducts/ecmwf-hres/250hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1024:
-        productDesc = "ECMWF-HRES 250 hPa Heights, Winds, Isotachs"
-        productPath = "products/ecmwf-hres/250staticjet/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1025:
-        productDesc = "ECMWF-HRES 850 hPa Winds"
-        productPath = "gisproducts/ecmwf-hres/850wind/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1026:
-        productDesc = "ECMWF-HRES 850 hPa Heights"
-        productPath = "gisproducts/ecmwf-hres/850hgt/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1027:
-        productDesc = "ECMWF-HRES 850 hPa Temperature"
-        productPath = "gisproducts/ecmwf-hres/850temps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1028:
-        productDesc = "ECMWF-HRES 850 hPa Heights, Winds, Temperatures"
-        productPath = "products/ecmwf-hres/850statictemps/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1029:
-        productDesc = "ECMWF-HRES 700 hPa Relative Humidity"
-        productPath = "gisproducts/ecmwf-hres/700rh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1031:
-        productDesc = "ECMWF-HRES 700 hPa Relative Humidity, MSLP, 1000->500 hPa Thickness"
-        productPath = "products/ecmwf-hres/700staticrh/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1032:
-        productDesc = "ECMWF-HRES 4-panel"
-        productPath = "products/ecmwf-hres/4pnl/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 10
-        if runTime.hour in [0, 12]:
-            totalFrameCount = 61
-        else:
-            totalFrameCount = 31
-    elif productID == 1200:
-        productDesc = "WPC Surface Analysis"
-        productPath = "gisproducts/noaa/wpcsfcbull/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 1
-        productTypeID = 12
-        totalFrameCount = 1
-    elif productID == 1201:
-        productDesc = "WPC Surface Analysis"
-        productPath = "products/noaa/wpcsfcbull/"
-        isFcst = False
-        fileExt = "png"
-        dispFrames = 1
-        productTypeID = 12
-        totalFrameCount = 1
-    elif productID == 1203:
-        productDesc = "SPC Categorical Convective Outlook"
-        productPath = "products/noaa/spc/catout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 3
-    elif productID == 1205:
-        productDesc = "SPC Long-Range Convective Outlook"
-        productPath = "products/noaa/spc/LRout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 8
-    elif productID == 1207:
-        productDesc = "SPC Probabilistic Convective Outlook D3-D8"
-        productPath = "products/noaa/spc/probout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 5
-    elif productID == 1209:
-        productDesc = "SPC Hail Outlook"
-        productPath = "products/noaa/spc/hailout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 2
-    elif productID == 1211:
-        productDesc = "SPC Wind Outlook"
-        productPath = "products/noaa/spc/windout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 2
-    elif productID == 1213:
-        productDesc = "SPC Tornado Outlook"
-        productPath = "products/noaa/spc/tornout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 2
-    elif productID == 1215:
-        productDesc = "SPC Fire Weather Outlook"
-        productPath = "products/noaa/spc/fireout/"
-        isFcst = True
-        fileExt = "png"
-        dispFrames = 0
-        productTypeID = 12
-        totalFrameCount = 8
-    if isFcst:
+    product = getProduct(productID)
+    if product.isForecast:
         fHour = validTime - runTime
         fHour = int(fHour.total_seconds() / 3600)
     else:
@@ -1453,131 +1049,95 @@ def writeJson(basePath, productID, runTime, fileName, validTime, gisInfo, reload
     
     productDict = {
         "productID" : productID,
-        "productDescription" : productDesc,
-        "productPath" : productPath,
+        "productDescription" : product.productDescription,
+        "productPath" : product.productPath,
         "productReloadTime" : reloadInterval,
         "lastReloadTime" : publishTime.strftime("%Y%m%d%H%M"),
-        "isForecast" : isFcst,
+        "isForecast" : product.isForecast,
         "isGIS" : isGIS,
-        "fileExtension" : fileExt,
-        "displayFrames" : dispFrames
+        "fileExtension" : product.fileExtension,
+        "displayFrames" : product.displayFrames
     }
-    productDictJsonPath = path.join(basePath, "output", "metadata", str(productID)+".json")
-    Path(path.dirname(productDictJsonPath)).mkdir(parents=True, exist_ok=True)
-    with atomic_write(productDictJsonPath, overwrite=True) as jsonWrite:
-        json.dump(productDict, jsonWrite, indent=4)
-    chmod(productDictJsonPath, 0o644)
-
-    productRunDictPath = path.join(basePath, "output", "metadata", "products", str(productID), runTime.strftime("%Y%m%d%H00")+".json")
-    productRunLockPath = path.join(basePath, "output", "metadata", "products", str(productID), runTime.strftime("%Y%m%d%H00")+".lock")
-    Path(path.dirname(productRunDictPath)).mkdir(parents=True, exist_ok=True)
-    while path.exists(productRunLockPath):
-        if dt.utcnow() - timedelta(minutes=2) > publishTime:
-            break
-    try:
-        lockFile = open(productRunLockPath, "x")
-        lockFile.close()
-        if path.exists(productRunDictPath):
-            with open(productRunDictPath, "r") as jsonRead:
-                oldData = json.load(jsonRead)
-            # Add previously generated frames to a list, framesArray
-            framesArray = oldData["productFrames"]
-        else:
-            # If that file didn't exist, then create an empty list instead
-            framesArray = list()
-        frmDict = {
-                "fhour" : fHour,
-                "filename" : fileName,
-                "gisInfo" : gisInfo,
-                "valid" : validTime.strftime("%Y%m%d%H%M"),
-                "publishTime" : publishTime.strftime("%Y%m%d%H%M")
-        }
-        for frame in framesArray:
-            if frame["filename"] == frmDict["filename"]:
-                framesArray.remove(frame)
-        framesArray.append(frmDict)
-        if totalFrameCount == -1:
-            totalFrameCount = len(framesArray)
-        productRunDict = {
-            "publishTime" : publishTime.strftime("%Y%m%d%H%M"),
-            "pathExtension" : runPathExtension,
-            "runName" : runTime.strftime("%d %b %Y %HZ"),
-            "availableFrameCount" : len(framesArray),
-            "totalFrameCount" : totalFrameCount,
-            "productFrames" : sorted(framesArray, key=lambda dict: int(dict["valid"])) # productFramesArray, sorted by increasing valid Time
-        }
-        with atomic_write(productRunDictPath, overwrite=True) as jsonWrite:
-            json.dump(productRunDict, jsonWrite, indent=4)
-        chmod(productRunDictPath, 0o644)
-        remove(productRunLockPath)
-    except Exception as e:
-        remove(productRunLockPath)
-        raise e
-    
-    if productTypeID == 0:
-        productTypeDesc = "Radar & Satellite"
-    elif productTypeID == 1:
-        productTypeDesc = "TAMU Observations"
-    elif productTypeID == 3:
-        productTypeDesc = "GFS"
-    elif productTypeID == 5:
-        productTypeDesc = "NAM"
-    elif productTypeID == 6:
-        productTypeDesc = "NAM NEST"
-    elif productTypeID == 8:
-        productTypeDesc = "HRRR"
-    elif productTypeID == 10:
-        productTypeDesc = "ECMWF-HRES"
-    elif productTypeID == 12:
-        productTypeDesc = "NOAA"
-    productTypeDictPath = path.join(basePath, "output", "metadata", "productTypes", str(productTypeID)+".json")
-    Path(path.dirname(productTypeDictPath)).mkdir(parents=True, exist_ok=True)
-    productsInType = list()
-    if path.exists(productTypeDictPath):
-        with open(productTypeDictPath, "r") as jsonRead:
-            oldProductTypeDict = json.load(jsonRead)
-        for productInOldDict in oldProductTypeDict["products"]:
-            if productInOldDict["productID"] != productID:
-                productsInType.append(productInOldDict)
-    productsInType.append(productDict)
-    productTypeDict = {
-        "productTypeID" : productTypeID,
-        "productTypeDescription" : productTypeDesc,
-        "products" : natsorted(productsInType, key=lambda dict: dict["productID"])
+    frmDict = {
+        "fhour" : fHour,
+        "filename" : fileName,
+        "gisInfo" : gisInfo,
+        "valid" : validTime.strftime("%Y%m%d%H%M"),
+        "publishTime" : publishTime.strftime("%Y%m%d%H%M")
     }
-    with atomic_write(productTypeDictPath, overwrite=True) as jsonWrite:
-        json.dump(productTypeDict, jsonWrite, indent=4)
-    chmod(productTypeDictPath, 0o644)
+    journalEntry = {
+        "pathExtension" : product.pathExtensionForRun(runTime),
+        "runName" : runTime.strftime("%d %b %Y %HZ"),
+        "totalFrameCount" : product.totalFrameCountForRun(runTime),
+        "frame" : frmDict
+    }
+    if publishManifestsEnabled:
+        # Hashed now, while the frame's image is known to be final
+        journalEntry["image"] = fileDigest(path.join(basePath, "output", product.productPath, journalEntry["pathExtension"], fileName))
+    if _batchState["depth"] > 0:
+        _batchState["frames"].append((basePath, productDict, runTime, journalEntry))
+    else:
+        _flushFrames([(basePath, productDict, runTime, journalEntry)])
+    # A forecast's valid time is in the future, so its latency is measured from when its run was initialized
+    dataTime = runTime if product.isForecast else validTime
+    if dataTime.tzinfo is not None:
+        dataTime = dataTime.astimezone(timezone.utc).replace(tzinfo=None)
+    _recordPublishLatency(basePath, productID, (publishTime - dataTime).total_seconds())
 
-def dressImage(fig, ax, title, validTime, fhour=None, notice=None, plotHandle=None, cbticks=None, tickhighlight=None, cbextend="neither", colorbarLabel=None, width=1920, height=1080, tax=None, lax=None):
-    """
-    Adds standardized HDWX branding to a figure 
-    Parameters:
-    ----------
-    fig: the figure to be modified
-    ax: the primary axes of the figure
-    title: the title of the product
-    validTime: the time the product is valid for
-    fhour: the forecast hour of the model product
-    notice: Copyright/disclaimer text
-    plotHandle: the handle to the plot object that will be used to create the colorbar
-    cbticks: the tick values for the colorbar
-    tickhighlight: the tick values to be highlighted
-    cbextend: whether or not to extend the colorbar, "min", "max", "both", or "neither"
-    colorbarLabel: the label for the colorbar
-    width: the width of the figure in pixels
-    height: the height of the figure in pixels
-    tax: the title axes, will create if not provided
-    lax: the logo axes, will create if not provided
-    
-    """
+# Decoded branding images, loaded once per process. The logo is kept at most logoMasterWidth pixels wide, and resampled once for every pixel size it's drawn at.
+logoMasterWidth = 2048
+_brandingAssets = {"logoPath" : None, "logo" : None, "logoSizes" : dict()}
+
+
+def _atmoLogoPath():
+    # The logo lives in the top level of the hdwx-operational clone, one directory above the submodule's copy of this file
+    candidatePaths = [path.join(path.abspath(path.dirname(path.dirname(__file__))), "atmoLogo.png"), path.join(path.abspath(path.dirname(__file__)), "atmoLogo.png")]
+    return next((candidate for candidate in candidatePaths if path.exists(candidate)), path.join('assets', 'atmoLogo.png'))
+
+
+def _logoAtSize(logoSize):
+    # Returns the logo as a uint8 RGBA array of exactly logoSize (width, height) pixels, or None if there's no logo
+    if _brandingAssets["logo"] is None:
+        atmoLogoPath = _atmoLogoPath()
+        if not path.exists(atmoLogoPath):
+            return None
+        from PIL import Image
+        with Image.open(atmoLogoPath) as logoFile:
+            logoImage = logoFile.convert("RGBA")
+        if logoImage.width > logoMasterWidth:
+            logoImage = logoImage.resize((logoMasterWidth, round(logoImage.height*logoMasterWidth/logoImage.width)), Image.LANCZOS)
+        _brandingAssets["logoPath"] = atmoLogoPath
+        _brandingAssets["logo"] = logoImage
+    if logoSize not in _brandingAssets["logoSizes"].keys():
+        import numpy as np
+        from PIL import Image
+        _brandingAssets["logoSizes"][logoSize] = np.asarray(_brandingAssets["logo"].resize(logoSize, Image.LANCZOS))
+    return _brandingAssets["logoSizes"][logoSize]
+
+
+def _titleString(title, validTime, fhour):
+    if fhour is None:
+        return title+"\n Valid "+validTime.strftime("%a %-d %b %Y %H%MZ")
+    else:
+        return title+"\n"+"f"+str(fhour)+" Valid "+validTime.strftime("%a %-d %b %Y %H%MZ")
+
+
+def _brandingNotice(title, validTime, notice):
+    if notice is None:
+        if "ecmwf" in title.lower():
+            notice = "Copyright © "+validTime.strftime("%Y")+" European Centre for Medium-Range Weather Forecasts (ECMWF)\nhttps://www.ecmwf.int/"
+    return notice
+
+
+def _brandLayout(fig, ax, titleStr, notice, plotHandle, cbticks, tickhighlight, cbextend, colorbarLabel, width, height, tax, lax):
+    # Adds the colorbar, title, and logo axes to a figure and lays out ax around them, returns the axes and title text it added
     from matplotlib import pyplot as plt
-    from matplotlib import image as mpimg
     px = 1/plt.rcParams["figure.dpi"]
     fig.set_size_inches(width*px, height*px)
     heightOfBottomBar = 100/height
     insetDistance = 75/width
     widthOfObjects = 500/width
+    cbax = None
     if plotHandle is not None:
         cbax = fig.add_axes([insetDistance, insetDistance+(10/height), widthOfObjects, .02])
         if cbticks is None:
@@ -1598,14 +1158,7 @@ def dressImage(fig, ax, title, validTime, fhour=None, notice=None, plotHandle=No
             cbax.set_xlabel(colorbarLabel)
     if tax is None:
         tax = fig.add_axes([0.5-(widthOfObjects/2), insetDistance, widthOfObjects, heightOfBottomBar])
-    if fhour is None:
-        titleStr = title+"\n Valid "+validTime.strftime("%a %-d %b %Y %H%MZ")
-    else:
-        titleStr = title+"\n"+"f"+str(fhour)+" Valid "+validTime.strftime("%a %-d %b %Y %H%MZ")
-    tax.text(0.5, 0.3, titleStr, horizontalalignment="center", verticalalignment="center", fontsize=16)
-    if notice is None:
-        if "ecmwf" in title.lower():
-            notice = "Copyright © "+validTime.strftime("%Y")+" European Centre for Medium-Range Weather Forecasts (ECMWF)\nhttps://www.ecmwf.int/"
+    titleText = tax.text(0.5, 0.3, titleStr, horizontalalignment="center", verticalalignment="center", fontsize=16)
     if notice is not None:
         tax.set_xlabel(notice)
     tax.set_facecolor("#00000000")
@@ -1618,22 +1171,390 @@ def dressImage(fig, ax, title, validTime, fhour=None, notice=None, plotHandle=No
     lax.axis("off")
     lax.set_position([(1-(lax.get_position().width+insetDistance)), (lax.get_position().y0), (lax.get_position().width), (lax.get_position().height)])
     plt.setp(lax.spines.values(), visible=False)
-    atmoLogoPath = path.join(path.abspath(path.dirname(path.dirname(__file__))), "atmoLogo.png")
-    if not path.exists(atmoLogoPath):
-        atmoLogoPath = path.join('assets', 'atmoLogo.png')
-    if path.exists(atmoLogoPath):
-        atmoLogo = mpimg.imread(atmoLogoPath)
-        lax.imshow(atmoLogo)
+    # The logo is drawn pre-resampled to the pixels it will cover, so rendering it is just a copy. The extent keeps the axes limits (and layout) of the full-size image.
+    logoAxesWidth, logoAxesHeight = lax.get_position().width*width, lax.get_position().height*height
+    logoAspect = 2821/11071
+    if logoAxesWidth*logoAspect <= logoAxesHeight:
+        logoSize = (max(round(logoAxesWidth), 1), max(round(logoAxesWidth*logoAspect), 1))
+    else:
+        logoSize = (max(round(logoAxesHeight/logoAspect), 1), max(round(logoAxesHeight), 1))
+    atmoLogo = _logoAtSize(logoSize)
+    if atmoLogo is not None:
+        lax.imshow(atmoLogo, extent=(-0.5, 11071-0.5, 2821-0.5, -0.5), interpolation="none")
     if ax is not None:
         ax.set_position([insetDistance, .025+heightOfBottomBar, 1-2*insetDistance, 1-(insetDistance+heightOfBottomBar)])
         ax.set_box_aspect(height/width)
     fig.set_facecolor("white")
+    return {"tax" : tax, "lax" : lax, "cbax" : cbax, "titleText" : titleText}
+
+
+def dressImage(fig, ax, title, validTime, fhour=None, notice=None, plotHandle=None, cbticks=None, tickhighlight=None, cbextend="neither", colorbarLabel=None, width=1920, height=1080, tax=None, lax=None, productID=None):
+    """
+    Adds standardized HDWX branding to a figure 
+    Parameters:
+    ----------
+    fig: the figure to be modified
+    ax: the primary axes of the figure
+    title: the title of the product
+    validTime: the time the product is valid for
+    fhour: the forecast hour of the model product
+    notice: Copyright/disclaimer text
+    plotHandle: the handle to the plot object that will be used to create the colorbar
+    cbticks: the tick values for the colorbar
+    tickhighlight: the tick values to be highlighted
+    cbextend: whether or not to extend the colorbar, "min", "max", "both", or "neither"
+    colorbarLabel: the label for the colorbar
+    width: the width of the figure in pixels
+    height: the height of the figure in pixels
+    tax: the title axes, will create if not provided
+    lax: the logo axes, will create if not provided
+    productID: labels the dressImage timing span, see timingSpan
+    
+    """
+    with timingSpan("dressImage", productID):
+        _brandLayout(fig, ax, _titleString(title, validTime, fhour), _brandingNotice(title, validTime, notice), plotHandle, cbticks, tickhighlight, cbextend, colorbarLabel, width, height, tax, lax)
     return fig
 
-def saveImage(fig, outputPath, transparent=False, bbox_inches=None):
-    gifPath = outputPath.replace(path.basename(outputPath), "gif-"+path.basename(outputPath))
-    fig.savefig(gifPath, format="png", transparent=transparent, bbox_inches=bbox_inches)
+# Pixels are looked up in a palette by their color truncated to this many bits per channel, which bounds each palette's lookup table at 2**(3*bits) entries (512 KB for 6 bits)
+paletteLookupBits = 6
+# A palette built from a product's first frame only has the colors of that frame. When a later frame has colors further than this (RGB distance, 0-441) from all of them,
+# the palette is extended with them, or rebuilt from that frame once it's full, so a sparse first frame (clear air radar) can't lock in a palette of a few colors.
+paletteMaxError = 24
+# Palette and lookup table of every paletteKey used by this process. The lookup table is only filled in for colors that have actually been seen.
+# Entries are replaced rather than changed when a palette grows, so an encoding thread always maps a frame through a lookup table that matches its palette.
+_paletteCache = dict()
+# Held while building a palette, so that encoding threads saving the first frames of a product at the same time all agree on its palette
+_paletteLock = threading.Lock()
+
+
+def _newPalette(paletteColors, adaptive):
+    import numpy as np
+    paletteArray = np.asarray(paletteColors, dtype=np.uint8).reshape(-1, 3)
+    if len(paletteArray) > 256:
+        raise ValueError(f"Palettes can have at most 256 colors, got {len(paletteArray)}")
+    return {"palette" : paletteArray, "lookup" : np.full(1 << (3*paletteLookupBits), -1, dtype=np.int16), "adaptive" : adaptive}
+
+
+def registerPalette(paletteKey, paletteColors):
+    """
+    Sets the palette that saveImage quantizes frames saved with paletteKey to, instead of building one from the frames. A registered palette is used as is, it's never extended.
+    Parameters:
+    ----------
+    paletteKey: any hashable, usually the productID or the name of the product's colormap
+    paletteColors: up to 256 colors, as a flat list [r, g, b, r, g, b, ...] or an (N, 3) array, 0-255
+
+    """
+    _paletteCache[paletteKey] = _newPalette(paletteColors, adaptive=False)
+
+
+def _medianCut(rgbPixels, colorCount):
+    # Median cut keeps the colors that cover the most pixels, so a product's color table comes through almost exactly
+    from PIL import Image
+    return Image.fromarray(rgbPixels.reshape(1, -1, 3)).quantize(colorCount, method=Image.Quantize.MEDIANCUT).getpalette()
+
+
+def _cellColors(cells):
+    # The color at the center of each lookup table cell, as float32 (N, 3)
+    import numpy as np
+    shift = 8 - paletteLookupBits
+    cellMask = (1 << paletteLookupBits) - 1
+    return (np.stack([cells >> (2*paletteLookupBits), (cells >> paletteLookupBits) & cellMask, cells & cellMask], axis=1) << shift).astype(np.float32) + ((1 << shift) - 1) / 2
+
+
+def _nearestColors(cells, palette):
+    # Index of the nearest palette color to each cell, and its distance
+    import numpy as np
+    cellCenters = _cellColors(cells)
+    paletteFloat = palette.astype(np.float32)
+    distances = (paletteFloat ** 2).sum(axis=1)[np.newaxis, :] - 2 * cellCenters @ paletteFloat.T
+    nearest = distances.argmin(axis=1)
+    return nearest, np.sqrt(np.maximum(distances[np.arange(len(cells)), nearest] + (cellCenters ** 2).sum(axis=1), 0))
+
+
+def _mapToPalette(cachedPalette, cellIndices):
+    # Palette index of every pixel, filling in the lookup table for cells not seen before. Returns (indices, the largest distance of a newly seen cell to its color)
+    paletteIndices = cachedPalette["lookup"][cellIndices]
+    unseenPixels = paletteIndices < 0
+    if not unseenPixels.any():
+        return paletteIndices, 0
+    import numpy as np
+    newCells = np.unique(cellIndices[unseenPixels])
+    nearest, nearestDistances = _nearestColors(newCells, cachedPalette["palette"])
+    cachedPalette["lookup"][newCells] = nearest
+    paletteIndices[unseenPixels] = cachedPalette["lookup"][cellIndices[unseenPixels]]
+    return paletteIndices, nearestDistances.max()
+
+
+def _adaptPalette(paletteKey, rgbPixels, cellIndices):
+    # Replaces paletteKey's palette with one that also covers the colors of this frame that are too far from it: the current palette plus a median cut of those colors
+    # if it has room for them, otherwise a median cut of the whole frame. Call with _paletteLock held, returns the new entry.
+    import numpy as np
+    cachedPalette = _paletteCache[paletteKey]
+    palette = cachedPalette["palette"]
+    frameCells, cellPixels = np.unique(cellIndices, return_inverse=True)
+    _, cellDistances = _nearestColors(frameCells, palette)
+    # Another thread may have adapted the palette to a frame like this one already
+    poorPixels = (cellDistances > paletteMaxError)[cellPixels.reshape(-1)]
+    if not poorPixels.any():
+        return cachedPalette
+    freeColors = 256 - len(palette)
+    if freeColors > 0:
+        newColors = np.asarray(_medianCut(rgbPixels.reshape(-1, 3)[poorPixels], freeColors), dtype=np.uint8).reshape(-1, 3)
+        _paletteCache[paletteKey] = _newPalette(np.concatenate([palette, newColors]), adaptive=True)
+    else:
+        _paletteCache[paletteKey] = _newPalette(_medianCut(rgbPixels, 256), adaptive=True)
+    return _paletteCache[paletteKey]
+
+
+def _quantizeToPalette(rgbPixels, paletteKey):
+    # Maps an (height, width, 3) uint8 array to a palette image, through the cached lookup table of paletteKey
+    import numpy as np
+    from PIL import Image
+    with _paletteLock:
+        if paletteKey not in _paletteCache.keys():
+            if paletteKey is None:
+                registerPalette(None, Image.new("RGB", (1, 1)).convert("P", palette=Image.WEB).getpalette())
+            else:
+                _paletteCache[paletteKey] = _newPalette(_medianCut(rgbPixels, 256), adaptive=True)
+        cachedPalette = _paletteCache[paletteKey]
+    shift = 8 - paletteLookupBits
+    cellIndices = ((rgbPixels[..., 0] >> shift).astype(np.int32) << (2*paletteLookupBits)) | ((rgbPixels[..., 1] >> shift).astype(np.int32) << paletteLookupBits) | (rgbPixels[..., 2] >> shift)
+    paletteIndices, newCellDistance = _mapToPalette(cachedPalette, cellIndices)
+    if cachedPalette["adaptive"] and newCellDistance > paletteMaxError:
+        with _paletteLock:
+            cachedPalette = _adaptPalette(paletteKey, rgbPixels, cellIndices)
+        paletteIndices, _ = _mapToPalette(cachedPalette, cellIndices)
+    im = Image.fromarray(paletteIndices.astype(np.uint8), mode="P")
+    im.putpalette(cachedPalette["palette"].ravel().tolist())
+    return im
+
+
+def _renderRGB(fig, transparent, bbox_inches):
+    # Renders a figure to an (height, width, 3) uint8 array
+    from io import BytesIO
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import numpy as np
+    # savefig still handles dpi, facecolor, transparency and bbox_inches, but hands back the Agg canvas's RGBA pixels instead of encoding a PNG that would only be decoded again
+    originalCanvas = fig.canvas
+    aggCanvas = originalCanvas if isinstance(originalCanvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
+    try:
+        rgbaBuffer = BytesIO()
+        fig.savefig(rgbaBuffer, format="rgba", transparent=transparent, bbox_inches=bbox_inches)
+        imageWidth, imageHeight = int(aggCanvas.renderer.width), int(aggCanvas.renderer.height)
+    finally:
+        if fig.canvas is not originalCanvas:
+            fig.set_canvas(originalCanvas)
+    rgbaPixels = np.frombuffer(rgbaBuffer.getvalue(), dtype=np.uint8).reshape(imageHeight, imageWidth, 4)
+    return np.ascontiguousarray(rgbaPixels[..., :3])
+
+
+def _encodeImage(rgbPixels, outputPath, paletteKey, productID=None):
+    # Quantizes, encodes, and atomically writes a rendered frame
+    from io import BytesIO
     from PIL import Image
-    im = Image.open(gifPath)
-    im = im.convert("RGB").convert("P", palette=Image.WEB)
-    im.save(outputPath)
+    with timingSpan("saveImage.quantize", productID):
+        im = _quantizeToPalette(rgbPixels, paletteKey)
+    with timingSpan("saveImage.encode", productID):
+        imageBuffer = BytesIO()
+        im.save(imageBuffer, format=Image.registered_extensions().get(path.splitext(outputPath)[1].lower(), "PNG"))
+    with timingSpan("saveImage.write", productID):
+        atomicWriteBytes(outputPath, imageBuffer.getvalue())
+
+
+# Background encoding for saveImage. With workers > 0, saveImage only renders the figure and hands quantizing, encoding, and writing the image to a pool of threads
+# (numpy, PIL, and zlib release the GIL for most of that), so the next frame can be rendered in the meantime. At most maxPending frames (twice the workers if None) wait in the pool
+# before saveImage blocks. Configured with the HDWX_IMAGE_WORKERS environment variable, or by setting imageEncoding["workers"] before the first saveImage.
+imageEncoding = {
+    "workers" : int(environ.get("HDWX_IMAGE_WORKERS", "0")),
+    "maxPending" : None
+}
+# Frames submitted to the pool, in order, as (future, onWritten)
+_imageEncodingState = {"pid" : None, "pool" : None, "slots" : None, "pending" : list()}
+
+
+def _imageEncodingPool():
+    # The pool is created on first use, and again in forked children, which don't inherit the parent's threads
+    if _imageEncodingState["pid"] != getpid():
+        from concurrent.futures import ThreadPoolExecutor
+        _imageEncodingState["pool"] = ThreadPoolExecutor(max_workers=imageEncoding["workers"], thread_name_prefix="saveImage")
+        _imageEncodingState["slots"] = threading.BoundedSemaphore(imageEncoding["maxPending"] if imageEncoding["maxPending"] is not None else max(2 * imageEncoding["workers"], 1))
+        _imageEncodingState["pending"] = list()
+        _imageEncodingState["pid"] = getpid()
+    return _imageEncodingState["pool"]
+
+
+def _runImageHooks(wait):
+    # Runs the onWritten hook of every frame that's finished writing, in the order the frames were saved, on the calling thread.
+    # Stops at the first frame that isn't done unless wait is True. An encoding error is raised here, and that frame's hook is never run.
+    pendingImages = _imageEncodingState["pending"]
+    while len(pendingImages) > 0 and (wait or pendingImages[0][0].done()):
+        encodeFuture, onWritten = pendingImages.pop(0)
+        encodeFuture.result()
+        if onWritten is not None:
+            onWritten()
+
+
+def flushImages():
+    """
+    Waits for every frame saveImage handed to the background encoding pool to be written, and runs their onWritten hooks. Raises the first encoding error, if any.
+    Registered to run at exit.
+    """
+    if _imageEncodingState["pid"] == getpid():
+        _runImageHooks(wait=True)
+
+
+atexit.register(flushImages)
+
+
+def saveImage(fig, outputPath, transparent=False, bbox_inches=None, paletteKey=None, onWritten=None, productID=None):
+    """
+    Renders a figure and atomically writes it to outputPath as a palette image, to keep frames small
+    Parameters:
+    ----------
+    fig: the figure to save
+    outputPath: where to write the image, its format is picked from the extension
+    transparent: passed to savefig
+    bbox_inches: passed to savefig
+    paletteKey: frames saved with the same paletteKey share a palette, built from the first of them and extended with colors later frames add (or set with registerPalette). Usually the productID.
+        If None, the 216 color web palette is used.
+    onWritten: called with no arguments once the image is on disk, for example lambda: writeJson(...) so the frame is only published once its image exists.
+        With background encoding, hooks run on the plotting thread during a later saveImage or flushImages call, in the order the frames were saved.
+    productID: labels this frame's timing spans, see timingSpan
+
+    """
+    with timingSpan("saveImage.render", productID):
+        rgbPixels = _renderRGB(fig, transparent, bbox_inches)
+    _writeRendered(rgbPixels, outputPath, paletteKey, onWritten, productID)
+
+
+def _writeRendered(rgbPixels, outputPath, paletteKey, onWritten, productID=None):
+    # Encodes and writes a rendered frame, on this thread or in the background encoding pool
+    if imageEncoding["workers"] <= 0:
+        _encodeImage(rgbPixels, outputPath, paletteKey, productID)
+        if onWritten is not None:
+            onWritten()
+        return
+    encodePool = _imageEncodingPool()
+    _runImageHooks(wait=False)
+    _imageEncodingState["slots"].acquire()
+    try:
+        encodeFuture = encodePool.submit(_encodeImage, rgbPixels, outputPath, paletteKey, productID)
+    except BaseException:
+        _imageEncodingState["slots"].release()
+        raise
+    encodeFuture.add_done_callback(lambda doneFuture: _imageEncodingState["slots"].release())
+    _imageEncodingState["pending"].append((encodeFuture, onWritten))
+
+# Branding templates, by figure. A template's background is everything but the data and title, rendered once, so each frame only draws its own artists over a copy of it.
+_brandingTemplates = weakref.WeakKeyDictionary()
+
+
+def _colorbarConfig(plotHandle):
+    # What about a plot handle changes how its colorbar looks
+    if plotHandle is None:
+        return None
+    norm = plotHandle.norm
+    return (plotHandle.get_cmap().name, type(norm).__name__, norm.vmin, norm.vmax, tuple(getattr(norm, "boundaries", None) if getattr(norm, "boundaries", None) is not None else ()))
+
+
+def _captureTemplateBackground(template):
+    # Renders the figure without its animated (per frame) artists, and keeps a copy of the pixels
+    fig = template["fig"]
+    fig.canvas.draw()
+    template["background"] = fig.canvas.copy_from_bbox(fig.bbox)
+    template["canvasSize"] = fig.canvas.get_width_height()
+
+
+def brandingTemplate(fig, ax, plotHandle=None, cbticks=None, tickhighlight=None, cbextend="neither", colorbarLabel=None, notice=None, width=1920, height=1080, staticKey=None):
+    """
+    Brands a figure like dressImage, but only once, for products that draw many frames on the same figure. Returns the figure's template, for saveTemplateFrame.
+    The template is rebuilt if called again with a different size, colorbar, notice, or staticKey, and reused otherwise.
+    Everything on the figure except the artists passed to saveTemplateFrame (map features, gridlines, colorbar, logo) is rendered once, so it must not change between frames.
+    Parameters:
+    ----------
+    fig: the figure to be modified, it's switched to the Agg canvas if it isn't on it already
+    ax: the primary axes of the figure
+    plotHandle: the handle to the plot object that will be used to create the colorbar
+    cbticks: the tick values for the colorbar
+    tickhighlight: the tick values to be highlighted
+    cbextend: whether or not to extend the colorbar, "min", "max", "both", or "neither"
+    colorbarLabel: the label for the colorbar
+    notice: Copyright/disclaimer text, unlike dressImage the ECMWF notice isn't added from the title
+    width: the width of the figure in pixels
+    height: the height of the figure in pixels
+    staticKey: any hashable describing the rest of the figure's static content (a radar site, a map extent), changing it re-renders the background
+
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    templateKey = (width, height, _colorbarConfig(plotHandle), None if cbticks is None else tuple(cbticks), tickhighlight is not None, cbextend, colorbarLabel, notice, staticKey)
+    template = _brandingTemplates.get(fig)
+    if template is not None and template["key"] == templateKey and template["ax"] is ax:
+        return template
+    if template is not None:
+        # Undo the previous layout, so the rebuilt one is laid out the same as the first
+        [fig.delaxes(brandingAx) for brandingAx in template["addedAxes"]]
+        [overlayArtist.set_animated(False) for overlayArtist in template["overlayArtists"]]
+        template["ax"].set_position(template["axPosition"])
+        template["ax"].set_box_aspect(template["axBoxAspect"])
+        axPosition, axBoxAspect = template["axPosition"], template["axBoxAspect"]
+    else:
+        axPosition, axBoxAspect = ax.get_position(original=True), ax.get_box_aspect()
+    if not isinstance(fig.canvas, FigureCanvasAgg):
+        FigureCanvasAgg(fig)
+    if plotHandle is not None:
+        plotHandle.set_animated(True)
+    existingAxes = list(fig.axes)
+    brandingArtists = _brandLayout(fig, ax, "", notice, plotHandle, cbticks, tickhighlight, cbextend, colorbarLabel, width, height, None, None)
+    brandingArtists["titleText"].set_animated(True)
+    template = {"key" : templateKey, "fig" : fig, "ax" : ax, "titleText" : brandingArtists["titleText"], "addedAxes" : [brandingAx for brandingAx in fig.axes if brandingAx not in existingAxes],
+                "axPosition" : axPosition, "axBoxAspect" : axBoxAspect, "overlayArtists" : list(), "background" : None, "canvasSize" : None}
+    _captureTemplateBackground(template)
+    _brandingTemplates[fig] = template
+    return template
+
+
+def _renderTemplateFrame(template, titleStr, dataArtists):
+    # Draws a frame's artists and title over the template's background, returns the (height, width, 3) uint8 pixels
+    import numpy as np
+    fig = template["fig"]
+    if fig.canvas.get_width_height() != template["canvasSize"]:
+        _captureTemplateBackground(template)
+    [dataArtist.set_animated(True) for dataArtist in dataArtists]
+    # Static artists that belong above the data (coastlines, borders, spines) are left out of the background and drawn on top of the data every frame instead
+    lowestDataZorder = min([dataArtist.get_zorder() for dataArtist in dataArtists], default=None)
+    dataAxes = list(dict.fromkeys([dataArtist.axes for dataArtist in dataArtists if dataArtist.axes is not None]))
+    overlayArtists = [child for dataAx in dataAxes for child in dataAx.get_children() if child.get_visible() and child not in dataArtists and child is not dataAx.patch and child.get_zorder() > lowestDataZorder
+                        and (not child.get_animated() or child in template["overlayArtists"])]
+    if overlayArtists != template["overlayArtists"]:
+        [overlayArtist.set_animated(False) for overlayArtist in template["overlayArtists"]]
+        [overlayArtist.set_animated(True) for overlayArtist in overlayArtists]
+        template["overlayArtists"] = overlayArtists
+        _captureTemplateBackground(template)
+    fig.canvas.restore_region(template["background"])
+    for dataAx in dataAxes:
+        [fig.draw_artist(artist) for artist in sorted([artist for artist in dataArtists + overlayArtists if artist.axes is dataAx], key=lambda artist: artist.get_zorder())]
+    [fig.draw_artist(dataArtist) for dataArtist in dataArtists if dataArtist.axes is None]
+    template["titleText"].set_text(titleStr)
+    fig.draw_artist(template["titleText"])
+    return np.ascontiguousarray(np.asarray(fig.canvas.buffer_rgba())[..., :3])
+
+
+def saveTemplateFrame(template, outputPath, title, validTime, dataArtists, fhour=None, paletteKey=None, onWritten=None, productID=None):
+    """
+    Saves one frame of a branded template like saveImage, redrawing only its data artists and title
+    Parameters:
+    ----------
+    template: returned by brandingTemplate
+    outputPath: where to write the image, its format is picked from the extension
+    title: the title of the product
+    validTime: the time the product is valid for
+    dataArtists: the artists that make up this frame (the pcolormesh, contours, scatter...), they're marked animated so that they're left out of the template's background
+    fhour: the forecast hour of the model product
+    paletteKey: passed to saveImage
+    onWritten: passed to saveImage
+    productID: passed to saveImage
+
+    """
+    with timingSpan("saveTemplateFrame.render", productID):
+        rgbPixels = _renderTemplateFrame(template, _titleString(title, validTime, fhour), dataArtists)
+    _writeRendered(rgbPixels, outputPath, paletteKey, onWritten, productID)
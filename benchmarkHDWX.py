@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+# Benchmarks for the HDWX_helpers hot paths
+# Created 18 October 2026 by Sam Gardner <stgardner4@tamu.edu>
+
+from datetime import datetime as dt, timedelta
+from os import path, environ, cpu_count
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import json
+import sys
+import time
+
+import HDWX_helpers
+
+# Filesystem operations observed through audit hooks (stat and fsync aren't audited, so this undercounts actual syscalls, but equally for every mode)
+_fileOperationEvents = {"open", "os.rename", "os.replace", "os.remove", "os.chmod", "os.mkdir", "os.listdir", "os.scandir", "os.truncate", "fcntl.flock", "os.rmdir", "os.utime"}
+_fileOperationCounts = {"counting" : False, "counts" : dict()}
+
+
+def _countFileOperations(event, args):
+    if _fileOperationCounts["counting"] and event in _fileOperationEvents:
+        _fileOperationCounts["counts"][event] = _fileOperationCounts["counts"].get(event, 0) + 1
+
+
+sys.addaudithook(_countFileOperations)
+
+
+def _measure(function, *args):
+    # Returns (wall seconds, dict of file operation counts) for one call of function
+    _fileOperationCounts["counts"] = dict()
+    _fileOperationCounts["counting"] = True
+    startTime = time.perf_counter()
+    try:
+        function(*args)
+    finally:
+        _fileOperationCounts["counting"] = False
+    return time.perf_counter() - startTime, dict(_fileOperationCounts["counts"])
+
+
+def _gfsFrames(runTime):
+    # Every GFS product (productType 3), every forecast hour of one run
+    gfsProducts = [product for product in HDWX_helpers.productRegistry.values() if product.productTypeID == 3]
+    for fhour in range(0, 385, 3):
+        for product in gfsProducts:
+            yield product.productID, runTime, f"f{fhour:03d}.png", runTime + timedelta(hours=fhour), ["14.5,-144.5", "54.5,-44.5"], 60
+
+
+def _writeGfsRun(basePath, runTime):
+    for frameArgs in _gfsFrames(runTime):
+        HDWX_helpers.writeJson(basePath, *frameArgs)
+    HDWX_helpers.compactPendingJournals()
+
+
+def _writeGfsRunBatched(basePath, runTime):
+    with HDWX_helpers.writeJsonBatch():
+        for frameArgs in _gfsFrames(runTime):
+            HDWX_helpers.writeJson(basePath, *frameArgs)
+
+
+def _withoutPublishTimes(jsonData):
+    # Publish times depend on when the benchmark ran, so they're left out of output comparisons
+    if isinstance(jsonData, dict):
+        return {key : _withoutPublishTimes(value) for key, value in jsonData.items() if key not in ["publishTime", "lastReloadTime"]}
+    if isinstance(jsonData, list):
+        return [_withoutPublishTimes(value) for value in jsonData]
+    return jsonData
+
+
+def _readTree(basePath):
+    # Contents of every metadata json under basePath, keyed by relative path
+    metadataTree = dict()
+    for jsonPath in sorted(Path(basePath, "output", "metadata").rglob("*.json")):
+        with open(jsonPath, "r") as jsonRead:
+            metadataTree[str(jsonPath.relative_to(basePath))] = _withoutPublishTimes(json.load(jsonRead))
+    return metadataTree
+
+
+def benchmarkWriteJsonBatch():
+    """
+    Publishes a full synthetic GFS run (every GFS product, f000 through f384) with one writeJson call per frame and again inside a single writeJsonBatch
+    Returns a dict of wall time and file operation counts for both modes
+    """
+    runTime = dt(2023, 6, 1, 0)
+    results = dict()
+    with TemporaryDirectory() as perFrameDir, TemporaryDirectory() as batchedDir:
+        results["perFrame"] = _measure(_writeGfsRun, perFrameDir, runTime)
+        results["batched"] = _measure(_writeGfsRunBatched, batchedDir, runTime)
+        sameOutput = _readTree(perFrameDir) == _readTree(batchedDir)
+    frameCount = len(list(_gfsFrames(runTime)))
+    return {
+        "frames" : frameCount,
+        "identicalOutput" : sameOutput,
+        "modes" : {modeName : {"wallSeconds" : wallSeconds, "fileOperations" : sum(fileOperations.values()), "fileOperationsByType" : fileOperations} for modeName, (wallSeconds, fileOperations) in results.items()}
+    }
+
+
+# Size of the synthetic trees generated by the tree benchmarks, set with --tree <products> <runs> <frames>
+syntheticTree = {"products" : 10, "runs" : 12, "frames" : 10, "runSpacingHours" : 6}
+
+
+def _syntheticProducts():
+    # The first syntheticTree["products"] local products of the registry that each have their own productPath
+    syntheticProducts = dict()
+    for product in sorted(HDWX_helpers.productRegistry.values(), key=lambda product: product.productID):
+        if "http" not in product.productPath and product.productPath not in syntheticProducts.keys():
+            syntheticProducts[product.productPath] = product
+    return list(syntheticProducts.values())[:syntheticTree["products"]]
+
+
+def _syntheticFrames(latestRunTime, products=None):
+    # syntheticTree["frames"] frames of syntheticTree["runs"] runs of every product, the newest run at latestRunTime
+    for product in (_syntheticProducts() if products is None else products):
+        for runIdx in range(syntheticTree["runs"]):
+            runTime = latestRunTime - timedelta(hours=runIdx*syntheticTree["runSpacingHours"])
+            for frameIdx in range(syntheticTree["frames"]):
+                yield product.productID, runTime, f"{frameIdx}.png", runTime + timedelta(minutes=5*frameIdx), ["0,0", "0,0"], 60
+
+
+def buildSyntheticTree(basePath, latestRunTime, products=None, writeImages=True):
+    """
+    Publishes a synthetic submodule output tree, laid out like a real one: basePath/output/metadata written by writeJson, and a small image for every frame
+    Parameters:
+    ----------
+    basePath: the synthetic submodule's directory
+    latestRunTime: the run time of every product's newest run
+    products: the products to publish, defaults to the first syntheticTree["products"] of the registry
+    writeImages: whether to write an image file for every frame
+    Returns the number of frames published
+
+    """
+    frameCount = 0
+    with HDWX_helpers.writeJsonBatch():
+        for productID, runTime, fileName, validTime, gisInfo, reloadInterval in _syntheticFrames(latestRunTime, products):
+            if writeImages:
+                product = HDWX_helpers.getProduct(productID)
+                imageDir = path.join(basePath, "output", product.productPath, product.pathExtensionForRun(runTime))
+                Path(imageDir).mkdir(parents=True, exist_ok=True)
+                with open(path.join(imageDir, fileName), "wb") as imageWrite:
+                    imageWrite.write(bytes(1024))
+            HDWX_helpers.writeJson(basePath, productID, runTime, fileName, validTime, gisInfo, reloadInterval)
+            frameCount += 1
+    return frameCount
+
+
+def benchmarkWriteJsonTree():
+    """
+    Publishes a syntheticTree of products, runs, and frames with one writeJson call per frame, and again inside a single writeJsonBatch
+    Returns the wall time of both, and whether they wrote the same metadata
+    """
+    latestRunTime = dt(2023, 6, 1, 0)
+    frames = list(_syntheticFrames(latestRunTime))
+    with TemporaryDirectory() as perFrameDir, TemporaryDirectory() as batchedDir:
+        startTime = time.perf_counter()
+        for frameArgs in frames:
+            HDWX_helpers.writeJson(perFrameDir, *frameArgs)
+        HDWX_helpers.compactPendingJournals()
+        perFrameSeconds = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        buildSyntheticTree(batchedDir, latestRunTime, writeImages=False)
+        batchedSeconds = time.perf_counter() - startTime
+        sameOutput = _readTree(perFrameDir) == _readTree(batchedDir)
+    return {"tree" : dict(syntheticTree), "frames" : len(frames), "identicalOutput" : sameOutput, "perFrameSeconds" : perFrameSeconds,
+            "perFrameMeanSeconds" : perFrameSeconds / len(frames), "batchedSeconds" : batchedSeconds}
+
+
+def _concurrentWriter(basePath, productID, runTime, writerIdx, framesPerWriter):
+    for frameIdx in range(framesPerWriter):
+        HDWX_helpers.writeJson(basePath, productID, runTime, f"w{writerIdx}f{frameIdx}.png", runTime + timedelta(minutes=writerIdx*framesPerWriter+frameIdx), ["0,0", "0,0"], 60)
+
+
+def benchmarkConcurrentWriters(writerCount=8, framesPerWriter=20):
+    """
+    Has writerCount processes publish framesPerWriter frames each to the same run at the same time, like a plotter's multiprocessing pool
+    Returns the wall time, and whether every frame made it into the run's metadata
+    """
+    from multiprocessing import Process
+    runTime = dt(2023, 6, 1, 0)
+    productID = _syntheticProducts()[0].productID
+    with TemporaryDirectory() as basePath:
+        writers = [Process(target=_concurrentWriter, args=(basePath, productID, runTime, writerIdx, framesPerWriter)) for writerIdx in range(writerCount)]
+        startTime = time.perf_counter()
+        [writer.start() for writer in writers]
+        [writer.join() for writer in writers]
+        wallSeconds = time.perf_counter() - startTime
+        with open(path.join(basePath, "output", "metadata", "products", str(productID), runTime.strftime("%Y%m%d%H00")+".json"), "r") as jsonRead:
+            framesWritten = len(json.load(jsonRead)["productFrames"])
+    return {"writers" : writerCount, "frames" : writerCount*framesPerWriter, "framesWritten" : framesWritten, "complete" : framesWritten == writerCount*framesPerWriter,
+            "wallSeconds" : wallSeconds, "perFrameMeanSeconds" : wallSeconds / (writerCount*framesPerWriter)}
+
+
+def _runCleanup(hdwxRootPath, purgeAfterHours, policyPath, extraArgs=()):
+    # Runs a cleanup pass the way hdwx_cleanup.service does, returns its report
+    import subprocess
+    with TemporaryDirectory() as reportDir:
+        reportPath = path.join(reportDir, "report.json")
+        # The expiry index goes next to the synthetic tree rather than in the clone
+        cleanupEnv = dict(environ, HDWX_CLEANUP_INDEX_DIR=path.dirname(hdwxRootPath))
+        subprocess.run([sys.executable, path.join(path.dirname(path.abspath(__file__)), "cleanupHDWX.py"), str(purgeAfterHours), hdwxRootPath, "--report", reportPath, "--policy", policyPath, *extraArgs], check=True, stdout=subprocess.DEVNULL, env=cleanupEnv)
+        with open(reportPath, "r") as reportRead:
+            return json.load(reportRead)
+
+
+def benchmarkCleanup():
+    """
+    Builds a syntheticTree whose runs go back runs*runSpacingHours hours and cleans it up with a purge age of half that: a dry run, the pass that purges the older half, and a pass with nothing left to purge
+    Returns each pass's duration as measured by cleanupHDWX.py, and the runs and files it purged
+    """
+    purgeAfterHours = syntheticTree["runs"]*syntheticTree["runSpacingHours"] // 2
+    with TemporaryDirectory() as basePath:
+        frameCount = buildSyntheticTree(basePath, dt.utcnow().replace(minute=0, second=0, microsecond=0))
+        # Retention rules would keep or purge some products early, so the benchmark doesn't depend on which products the tree happens to contain
+        policyPath = path.join(basePath, "retentionPolicy.json")
+        with open(policyPath, "w") as policyWrite:
+            json.dump({"rules" : []}, policyWrite)
+        hdwxRootPath = path.join(basePath, "output")
+        dryRunReport = _runCleanup(hdwxRootPath, purgeAfterHours, policyPath, ["--dry-run"])
+        purgeReport = _runCleanup(hdwxRootPath, purgeAfterHours, policyPath)
+        unchangedReport = _runCleanup(hdwxRootPath, purgeAfterHours, policyPath)
+    return {"tree" : dict(syntheticTree), "frames" : frameCount, "runsPurged" : purgeReport["totals"]["runsPurged"], "filesRemoved" : purgeReport["totals"]["filesRemoved"],
+            "dryRunSeconds" : dryRunReport["durationSeconds"], "purgeSeconds" : purgeReport["durationSeconds"], "unchangedSeconds" : unchangedReport["durationSeconds"]}
+
+
+def benchmarkProductTypeMerge(submoduleCount=4):
+    """
+    Spreads a syntheticTree's products over submoduleCount submodules and merges their productTypes, from scratch, again with nothing changed, and after one submodule publishes a frame
+    Returns the wall time of each merge
+    """
+    import productTypeJsonManager
+    latestRunTime = dt(2023, 6, 1, 0)
+    products = _syntheticProducts()
+    with TemporaryDirectory() as cloneDir, TemporaryDirectory() as targetDir:
+        for submoduleIdx in range(submoduleCount):
+            buildSyntheticTree(path.join(cloneDir, f"hdwx-synthetic{submoduleIdx}"), latestRunTime, products[submoduleIdx::submoduleCount], writeImages=False)
+        results = dict()
+        startTime = time.perf_counter()
+        state, rewrittenProductTypes = productTypeJsonManager.updateProductTypes(cloneDir, targetDir, dict())
+        results["coldSeconds"] = time.perf_counter() - startTime
+        results["productTypes"] = len(rewrittenProductTypes)
+        startTime = time.perf_counter()
+        state, rewrittenProductTypes = productTypeJsonManager.updateProductTypes(cloneDir, targetDir, state)
+        results["unchangedSeconds"] = time.perf_counter() - startTime
+        HDWX_helpers.writeJson(path.join(cloneDir, "hdwx-synthetic0"), products[0].productID, latestRunTime + timedelta(hours=syntheticTree["runSpacingHours"]), "0.png", latestRunTime, ["0,0", "0,0"], 60)
+        HDWX_helpers.compactPendingJournals()
+        startTime = time.perf_counter()
+        state, rewrittenProductTypes = productTypeJsonManager.updateProductTypes(cloneDir, targetDir, state)
+        results["oneChangedSeconds"] = time.perf_counter() - startTime
+    return {"tree" : dict(syntheticTree), "submodules" : submoduleCount, **results}
+
+
+def benchmarkSync():
+    """
+    Syncs a syntheticTree to a local target with syncHDWX.py: the first pass (a full reconcile), a pass after every product publishes one more frame
+    (shipping only the recorded changes), and a forced reconcile with nothing left to ship
+    Returns the wall time of each pass and the files it shipped
+    """
+    import syncHDWX
+    latestRunTime = dt(2023, 6, 1, 0)
+    HDWX_helpers.syncLogEnabled = syncHDWX.syncLogEnabled = True
+    try:
+        with TemporaryDirectory() as basePath, TemporaryDirectory() as targetDir:
+            frameCount = buildSyntheticTree(basePath, latestRunTime)
+            firstStats = syncHDWX.syncModule(basePath, targetDir)
+            newFrames = [(product.productID, latestRunTime, "new.png", latestRunTime + timedelta(hours=1), ["0,0", "0,0"], 60) for product in _syntheticProducts()]
+            for productID, runTime, fileName, validTime, gisInfo, reloadInterval in newFrames:
+                product = HDWX_helpers.getProduct(productID)
+                with open(path.join(basePath, "output", product.productPath, product.pathExtensionForRun(runTime), fileName), "wb") as imageWrite:
+                    imageWrite.write(bytes(1024))
+                HDWX_helpers.writeJson(basePath, productID, runTime, fileName, validTime, gisInfo, reloadInterval)
+            HDWX_helpers.compactPendingJournals()
+            changedStats = syncHDWX.syncModule(basePath, targetDir)
+            reconcileStats = syncHDWX.syncModule(basePath, targetDir, fullReconcile=True)
+    finally:
+        HDWX_helpers.syncLogEnabled = syncHDWX.syncLogEnabled = HDWX_helpers.environ.get("HDWX_SYNC_LOG", "0") == "1"
+    return {"tree" : dict(syntheticTree), "frames" : frameCount, "newFrames" : len(newFrames),
+            "firstSeconds" : firstStats["seconds"], "firstShipped" : firstStats["shipped"],
+            "changedSeconds" : changedStats["seconds"], "changedShipped" : changedStats["shipped"],
+            "unchangedReconcileSeconds" : reconcileStats["seconds"], "unchangedReconcileShipped" : reconcileStats["shipped"]}
+
+
+def benchmarkMetricsOverhead(spanCount=200000):
+    """
+    Times spanCount empty timingSpan blocks with metrics off, and on (without flushing)
+    Returns the cost of one span in each case
+    """
+    def emptySpans():
+        for spanIdx in range(spanCount):
+            with HDWX_helpers.timingSpan("benchmark", 0):
+                pass
+    previousMetrics = dict(HDWX_helpers.metrics)
+    results = dict()
+    try:
+        with TemporaryDirectory() as metricsDir:
+            for modeName, metricsDirForMode in [("disabled", None), ("enabled", metricsDir)]:
+                HDWX_helpers.metrics.update({"dir" : metricsDirForMode, "flushSeconds" : float("inf")})
+                startTime = time.perf_counter()
+                emptySpans()
+                results[modeName+"SpanSeconds"] = (time.perf_counter() - startTime) / spanCount
+            # The benchmark's spans aren't real measurements, so they're never flushed
+            HDWX_helpers._metricsState["spans"] = dict()
+    finally:
+        HDWX_helpers.metrics.clear()
+        HDWX_helpers.metrics.update(previousMetrics)
+    return {"spans" : spanCount, **results}
+
+
+def _saveImageLegacy(fig, outputPath, transparent=False, bbox_inches=None):
+    # saveImage as it was before encoding in memory: a full PNG encode to a gif- temporary that's decoded, quantized and encoded again (and never removed)
+    gifPath = outputPath.replace(path.basename(outputPath), "gif-"+path.basename(outputPath))
+    fig.savefig(gifPath, format="png", transparent=transparent, bbox_inches=bbox_inches)
+    from PIL import Image
+    im = Image.open(gifPath)
+    im = im.convert("RGB").convert("P", palette=Image.WEB)
+    im.save(outputPath)
+
+
+def _syntheticFigure(seed):
+    # A 1920x1080 frame with a filled field, contours, and a title, similar in cost to a GIS product
+    import matplotlib
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    lons, lats = np.meshgrid(np.linspace(-130, -60, 700), np.linspace(20, 55, 350))
+    field = np.sin(lons/7 + seed) * np.cos(lats/5) * 30 + rng.normal(0, 1, lons.shape)
+    fig = plt.figure()
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.pcolormesh(lons, lats, field, cmap="viridis", shading="auto")
+    ax.contour(lons, lats, field, levels=10, colors="black", linewidths=0.5)
+    ax.set_title(f"Synthetic frame {seed}")
+    ax.axis("off")
+    fig.set_size_inches(1920/fig.dpi, 1080/fig.dpi)
+    return fig
+
+
+def _colorError(fig, imagePath):
+    # Mean absolute difference per channel (0-255) between the saved image and the figure rendered without quantization
+    from io import BytesIO
+    from PIL import Image
+    import numpy as np
+    referenceBuffer = BytesIO()
+    fig.savefig(referenceBuffer, format="png")
+    reference = np.asarray(Image.open(referenceBuffer).convert("RGB"), dtype=np.int16)
+    saved = np.asarray(Image.open(imagePath).convert("RGB"), dtype=np.int16)
+    return float(np.abs(reference - saved).mean())
+
+
+def _saveFrames(saveFunction, outputDir, frameCount):
+    import matplotlib.pyplot as plt
+    secondsPerFrame = list()
+    colorErrors = list()
+    for frameIdx in range(frameCount):
+        fig = _syntheticFigure(frameIdx)
+        startTime = time.perf_counter()
+        saveFunction(fig, path.join(outputDir, f"f{frameIdx:03d}.png"))
+        secondsPerFrame.append(time.perf_counter() - startTime)
+        colorErrors.append(_colorError(fig, path.join(outputDir, f"f{frameIdx:03d}.png")))
+        plt.close(fig)
+    return secondsPerFrame, colorErrors
+
+
+def benchmarkSaveImage(frameCount=10):
+    """
+    Saves the same synthetic 1920x1080 frames with the legacy disk round-trip saveImage (dithered to the web palette),
+    and with the current saveImage using the web palette and a palette built for the product
+    Returns a dict of per-frame time, bytes written, and color error (compared to the unquantized figure) for each
+    """
+    results = dict()
+    saveModes = [
+        ("legacy", _saveImageLegacy),
+        ("webPalette", HDWX_helpers.saveImage),
+        ("productPalette", lambda fig, outputPath: HDWX_helpers.saveImage(fig, outputPath, paletteKey="benchmark"))
+    ]
+    for modeName, saveFunction in saveModes:
+        # Start from an empty palette cache, so the first frame pays for building the palette like it would in a plotter
+        HDWX_helpers._paletteCache.clear()
+        with TemporaryDirectory() as outputDir:
+            secondsPerFrame, colorErrors = _saveFrames(saveFunction, outputDir, frameCount)
+            writtenFiles = [writtenFile for writtenFile in Path(outputDir).iterdir()]
+            results[modeName] = {
+                "meanSecondsPerFrame" : sum(secondsPerFrame) / frameCount,
+                "maxSecondsPerFrame" : max(secondsPerFrame),
+                "filesWritten" : len(writtenFiles),
+                "bytesWrittenPerFrame" : sum([writtenFile.stat().st_size for writtenFile in writtenFiles]) / frameCount,
+                "meanColorError" : sum(colorErrors) / frameCount
+            }
+    return {"frames" : frameCount, "modes" : results}
+
+
+def _saveLoop(outputDir, frameCount, publishedFrames):
+    # A plotting loop as a model or radar plotter would run it: create, save, and close each frame, publishing each one once its image is written
+    import matplotlib.pyplot as plt
+    for frameIdx in range(frameCount):
+        fig = _syntheticFigure(frameIdx)
+        HDWX_helpers.saveImage(fig, path.join(outputDir, f"f{frameIdx:03d}.png"), paletteKey="benchmark", onWritten=lambda frameIdx=frameIdx: publishedFrames.append(frameIdx))
+        plt.close(fig)
+    HDWX_helpers.flushImages()
+
+
+def benchmarkSaveImagePool(frameCount=10, workers=2):
+    """
+    Runs the same plotting loop with saveImage encoding in the foreground and in a background pool of worker threads
+    Returns a dict of total loop time for both, whether every frame was published in order, and whether both wrote identical images
+    """
+    results = dict()
+    originalEncoding = dict(HDWX_helpers.imageEncoding)
+    with TemporaryDirectory() as foregroundDir, TemporaryDirectory() as backgroundDir:
+        for modeName, modeWorkers, outputDir in [("foreground", 0, foregroundDir), ("background", workers, backgroundDir)]:
+            HDWX_helpers._paletteCache.clear()
+            HDWX_helpers.imageEncoding["workers"] = modeWorkers
+            publishedFrames = list()
+            startTime = time.perf_counter()
+            try:
+                _saveLoop(outputDir, frameCount, publishedFrames)
+            finally:
+                HDWX_helpers.imageEncoding.update(originalEncoding)
+            results[modeName] = {"workers" : modeWorkers, "loopSeconds" : time.perf_counter() - startTime, "publishedInOrder" : publishedFrames == list(range(frameCount))}
+        sameOutput = all([Path(foregroundDir, f"f{frameIdx:03d}.png").read_bytes() == Path(backgroundDir, f"f{frameIdx:03d}.png").read_bytes() for frameIdx in range(frameCount)])
+    return {"frames" : frameCount, "identicalOutput" : sameOutput, "modes" : results}
+
+
+def benchmarkDressImage(frameCount=5):
+    """
+    Brands and renders the same frame repeatedly, with the branding asset cache emptied before every frame (so the logo is decoded and resampled every time) and kept warm
+    Returns a dict of mean dressImage and render time per frame for both
+    """
+    import matplotlib
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+    import numpy as np
+    results = dict()
+    for modeName, clearCache in [("coldCache", True), ("warmCache", False)]:
+        dressSeconds = list()
+        renderSeconds = list()
+        # One untimed frame, so the warm mode starts warm
+        for frameIdx in range(frameCount+1):
+            if clearCache:
+                HDWX_helpers._brandingAssets.update({"logoPath" : None, "logo" : None, "logoSizes" : dict()})
+            fig = plt.figure()
+            ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
+            plotHandle = ax.pcolormesh(np.random.default_rng(frameIdx).random((50, 80)))
+            startTime = time.perf_counter()
+            HDWX_helpers.dressImage(fig, ax, "Synthetic product", dt(2023, 6, 1), plotHandle=plotHandle, colorbarLabel="Synthetic units")
+            dressedTime = time.perf_counter()
+            fig.canvas.draw()
+            if frameIdx > 0:
+                dressSeconds.append(dressedTime - startTime)
+                renderSeconds.append(time.perf_counter() - dressedTime)
+            plt.close(fig)
+        results[modeName] = {"meanDressSeconds" : sum(dressSeconds) / frameCount, "meanRenderSeconds" : sum(renderSeconds) / frameCount}
+    return {"frames" : frameCount, "logoFound" : HDWX_helpers._brandingAssets["logo"] is not None, "modes" : results}
+
+
+def benchmarkBrandingTemplate(frameCount=10):
+    """
+    Renders the same frames by branding a new figure for each one with dressImage, and by drawing each one over a brandingTemplate
+    Returns the mean seconds per frame of each (rendering only, encoding is the same for both), and whether their pixels matched
+    """
+    import matplotlib
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    def staticFigure():
+        fig = plt.figure()
+        ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
+        # Stand-ins for map features, drawn above the data like cartopy's coastlines and borders
+        for lineIdx in range(20):
+            ax.plot(np.linspace(0, 80, 500), 25+10*np.sin(np.linspace(0, 6, 500)+lineIdx)+lineIdx, color="black", linewidth=0.5, zorder=3)
+        ax.set_xlim(0, 80)
+        ax.set_ylim(0, 50)
+        return fig, ax
+
+    def frameData(ax, frameIdx, animated):
+        return ax.pcolormesh(np.random.default_rng(frameIdx).random((50, 80)), vmin=0, vmax=1, cmap="viridis", animated=animated)
+    dressSeconds = list()
+    templateSeconds = list()
+    pixelsMatch = True
+    templateFig, templateAx = staticFigure()
+    for frameIdx in range(frameCount):
+        validTime = dt(2023, 6, 1) + timedelta(minutes=5*frameIdx)
+        startTime = time.perf_counter()
+        fig, ax = staticFigure()
+        plotHandle = frameData(ax, frameIdx, False)
+        HDWX_helpers.dressImage(fig, ax, "Synthetic product", validTime, plotHandle=plotHandle, colorbarLabel="Synthetic units")
+        dressedPixels = HDWX_helpers._renderRGB(fig, False, None)
+        dressSeconds.append(time.perf_counter() - startTime)
+        plt.close(fig)
+        startTime = time.perf_counter()
+        plotHandle = frameData(templateAx, frameIdx, True)
+        template = HDWX_helpers.brandingTemplate(templateFig, templateAx, plotHandle=plotHandle, colorbarLabel="Synthetic units")
+        templatePixels = HDWX_helpers._renderTemplateFrame(template, HDWX_helpers._titleString("Synthetic product", validTime, None), [plotHandle])
+        templateSeconds.append(time.perf_counter() - startTime)
+        plotHandle.remove()
+        pixelsMatch = pixelsMatch and np.array_equal(dressedPixels, templatePixels)
+    plt.close(templateFig)
+    # The first frame builds the template, so it's reported separately
+    return {"frames" : frameCount, "pixelsMatch" : pixelsMatch, "dressImageMeanSeconds" : sum(dressSeconds) / frameCount,
+            "templateFirstFrameSeconds" : templateSeconds[0], "templateMeanSeconds" : sum(templateSeconds[1:]) / max(frameCount-1, 1)}
+
+
+def benchmarkRenderWorker(jobCount=5):
+    """
+    Runs a small plotting script jobCount times as its own process, and jobCount times through a render worker
+    Returns the mean seconds per run of each, measured from the calling service's side
+    """
+    import subprocess
+    renderWorkerPath = path.join(path.dirname(path.abspath(__file__)), "renderWorker.py")
+    with TemporaryDirectory() as tmpDir:
+        scriptPath = path.join(tmpDir, "plotFrame.py")
+        with open(scriptPath, "w") as scriptWrite:
+            scriptWrite.write("\n".join([
+                "import sys",
+                "sys.path.append("+repr(path.dirname(path.abspath(__file__)))+")",
+                "import matplotlib",
+                "matplotlib.use('agg')",
+                "from matplotlib import pyplot as plt",
+                "from datetime import datetime as dt",
+                "import numpy as np",
+                "import HDWX_helpers",
+                "fig = plt.figure()",
+                "ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])",
+                "plotHandle = ax.pcolormesh(np.random.default_rng(int(sys.argv[1])).random((50, 80)))",
+                "HDWX_helpers.dressImage(fig, ax, 'Synthetic product', dt(2023, 6, 1), plotHandle=plotHandle, colorbarLabel='Synthetic units')",
+                "HDWX_helpers.saveImage(fig, 'frame'+sys.argv[1]+'.png')",
+                ""
+            ]))
+        workerEnv = dict(environ, HDWX_RENDER_SOCKET=path.join(tmpDir, "renderWorker.sock"))
+        results = dict()
+        startTime = time.perf_counter()
+        for jobIdx in range(jobCount):
+            subprocess.run([sys.executable, renderWorkerPath, "plotFrame.py", str(jobIdx)], cwd=tmpDir, env=workerEnv, check=True)
+        results["processPerRunMeanSeconds"] = (time.perf_counter() - startTime) / jobCount
+        renderWorker = subprocess.Popen([sys.executable, renderWorkerPath, "--serve"], cwd=tmpDir, env=workerEnv, stdout=subprocess.DEVNULL)
+        try:
+            while not path.exists(workerEnv["HDWX_RENDER_SOCKET"]):
+                time.sleep(0.1)
+            startTime = time.perf_counter()
+            for jobIdx in range(jobCount):
+                subprocess.run([sys.executable, renderWorkerPath, "plotFrame.py", str(jobIdx)], cwd=tmpDir, env=workerEnv, check=True)
+            results["renderWorkerMeanSeconds"] = (time.perf_counter() - startTime) / jobCount
+        finally:
+            renderWorker.terminate()
+            renderWorker.wait()
+    return {"jobs" : jobCount, **results}
+
+
+benchmarks = {
+    "writeJsonBatch" : benchmarkWriteJsonBatch,
+    "writeJsonTree" : benchmarkWriteJsonTree,
+    "concurrentWriters" : benchmarkConcurrentWriters,
+    "cleanup" : benchmarkCleanup,
+    "productTypeMerge" : benchmarkProductTypeMerge,
+    "sync" : benchmarkSync,
+    "metricsOverhead" : benchmarkMetricsOverhead,
+    "saveImage" : benchmarkSaveImage,
+    "saveImagePool" : benchmarkSaveImagePool,
+    "dressImage" : benchmarkDressImage,
+    "brandingTemplate" : benchmarkBrandingTemplate,
+    "renderWorker" : benchmarkRenderWorker
+}
+
+# A timing this much slower than the baseline's (as a fraction of it) is a regression, unless both are under regressionFloorSeconds, which is mostly noise
+regressionTolerance = 0.25
+regressionFloorSeconds = 0.01
+
+
+def _timings(results, prefix=""):
+    # Every timing in a results dict, by dotted path. Timings are the numbers whose key ends in "Seconds".
+    timings = dict()
+    for resultKey, resultValue in results.items():
+        if isinstance(resultValue, dict):
+            timings.update(_timings(resultValue, prefix+resultKey+"."))
+        elif resultKey.endswith("Seconds") and isinstance(resultValue, (int, float)) and not isinstance(resultValue, bool):
+            timings[prefix+resultKey] = resultValue
+    return timings
+
+
+def _fastestTimings(repeatedResults):
+    # Merges the results of repeated runs of a benchmark, keeping the fastest of every timing, since slower runs mostly measure other processes
+    if isinstance(repeatedResults[0], dict):
+        return {resultKey : _fastestTimings([results[resultKey] for results in repeatedResults]) if resultKey.endswith("Seconds") or isinstance(resultValue, dict) else resultValue
+                for resultKey, resultValue in repeatedResults[0].items()}
+    if isinstance(repeatedResults[0], (int, float)) and not isinstance(repeatedResults[0], bool):
+        return min(repeatedResults)
+    return repeatedResults[0]
+
+
+def compareResults(results, baselineResults, tolerance=None):
+    """
+    Finds the timings that got slower than a previous run's
+    Parameters:
+    ----------
+    results: the "results" of a benchmark run
+    baselineResults: the "results" of the run to compare against. Timings missing from either, and benchmarks run on a different size of synthetic tree, are skipped.
+    tolerance: fraction slower than the baseline that's allowed, defaults to regressionTolerance
+    Returns a list of {"timing", "baselineSeconds", "seconds", "ratio"}, one per regression
+
+    """
+    tolerance = regressionTolerance if tolerance is None else tolerance
+    comparableResults = {benchmarkName : benchmarkResults for benchmarkName, benchmarkResults in results.items()
+                            if benchmarkName in baselineResults.keys() and benchmarkResults.get("tree") == baselineResults[benchmarkName].get("tree")}
+    baselineTimings = _timings(baselineResults)
+    regressions = list()
+    for timingName, seconds in _timings(comparableResults).items():
+        baselineSeconds = baselineTimings.get(timingName)
+        if baselineSeconds is None or max(seconds, baselineSeconds) < regressionFloorSeconds:
+            continue
+        if seconds > baselineSeconds * (1 + tolerance):
+            regressions.append({"timing" : timingName, "baselineSeconds" : baselineSeconds, "seconds" : seconds, "ratio" : seconds / max(baselineSeconds, 1e-9)})
+    return regressions
+
+
+# benchmarkHDWX.py [benchmark names...] [--tree <products> <runs> <frames>] [--repeat <runs>] [--output <results json>] [--compare <baseline results json>] [--tolerance <fraction>]
+if __name__ == "__main__":
+    import platform
+    benchmarkNames = list()
+    outputPath = None
+    baselinePath = None
+    tolerance = None
+    repeatCount = 1
+    argIdx = 1
+    while argIdx < len(sys.argv):
+        if sys.argv[argIdx] == "--tree":
+            syntheticTree.update({"products" : int(sys.argv[argIdx+1]), "runs" : int(sys.argv[argIdx+2]), "frames" : int(sys.argv[argIdx+3])})
+            argIdx += 3
+        elif sys.argv[argIdx] == "--repeat":
+            repeatCount = int(sys.argv[argIdx+1])
+            argIdx += 1
+        elif sys.argv[argIdx] == "--output":
+            outputPath = sys.argv[argIdx+1]
+            argIdx += 1
+        elif sys.argv[argIdx] == "--compare":
+            baselinePath = sys.argv[argIdx+1]
+            argIdx += 1
+        elif sys.argv[argIdx] == "--tolerance":
+            tolerance = float(sys.argv[argIdx+1])
+            argIdx += 1
+        else:
+            benchmarkNames.append(sys.argv[argIdx])
+        argIdx += 1
+    benchmarkNames = benchmarkNames if len(benchmarkNames) > 0 else list(benchmarks.keys())
+    for benchmarkName in benchmarkNames:
+        if benchmarkName not in benchmarks.keys():
+            print("Unknown benchmark: " + benchmarkName)
+            print("Available benchmarks: " + ", ".join(benchmarks.keys()))
+            exit()
+    allResults = {
+        "environment" : {"startTime" : dt.utcnow().strftime("%Y%m%d%H%M%S"), "python" : platform.python_version(), "platform" : platform.platform(), "cpuCount" : cpu_count(), "syntheticTree" : dict(syntheticTree), "repeat" : repeatCount},
+        "results" : {benchmarkName : _fastestTimings([benchmarks[benchmarkName]() for repeatIdx in range(repeatCount)]) for benchmarkName in benchmarkNames}
+    }
+    if baselinePath is not None:
+        with open(baselinePath, "r") as baselineRead:
+            allResults["regressions"] = compareResults(allResults["results"], json.load(baselineRead)["results"], tolerance)
+    print(json.dumps(allResults, indent=4))
+    if outputPath is not None:
+        with open(outputPath, "w") as outputWrite:
+            json.dump(allResults, outputWrite, indent=4)
+    if len(allResults.get("regressions", list())) > 0:
+        print(str(len(allResults["regressions"]))+" timings regressed: "+", ".join([regression["timing"] for regression in allResults["regressions"]]))
+        exit(1)
@@ -1,16 +1,6 @@
 #!/bin/bash
-startingDir=`pwd`
+# Kept for services installed before cleanupModules.py, which does what this used to, several submodules at once
 relMyDir=`dirname $BASH_SOURCE`
 myDir=`realpath $relMyDir`
-productDirs=(*/)
-for productDir in "${productDirs[@]}"
-do
-    cd $productDir
-    if [ -f HDWX_helpers.py ]; then
-        rm HDWX_helpers.py
-    fi
-    cp ../HDWX_helpers.py ./
-    python3 cleanup.py
-    cd $myDir
-done
-cd $startingDir
+cd $myDir
+exec python3 cleanupModules.py "$@"
@@ -4,69 +4,614 @@
 
 import sys
 from datetime import datetime as dt, timedelta
-from os import path, listdir, remove
-from shutil import rmtree
+from os import path, listdir, remove, scandir
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import os
+import hashlib
 import json
+import time
+from HDWX_helpers import productRegistry, atomicWriteBytes, writeMetadataJson, runLock, metadataSiblingExtensions, openMetadataIndex, indexedRuns, removeIndexedRuns, timingSpan, recordSpan
 
-# cleanupHDWX.py <purgeAfterHours> <HDWX server root>
+# Retention rules, applied in order to every product they match. See loadRetentionRules for the rule format.
+retentionPolicyPath = path.join(path.dirname(path.abspath(__file__)), "retentionPolicy.json")
+# Sorted run list of every product directory, so that products whose directory hasn't changed aren't listed again. Kept in the clone (one per HDWX server root), or in
+# HDWX_CLEANUP_INDEX_DIR if that's set, outside of the tree the web server serves. Older versions kept it in hdwxRootPath/metadata/ under legacyExpiryIndexName.
+expiryIndexDir = os.environ.get("HDWX_CLEANUP_INDEX_DIR", path.dirname(path.abspath(__file__)))
+legacyExpiryIndexName = ".cleanupExpiryIndex.json"
+# Directories modified less than this long before they were listed aren't trusted in the index, a run written in the same mtime tick as the listing would otherwise be missed
+indexRacySeconds = 2
+
+
+def loadRetentionRules(policyPath=None):
+    """
+    Reads the list of retention rules. Each rule is a dict with:
+    "name": used in the cleanup report
+    "match": dict of any of "productIDs" (list), "productPathContains", "productDescriptionContains", all of which must match
+    and any of:
+    "purgeAfterHours": replaces the purge threshold passed on the command line
+    "purgeAfterFactor": multiplies the purge threshold
+    "keepAtLeastHours": runs newer than this are never purged
+    "purge": false to never purge the product
+    Parameters:
+    ----------
+    policyPath: path to the retention policy json, defaults to retentionPolicy.json next to this script
+
+    """
+    with open(policyPath if policyPath is not None else retentionPolicyPath, "r") as jsonRead:
+        return json.load(jsonRead)["rules"]
+
+
+def _ruleMatches(rule, productID, productData):
+    ruleMatch = rule.get("match", dict())
+    if "productIDs" in ruleMatch.keys() and productID not in [str(matchID) for matchID in ruleMatch["productIDs"]]:
+        return False
+    if "productPathContains" in ruleMatch.keys() and ruleMatch["productPathContains"] not in productData["productPath"]:
+        return False
+    if "productDescriptionContains" in ruleMatch.keys() and ruleMatch["productDescriptionContains"] not in productData["productDescription"]:
+        return False
+    return True
+
+
+def compileRetention(productID, productData, retentionRules, hoursToPurgeAfter):
+    """
+    Applies the retention rules to one product
+    Parameters:
+    ----------
+    productID: the productID, as the name of its directory in metadata/products/
+    productData: dict containing at least the product's "productPath" and "productDescription"
+    retentionRules: list of rules from loadRetentionRules
+    hoursToPurgeAfter: timedelta after which runs are purged, before any rule is applied
+    Returns a dict of "purge" (False if runs of this product are never purged), "retention" (timedelta after which runs are purged), and "ruleNames" (rules that matched)
+
+    """
+    retention = {"purge" : True, "retention" : hoursToPurgeAfter, "ruleNames" : list()}
+    keepAtLeast = timedelta(0)
+    for rule in retentionRules:
+        if not _ruleMatches(rule, productID, productData):
+            continue
+        retention["ruleNames"].append(rule["name"])
+        if "purgeAfterHours" in rule.keys():
+            retention["retention"] = timedelta(hours=rule["purgeAfterHours"])
+        if "purgeAfterFactor" in rule.keys():
+            retention["retention"] = timedelta(seconds=retention["retention"].total_seconds()*rule["purgeAfterFactor"])
+        if "keepAtLeastHours" in rule.keys():
+            keepAtLeast = max(keepAtLeast, timedelta(hours=rule["keepAtLeastHours"]))
+        if "purge" in rule.keys():
+            retention["purge"] = rule["purge"]
+    retention["retention"] = max(retention["retention"], keepAtLeast)
+    return retention
+
+
+def productPolicy(metadataTopDir, productID, now, hoursToPurgeAfter, retentionRules, cleanupStats):
+    """
+    Works out, once per product, where a product's frames are stored and which of its runs are old enough to purge
+    Parameters:
+    ----------
+    metadataTopDir: hdwxRootPath/metadata/
+    productID: the productID, as the name of its directory in metadata/products/
+    now: the current time
+    hoursToPurgeAfter: timedelta after which runs are purged
+    retentionRules: list of rules from loadRetentionRules
+    cleanupStats: dict of counters to update
+    Returns a dict with the product's "record" (ProductRecord or None if it isn't in the registry), "productPath", "purge", "thresholdTime" (runs older than this are purged),
+    "normalThresholdTime" (what thresholdTime would be without any retention rule), and "ruleNames"
+
+    """
+    # The "associated data" is stored in hdwxRootPath+productPath+pathExtension
+    # First we need the productPath, which is defined in the product registry for all known products...
+    productRecord = productRegistry.get(int(productID)) if productID.isdigit() else None
+    if productRecord is not None:
+        productData = productRecord._asdict()
+    else:
+        # ...otherwise it can be obtained from hdwxRootPath/metadata/<productID>.json (This is where that "metadataTopDir" comes in)
+        with open(path.join(metadataTopDir, productID+".json"), "r") as jsonRead:
+            # Read the json file
+            productData = json.load(jsonRead)
+        cleanupStats["productJsonReads"] += 1
+    retention = compileRetention(productID, productData, retentionRules, hoursToPurgeAfter)
+    return {"record" : productRecord, "productPath" : productData["productPath"], "purge" : retention["purge"], "thresholdTime" : now - retention["retention"], "normalThresholdTime" : now - hoursToPurgeAfter, "ruleNames" : retention["ruleNames"]}
+
+
+def _newProductReport():
+    return {"runsScanned" : 0, "runsExpired" : 0, "runsKeptByRetentionRules" : 0, "runsExpiredEarlyByRetentionRules" : 0, "retentionRules" : list(), "listedFromIndex" : False, "filesReclaimed" : 0, "bytesReclaimed" : 0, "purgeErrors" : 0, "seconds" : 0.0}
+
+
+def expiryIndexPath(hdwxRootPath):
+    """
+    Returns the path of the expiry index for the HDWX server root hdwxRootPath
+    """
+    return path.join(expiryIndexDir, ".cleanupExpiryIndex-"+hashlib.sha256(path.realpath(hdwxRootPath).encode()).hexdigest()[:16]+".json")
+
+
+def loadExpiryIndex(hdwxRootPath):
+    indexPath = expiryIndexPath(hdwxRootPath)
+    if path.exists(indexPath):
+        try:
+            with open(indexPath, "r") as jsonRead:
+                return json.load(jsonRead)
+        except ValueError:
+            pass
+    return dict()
+
+
+def saveExpiryIndex(hdwxRootPath, expiryIndex):
+    atomicWriteBytes(expiryIndexPath(hdwxRootPath), json.dumps(expiryIndex).encode(), skipUnchanged=True)
+    # Don't leave an index written by older versions where the web server can serve it
+    try:
+        remove(path.join(hdwxRootPath, "metadata", legacyExpiryIndexName))
+    except FileNotFoundError:
+        pass
+
+
+def listProductRuns(productEntry, indexEntry, cleanupStats, dryRun=False):
+    """
+    Returns the index entry of one product: the product directory's mtime when it was listed, its run json names in time order, and which of them have precompressed copies
+    If the directory hasn't changed since indexEntry was made, indexEntry is returned without listing the directory
+    Parameters:
+    ----------
+    productEntry: os.DirEntry of hdwxRootPath/metadata/products/<productID>/
+    indexEntry: this product's entry from the previous pass's index, or None
+    cleanupStats: dict of counters to update
+    dryRun: if True, don't remove stray files
+
+    """
+    # stat before listing, so that anything written during the listing changes the mtime the next pass compares against
+    dirMtime = productEntry.stat().st_mtime_ns
+    if indexEntry is not None and indexEntry["mtime"] == dirMtime:
+        cleanupStats["productDirsFromIndex"] += 1
+        return indexEntry
+    runEntries = {runEntry.name : runEntry for runEntry in scandir(productEntry.path)}
+    runNames = list()
+    precompressedRuns = dict()
+    for runFileName in runEntries.keys():
+        # Precompressed copies of a run's json get removed along with the run, or now if the run's json is already gone
+        if path.splitext(runFileName)[1] in [".gz", ".br"]:
+            if path.splitext(runFileName)[0] in runEntries.keys():
+                precompressedRuns.setdefault(path.splitext(runFileName)[0], list()).append(path.splitext(runFileName)[1])
+            elif not dryRun:
+                remove(path.join(productEntry.path, runFileName))
+            continue
+        try:
+            # The filename of the json file is a time in UTC, formatted as %Y%m%d%H%M, so it sorts in time order
+            dt.strptime(runFileName, "%Y%m%d%H%M.json")
+        except:
+            if not dryRun:
+                remove(path.join(productEntry.path, runFileName))
+            continue
+        runNames.append(runFileName)
+    runNames.sort()
+    cleanupStats["productDirsListed"] += 1
+    cleanupStats["runsScanned"] += len(runNames)
+    if time.time_ns() - dirMtime < indexRacySeconds * 1e9:
+        dirMtime = None
+    return {"mtime" : dirMtime, "runs" : runNames, "precompressed" : precompressedRuns}
+
+
+def indexEntryFromMetadataIndex(indexedProductRuns):
+    """
+    Builds a product's index entry from its runs in a module's SQLite metadata index (see HDWX_helpers.openMetadataIndex) instead of listing its directory
+    Parameters:
+    ----------
+    indexedProductRuns: list of (run time, pathExtension) of the product, oldest first, from HDWX_helpers.indexedRuns
+
+    """
+    runNames = [runKey+".json" for runKey, pathExtension in indexedProductRuns]
+    # Whether precompressed copies exist isn't indexed, removing one that doesn't exist is harmless
+    return {"mtime" : None, "runs" : runNames, "precompressed" : {runName : ["."+encoding for encoding in metadataSiblingExtensions] for runName in runNames}, "pathExtensions" : {runKey+".json" : pathExtension for runKey, pathExtension in indexedProductRuns}}
+
+
+def _runsBefore(runNames, thresholdTime):
+    # Number of runs (sorted) whose run time is before thresholdTime. Run names have minute resolution, so compare against the first minute not before thresholdTime
+    thresholdMinute = thresholdTime.replace(second=0, microsecond=0)
+    if thresholdMinute < thresholdTime:
+        thresholdMinute = thresholdMinute + timedelta(minutes=1)
+    return bisect_left(runNames, thresholdMinute.strftime("%Y%m%d%H%M.json"))
+
+
+def findExpiredRuns(hdwxRootPath, productID, productMetadataDir, policy, indexEntry, expiredRuns, cleanupStats, productReport):
+    """
+    Finds every expired run of one product. Only the runs that are due are looked at.
+    Parameters:
+    ----------
+    hdwxRootPath: the HDWX server root
+    productID: the productID, as the name of its directory in metadata/products/
+    productMetadataDir: hdwxRootPath/metadata/products/<productID>/
+    policy: the product's policy from productPolicy
+    indexEntry: the product's index entry from listProductRuns
+    expiredRuns: dict of frame directory to {"productID", "metadataFiles", "runNames"}, updated with this product's expired runs
+    cleanupStats: dict of counters to update
+    productReport: this product's entry in the cleanup report
+    Returns the names of the run json files that expired
+
+    """
+    runNames = indexEntry["runs"]
+    normallyExpired = _runsBefore(runNames, policy["normalThresholdTime"])
+    expiredCount = _runsBefore(runNames, policy["thresholdTime"]) if policy["purge"] else 0
+    productReport["runsKeptByRetentionRules"] += max(0, normallyExpired - expiredCount)
+    productReport["runsExpiredEarlyByRetentionRules"] += max(0, expiredCount - normallyExpired)
+    for runFileName in runNames[:expiredCount]:
+        runFilePath = path.join(productMetadataDir, runFileName)
+        # Now we need the pathExtension, which the registry can work out from the run time...
+        if "pathExtensions" in indexEntry.keys():
+            runPathExtension = indexEntry["pathExtensions"][runFileName]
+            cleanupStats["runJsonReadsAvoided"] += 1
+        elif policy["record"] is not None:
+            runPathExtension = policy["record"].pathExtensionForRun(dt.strptime(runFileName, "%Y%m%d%H%M.json"))
+            cleanupStats["runJsonReadsAvoided"] += 1
+        else:
+            # ...otherwise it can be obtained from the run's json file, in hdwxRootPath/metadata/products/<productID>/<runtime>.json
+            try:
+                with open(runFilePath) as jsonRead:
+                    runData = json.load(jsonRead)
+            except FileNotFoundError:
+                continue
+            runPathExtension = runData["pathExtension"]
+            cleanupStats["runJsonReads"] += 1
+        # Now we know where the frames for this product are located, and we can purge them! Also remove the json data, but only once the frames are gone.
+        # Runs can share a frame directory (products with a fixed pathExtension), so group by directory and delete each one only once
+        expiredRun = expiredRuns.setdefault(path.join(hdwxRootPath, policy["productPath"], runPathExtension), {"productID" : productID, "metadataFiles" : list(), "runNames" : list()})
+        expiredRun["metadataFiles"].append(runFilePath)
+        expiredRun["runNames"].append(runFileName)
+        for precompressedExtension in indexEntry["precompressed"].get(runFileName, list()):
+            expiredRun["metadataFiles"].append(runFilePath+precompressedExtension)
+        # The run's publish manifest, if its module writes them (HDWX_PUBLISH_MANIFESTS), is in metadata/manifests/<productID>/
+        expiredRun["metadataFiles"].append(path.join(hdwxRootPath, "metadata", "manifests", productID, runFileName))
+        cleanupStats["runsPurged"] += 1
+        productReport["runsExpired"] += 1
+    return runNames[:expiredCount]
+
+
+def _removeDirContents(dirFd, dryRun):
+    # Deletes everything inside an open directory using paths relative to its fd (unlinkat), returns the number of files and bytes removed
+    filesRemoved = 0
+    bytesRemoved = 0
+    with scandir(dirFd) as dirEntries:
+        for dirEntry in dirEntries:
+            try:
+                if dirEntry.is_dir(follow_symlinks=False):
+                    childFd = os.open(dirEntry.name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dirFd)
+                    try:
+                        childFiles, childBytes = _removeDirContents(childFd, dryRun)
+                    finally:
+                        os.close(childFd)
+                    filesRemoved += childFiles
+                    bytesRemoved += childBytes
+                    if not dryRun:
+                        os.rmdir(dirEntry.name, dir_fd=dirFd)
+                else:
+                    fileSize = dirEntry.stat(follow_symlinks=False).st_size
+                    if not dryRun:
+                        os.unlink(dirEntry.name, dir_fd=dirFd)
+                    filesRemoved += 1
+                    bytesRemoved += fileSize
+            except FileNotFoundError:
+                pass
+    return filesRemoved, bytesRemoved
+
+
+def removeTree(dirPath, dryRun=False):
+    """
+    Deletes a directory and everything in it, without re-resolving the full path of every file like rmtree on older pythons does. A directory that doesn't exist is not an error.
+    Returns the number of files and bytes removed (or that would have been, for a dry run)
+    """
+    try:
+        dirFd = os.open(dirPath, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return 0, 0
+    try:
+        filesRemoved, bytesRemoved = _removeDirContents(dirFd, dryRun)
+    finally:
+        os.close(dirFd)
+    if not dryRun:
+        try:
+            os.rmdir(dirPath)
+        except FileNotFoundError:
+            pass
+    return filesRemoved, bytesRemoved
+
+
+def _purgeRun(frameDir, metadataFiles, dryRun):
+    # The metadata is only removed once the frames are gone, so a failed delete gets retried on the next pass instead of leaving orphaned frames
+    startTime = time.monotonic()
+    filesRemoved, bytesRemoved = removeTree(frameDir, dryRun)
+    for metadataFile in metadataFiles:
+        try:
+            bytesRemoved += os.stat(metadataFile).st_size
+            if not dryRun:
+                remove(metadataFile)
+            filesRemoved += 1
+        except FileNotFoundError:
+            pass
+    return filesRemoved, bytesRemoved, time.monotonic() - startTime
+
+
+def purgeExpiredRuns(expiredRuns, deleteWorkers, cleanupStats, cleanupReport, dryRun=False):
+    """
+    Deletes the frames and then the metadata of expired runs, spread across a pool of threads so that deletes on network filesystems overlap
+    Parameters:
+    ----------
+    expiredRuns: dict of frame directory to {"productID", "metadataFiles", "runNames"}, from findExpiredRuns
+    deleteWorkers: maximum number of runs to delete at once
+    cleanupStats: dict of counters to update
+    cleanupReport: the cleanup report, whose per-product entries are updated with what was reclaimed
+    dryRun: if True, only measure what would be deleted
+    Returns a list of the frame directories that were purged
+
+    """
+    with ThreadPoolExecutor(max_workers=deleteWorkers) as deletePool:
+        purgeFutures = {frameDir : deletePool.submit(_purgeRun, frameDir, expiredRun["metadataFiles"], dryRun) for frameDir, expiredRun in expiredRuns.items()}
+    purgedDirs = list()
+    for frameDir, purgeFuture in purgeFutures.items():
+        productReport = cleanupReport["products"][expiredRuns[frameDir]["productID"]]
+        try:
+            filesRemoved, bytesRemoved, purgeSeconds = purgeFuture.result()
+        except OSError as e:
+            cleanupStats["purgeErrors"] += 1
+            productReport["purgeErrors"] += 1
+            print("Failed to purge "+frameDir+": "+str(e))
+            continue
+        cleanupStats["filesRemoved"] += filesRemoved
+        cleanupStats["bytesRemoved"] += bytesRemoved
+        productReport["filesReclaimed"] += filesRemoved
+        productReport["bytesReclaimed"] += bytesRemoved
+        productReport["seconds"] += purgeSeconds
+        recordSpan("cleanup.purge", purgeSeconds, expiredRuns[frameDir]["productID"])
+        purgedDirs.append(frameDir)
+    return purgedDirs
+
+
+# Images (and gif- temporaries) modified, or metadata frames published, less than this long ago are left alone by the orphan scan, they may belong to a frame that's still being published or synced
+orphanMinAgeSeconds = 3600
+# Paths of each kind of orphan listed in the report, the counts are always complete
+orphanReportLimit = 100
+
+
+def _newOrphanReport():
+    orphanReport = {"seconds" : 0.0, "imageDirsScanned" : 0, "imagesScanned" : 0, "runJsonReads" : 0}
+    for orphanKind in ["temporaryImages", "unreferencedImages", "missingImages"]:
+        orphanReport[orphanKind] = {"count" : 0, "bytes" : 0, "removed" : 0, "examples" : list()}
+    return orphanReport
+
+
+def _recordOrphan(orphanReport, orphanKind, orphanPath, orphanBytes):
+    orphanReport[orphanKind]["count"] += 1
+    orphanReport[orphanKind]["bytes"] += orphanBytes
+    if len(orphanReport[orphanKind]["examples"]) < orphanReportLimit:
+        orphanReport[orphanKind]["examples"].append(orphanPath)
+
+
+def _expectedImages(hdwxRootPath, productRuns, orphanReport):
+    # Reads the frames of every remaining run, returns a dict of image directory to dict of filename to list of (run json path, frame publishTime)
+    expectedImages = dict()
+    for productPath, productMetadataDir, runNames in productRuns.values():
+        for runFileName in runNames:
+            runFilePath = path.join(productMetadataDir, runFileName)
+            try:
+                with open(runFilePath, "r") as jsonRead:
+                    runData = json.load(jsonRead)
+            except (FileNotFoundError, ValueError):
+                continue
+            orphanReport["runJsonReads"] += 1
+            imagesInDir = expectedImages.setdefault(path.normpath(path.join(hdwxRootPath, productPath, runData["pathExtension"])), dict())
+            for frame in runData.get("productFrames", list()):
+                imagesInDir.setdefault(frame["filename"], list()).append((runFilePath, frame["publishTime"]))
+    return expectedImages
+
+
+def _scanImageDir(dirPath, productRoots, expectedImages, oldestMtime, hdwxRootPath, orphanReport, deleteOrphans):
+    # Streams through one image directory and its subdirectories, reporting (and removing) images no run references. Referenced images are popped from expectedImages.
+    # Returns True if the directory was left empty and removed.
+    orphanReport["imageDirsScanned"] += 1
+    imagesInDir = expectedImages.get(dirPath, dict())
+    removedAll = True
+    with scandir(dirPath) as dirEntries:
+        for dirEntry in dirEntries:
+            if dirEntry.is_dir(follow_symlinks=False):
+                # Another product's images can live below this product's productPath, those get scanned from their own root
+                if dirEntry.path in productRoots or not _scanImageDir(dirEntry.path, productRoots, expectedImages, oldestMtime, hdwxRootPath, orphanReport, deleteOrphans):
+                    removedAll = False
+                continue
+            orphanReport["imagesScanned"] += 1
+            if imagesInDir.pop(dirEntry.name, None) is not None:
+                removedAll = False
+                continue
+            try:
+                entryStat = dirEntry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if entryStat.st_mtime > oldestMtime:
+                removedAll = False
+                continue
+            # saveImage renders to gif-<filename> before converting it to the final palette image
+            orphanKind = "temporaryImages" if dirEntry.name.startswith("gif-") else "unreferencedImages"
+            _recordOrphan(orphanReport, orphanKind, path.relpath(dirEntry.path, hdwxRootPath), entryStat.st_size)
+            if deleteOrphans:
+                try:
+                    remove(dirEntry.path)
+                    orphanReport[orphanKind]["removed"] += 1
+                except FileNotFoundError:
+                    pass
+            else:
+                removedAll = False
+    # Run directories left empty by removing their orphans go too, and so do their parents (2001/01/01 date trees) once they're empty, up to the product's root
+    if deleteOrphans and removedAll and dirPath not in productRoots and dirPath not in expectedImages.keys():
+        try:
+            os.rmdir(dirPath)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def _dropMissingFrames(runFilePath, missingFilenames):
+    # Removes frames whose image doesn't exist from a run's json, and the json itself if that leaves it empty
+    with runLock(path.splitext(runFilePath)[0]+".lock"):
+        try:
+            with open(runFilePath, "r") as jsonRead:
+                runData = json.load(jsonRead)
+        except FileNotFoundError:
+            return
+        # The run's publish manifest no longer matches its json, mirrors without one fetch the whole run instead
+        try:
+            remove(path.join(path.dirname(path.dirname(path.dirname(runFilePath))), "manifests", path.basename(path.dirname(runFilePath)), path.basename(runFilePath)))
+        except FileNotFoundError:
+            pass
+        runData["productFrames"] = [frame for frame in runData["productFrames"] if frame["filename"] not in missingFilenames]
+        if len(runData["productFrames"]) == 0:
+            for metadataFile in [runFilePath] + [runFilePath+"."+encoding for encoding in metadataSiblingExtensions]:
+                try:
+                    remove(metadataFile)
+                except FileNotFoundError:
+                    pass
+            return
+        runData["availableFrameCount"] = len(runData["productFrames"])
+        writeMetadataJson(runFilePath, runData)
+
+
+def reconcileOrphans(hdwxRootPath, productRuns, orphanReport, deleteOrphans=False):
+    """
+    Compares the frames listed in run metadata with the images on disk, in one pass over each product's image tree
+    Reports images that no run references (including gif- temporaries left by saveImage), and frames whose image doesn't exist
+    Parameters:
+    ----------
+    hdwxRootPath: the HDWX server root
+    productRuns: dict of productID to (productPath, metadata directory, list of run json names) of every run still on disk
+    orphanReport: dict from _newOrphanReport to update
+    deleteOrphans: if True, remove unreferenced images and drop frames with missing images from their run's json
+
+    """
+    startTime = time.monotonic()
+    oldestMtime = time.time() - orphanMinAgeSeconds
+    oldestPublishTime = (dt.utcnow() - timedelta(seconds=orphanMinAgeSeconds)).strftime("%Y%m%d%H%M")
+    expectedImages = _expectedImages(hdwxRootPath, productRuns, orphanReport)
+    productRoots = set([path.normpath(path.join(hdwxRootPath, productPath)) for productPath, productMetadataDir, runNames in productRuns.values()])
+    for productRoot in sorted(productRoots):
+        if path.isdir(productRoot):
+            _scanImageDir(productRoot, productRoots, expectedImages, oldestMtime, hdwxRootPath, orphanReport, deleteOrphans)
+    # Whatever is left in expectedImages was never found on disk
+    missingByRun = dict()
+    for imageDir, imagesInDir in expectedImages.items():
+        for imageName, referencingRuns in imagesInDir.items():
+            for runFilePath, publishTime in referencingRuns:
+                if publishTime > oldestPublishTime:
+                    continue
+                _recordOrphan(orphanReport, "missingImages", path.relpath(path.join(imageDir, imageName), hdwxRootPath), 0)
+                missingByRun.setdefault(runFilePath, set()).add(imageName)
+    if deleteOrphans:
+        for runFilePath, missingFilenames in missingByRun.items():
+            _dropMissingFrames(runFilePath, missingFilenames)
+            orphanReport["missingImages"]["removed"] += len(missingFilenames)
+    orphanReport["seconds"] = time.monotonic() - startTime
+
+
+# Maximum number of runs deleted at once
+deleteWorkers = 8
+
+# cleanupHDWX.py <purgeAfterHours> <HDWX server root> [<delete workers>] [--dry-run] [--report <report json path>] [--policy <retention policy json path>] [--index <metadata index path>]... [--orphans report|delete]
 if __name__ == "__main__":
+    dryRun = "--dry-run" in sys.argv
+    reportPath = None
+    policyPath = None
+    metadataIndexPaths = list()
+    orphanMode = None
+    positionalArgs = list()
+    argIdx = 1
+    while argIdx < len(sys.argv):
+        if sys.argv[argIdx] == "--report":
+            reportPath = sys.argv[argIdx+1]
+            argIdx += 1
+        elif sys.argv[argIdx] == "--policy":
+            policyPath = sys.argv[argIdx+1]
+            argIdx += 1
+        elif sys.argv[argIdx] == "--index":
+            metadataIndexPaths.append(sys.argv[argIdx+1])
+            argIdx += 1
+        elif sys.argv[argIdx] == "--orphans":
+            orphanMode = sys.argv[argIdx+1]
+            argIdx += 1
+        elif sys.argv[argIdx] != "--dry-run":
+            positionalArgs.append(sys.argv[argIdx])
+        argIdx += 1
     # Get desired time to purge files after from arg 1
-    hoursToPurgeAfter = timedelta(hours=int(sys.argv[1]))
+    hoursToPurgeAfter = timedelta(hours=int(positionalArgs[0]))
     # If hours to purge after is 0 or negative, exit immediately
-    if int(sys.argv[1]) <= 0:
+    if int(positionalArgs[0]) <= 0:
         exit()
+    if len(positionalArgs) > 2:
+        deleteWorkers = int(positionalArgs[2])
+    retentionRules = loadRetentionRules(policyPath)
+    startTime = time.monotonic()
+    cleanupStats = {"productsScanned" : 0, "productDirsListed" : 0, "productDirsFromIndex" : 0, "productsFromMetadataIndex" : 0, "runsScanned" : 0, "runsPurged" : 0, "filesRemoved" : 0, "bytesRemoved" : 0, "purgeErrors" : 0, "productJsonReads" : 0, "runJsonReads" : 0, "runJsonReadsAvoided" : 0}
     # Get current time for comparison
     now = dt.utcnow()
+    cleanupReport = {"startTime" : now.strftime("%Y%m%d%H%M%S"), "dryRun" : dryRun, "purgeAfterHours" : int(positionalArgs[0]), "products" : dict()}
     # Get the supplied path to the HDWX root. This will be the basis for everything we work with.
-    hdwxRootPath = sys.argv[2]
+    hdwxRootPath = positionalArgs[1]
     # Get path to hdwxRootPath/metadata/ This is a surprise tool that will help us later...
     metadataTopDir = path.join(hdwxRootPath, "metadata")
     # If this path exists, clean out any temporary files there
     if path.exists(metadataTopDir):
-        [remove(path.join(metadataTopDir, fileInTopDir)) for fileInTopDir in listdir(metadataTopDir) if fileInTopDir.startswith("tmp") and "." not in fileInTopDir]
+        if not dryRun:
+            [remove(path.join(metadataTopDir, fileInTopDir)) for fileInTopDir in listdir(metadataTopDir) if fileInTopDir.startswith("tmp") and "." not in fileInTopDir]
         # Get path to hdwxRootPath/metadata/products/
         runsMetadataDir = path.join(metadataTopDir, "products")
         # if there's no data, at all, then we don't need to do any cleaning, so to be sure these paths exist first
         if path.exists(runsMetadataDir):
+            previousIndex = loadExpiryIndex(hdwxRootPath)
+            expiryIndex = dict()
+            # Products written by modules with a metadata index are looked up there instead of on disk
+            metadataIndexes = dict()
+            for metadataIndexPath in metadataIndexPaths:
+                metadataIndex = openMetadataIndex(metadataIndexPath)
+                for indexedProductID, indexedProductRuns in indexedRuns(metadataIndex).items():
+                    metadataIndexes[str(indexedProductID)] = (metadataIndex, indexedProductRuns)
             # metadataTopDir contains a subdirectory for each productID
-            for productID in listdir(runsMetadataDir):
-                # Get path to the product's subdir
-                productMetadataDir = path.join(runsMetadataDir, productID)
-                # Each product subdir contains a json file for every run of the product
-                for runFileName in listdir(productMetadataDir):
-                    try:
-                        # The filename of the json file is a time in UTC, formatted as %Y%m%d%H%M, so convert this to a datetime object
-                        runTime = dt.strptime(runFileName, "%Y%m%d%H%M.json")
-                    except:
-                        remove(path.join(productMetadataDir, runFileName))
-                        continue
-                    # The "associated data" is stored in hdwxRootPath+productPath+pathExtension
-                    # First we need the productPath, which can be obtained from hdwxRootPath/metadata/<productID>.json (This is where that "metadataTopDir" comes in)
-                    with open(path.join(metadataTopDir, productID+".json"), "r") as jsonRead:
-                        # Read the json file
-                        productData = json.load(jsonRead)
-                    # For satellite data, we only want to keep half of the purge threshold
-                    if "satellite" in productData["productPath"]:
-                        thresholdTime = now - timedelta(seconds=hoursToPurgeAfter.total_seconds()/2)
+            expiredRuns = dict()
+            productRuns = dict()
+            for productEntry in scandir(runsMetadataDir):
+                if not productEntry.is_dir():
+                    continue
+                productStartTime = time.monotonic()
+                productReport = cleanupReport["products"].setdefault(productEntry.name, _newProductReport())
+                policy = productPolicy(metadataTopDir, productEntry.name, now, hoursToPurgeAfter, retentionRules, cleanupStats)
+                productReport["retentionRules"] = policy["ruleNames"]
+                with timingSpan("cleanup.list", productEntry.name):
+                    if productEntry.name in metadataIndexes.keys():
+                        indexEntry = indexEntryFromMetadataIndex(metadataIndexes[productEntry.name][1])
+                        cleanupStats["productsFromMetadataIndex"] += 1
+                        productReport["listedFromIndex"] = True
                     else:
-                        thresholdTime = now - hoursToPurgeAfter
-                    # If the time older than the purge threshold then we want to purge it and all associated data
-                    if runTime < thresholdTime:
-                        # We want to keep ADRAD data for one year though
-                        if "ADRAD" in productData["productDescription"]:
-                            if runTime > now - timedelta(days=365):
-                                continue
-                        # Now we retrieve the productPath from the freshly read in dict
-                        productPath = productData["productPath"]
-                        # Now we need the pathExtension which can be obtained from the run's json file, in hdwxRootPath/metadata/products/<productID>/<runtime>.json
-                        runFilePath = path.join(productMetadataDir, runFileName) 
-                        with open(runFilePath) as jsonRead:
-                            runData = json.load(jsonRead)
-                        runPathExtension = runData["pathExtension"]
-                        if "gr2a" not in productPath:
-                            # Now we know where the frames for this product are located, and we can purge them!
-                            if path.exists(path.join(hdwxRootPath, productPath, runPathExtension)):
-                                rmtree(path.join(hdwxRootPath, productPath, runPathExtension))
-                            # Also remove the json data
-                            if path.exists(runFilePath):
-                                remove(runFilePath)
+                        indexEntry = listProductRuns(productEntry, previousIndex.get(productEntry.name), cleanupStats, dryRun)
+                        productReport["listedFromIndex"] = indexEntry is previousIndex.get(productEntry.name)
+                productReport["runsScanned"] += len(indexEntry["runs"])
+                runsPurgedBefore = cleanupStats["runsPurged"]
+                with timingSpan("cleanup.findExpired", productEntry.name):
+                    expiredRunNames = findExpiredRuns(hdwxRootPath, productEntry.name, productEntry.path, policy, indexEntry, expiredRuns, cleanupStats, productReport)
+                # A dry run leaves expired runs in place, so their images are still referenced
+                productRuns[productEntry.name] = (policy["productPath"], productEntry.path, indexEntry["runs"] if dryRun else indexEntry["runs"][len(expiredRunNames):])
+                # Purging changes the directory, so a product that had anything expire is listed again next pass
+                if cleanupStats["runsPurged"] == runsPurgedBefore and productEntry.name not in metadataIndexes.keys():
+                    expiryIndex[productEntry.name] = indexEntry
+                productReport["seconds"] += time.monotonic() - productStartTime
+                cleanupStats["productsScanned"] += 1
+            purgedDirs = purgeExpiredRuns(expiredRuns, deleteWorkers, cleanupStats, cleanupReport, dryRun)
+            if not dryRun:
+                saveExpiryIndex(hdwxRootPath, expiryIndex)
+                for purgedDir in purgedDirs:
+                    purgedProductID = expiredRuns[purgedDir]["productID"]
+                    if purgedProductID in metadataIndexes.keys():
+                        removeIndexedRuns(metadataIndexes[purgedProductID][0], int(purgedProductID), [path.splitext(runName)[0] for runName in expiredRuns[purgedDir]["runNames"]])
+            if orphanMode is not None:
+                cleanupReport["orphans"] = _newOrphanReport()
+                with timingSpan("cleanup.orphans"):
+                    reconcileOrphans(hdwxRootPath, productRuns, cleanupReport["orphans"], deleteOrphans=(orphanMode == "delete" and not dryRun))
+                print("Orphans: " + ", ".join([f"{orphanKind} {cleanupReport['orphans'][orphanKind]['count']} ({cleanupReport['orphans'][orphanKind]['removed']} removed)" for orphanKind in ["temporaryImages", "unreferencedImages", "missingImages"]]))
+    cleanupReport["durationSeconds"] = time.monotonic() - startTime
+    recordSpan("cleanup.total", cleanupReport["durationSeconds"])
+    cleanupReport["totals"] = cleanupStats
+    if reportPath is not None:
+        atomicWriteBytes(reportPath, json.dumps(cleanupReport, indent=4).encode())
+    elif dryRun:
+        print(json.dumps(cleanupReport, indent=4))
+    print(f"Cleanup {'dry run ' if dryRun else ''}finished in {cleanupReport['durationSeconds']:.1f} seconds: " + ", ".join([f"{statName} {statValue}" for statName, statValue in cleanupStats.items()]))
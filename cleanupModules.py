@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Runs every submodule's cleanup.py and compacts its run journals, several submodules at once, when the cleanup service stops
+# Created 18 October 2026 by Sam Gardner <stgardner4@tamu.edu>
+
+from os import path, listdir, remove, symlink, killpg, readlink
+from concurrent.futures import ThreadPoolExecutor
+import json
+import signal
+import subprocess
+import sys
+import time
+from HDWX_helpers import atomicWriteBytes
+
+# Submodules cleaned at once
+cleanupWorkers = 4
+# A submodule still cleaning after this long is killed (with everything it started), so one stuck module can't hold up the rest
+moduleTimeoutSeconds = 300
+
+
+def listModules(cloneDir):
+    """
+    Returns the names of every directory in the clone that a submodule could be in, sorted
+    """
+    return [moduleName for moduleName in sorted(listdir(cloneDir)) if path.isdir(path.join(cloneDir, moduleName)) and not moduleName.startswith(".") and moduleName != "__pycache__"]
+
+
+def linkHelpers(modulePath):
+    """
+    Points modulePath/HDWX_helpers.py at the clone's copy, replacing a copy left there by older versions of HDWX, so that the submodule's scripts always import the current helpers
+    Returns True if the link had to be (re)made
+    """
+    helpersPath = path.join(modulePath, "HDWX_helpers.py")
+    sharedHelpers = path.join("..", "HDWX_helpers.py")
+    if path.islink(helpersPath) and readlink(helpersPath) == sharedHelpers:
+        return False
+    if path.lexists(helpersPath):
+        remove(helpersPath)
+    symlink(sharedHelpers, helpersPath)
+    return True
+
+
+def _runStep(stepArgs, modulePath, deadline):
+    # Runs one step in modulePath in its own process group, killing the whole group if the module's deadline passes. Returns (exit code or None if it timed out, output)
+    stepProcess = subprocess.Popen(stepArgs, cwd=modulePath, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        stepOutput, _ = stepProcess.communicate(timeout=max(0, deadline - time.monotonic()))
+        return stepProcess.returncode, stepOutput.decode(errors="replace")
+    except subprocess.TimeoutExpired:
+        try:
+            killpg(stepProcess.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        stepOutput, _ = stepProcess.communicate()
+        return None, stepOutput.decode(errors="replace")
+
+
+def cleanModule(cloneDir, moduleName, timeoutSeconds=None):
+    """
+    Cleans one submodule: links it to the shared HDWX_helpers, runs its cleanup.py (if it has one), and compacts its run journals (if it has any)
+    Parameters:
+    ----------
+    cloneDir: the hdwx-operational clone
+    moduleName: the submodule's directory name
+    timeoutSeconds: time allowed for the whole submodule, defaults to moduleTimeoutSeconds
+    Returns a dict of "module", "exitCode" (the first failing step's, None if it timed out), "timedOut", "seconds", "steps" (names of the steps that ran), and "output"
+
+    """
+    startTime = time.monotonic()
+    deadline = startTime + (moduleTimeoutSeconds if timeoutSeconds is None else timeoutSeconds)
+    modulePath = path.join(cloneDir, moduleName)
+    moduleResult = {"module" : moduleName, "exitCode" : 0, "timedOut" : False, "seconds" : 0.0, "steps" : list(), "output" : ""}
+    try:
+        linkHelpers(modulePath)
+    except OSError as e:
+        moduleResult["exitCode"] = 1
+        moduleResult["output"] = "Couldn't link HDWX_helpers.py: "+str(e)+"\n"
+    moduleSteps = list()
+    if path.exists(path.join(modulePath, "cleanup.py")):
+        moduleSteps.append(("cleanup", [sys.executable, "cleanup.py"]))
+    # Journals abandoned by a writer that died before compacting, see HDWX_helpers.compactAllJournals. Runs even if cleanup.py failed, like it always has.
+    if path.isdir(path.join(modulePath, "journal")):
+        moduleSteps.append(("compactJournals", [sys.executable, "-c", "import HDWX_helpers; HDWX_helpers.compactAllJournals('.')"]))
+    for stepName, stepArgs in moduleSteps:
+        if moduleResult["timedOut"]:
+            break
+        moduleResult["steps"].append(stepName)
+        exitCode, stepOutput = _runStep(stepArgs, modulePath, deadline)
+        moduleResult["output"] += stepOutput
+        if exitCode is None:
+            moduleResult["timedOut"] = True
+            moduleResult["exitCode"] = None
+        elif exitCode != 0 and moduleResult["exitCode"] == 0:
+            moduleResult["exitCode"] = exitCode
+    moduleResult["seconds"] = time.monotonic() - startTime
+    return moduleResult
+
+
+def cleanModules(cloneDir, workers=None, timeoutSeconds=None):
+    """
+    Cleans every submodule of the clone, up to workers (default cleanupWorkers) at once, printing each one's output as it finishes
+    Returns the list of cleanModule results, in module order
+
+    """
+    moduleNames = listModules(cloneDir)
+    with ThreadPoolExecutor(max_workers=(cleanupWorkers if workers is None else workers)) as cleanupPool:
+        moduleFutures = [cleanupPool.submit(cleanModule, cloneDir, moduleName, timeoutSeconds) for moduleName in moduleNames]
+        moduleResults = list()
+        for moduleFuture in moduleFutures:
+            moduleResult = moduleFuture.result()
+            # Each module's output is printed in one piece, so modules cleaning at the same time don't interleave in the journal
+            for outputLine in moduleResult["output"].splitlines():
+                print(moduleResult["module"]+": "+outputLine)
+            if moduleResult["timedOut"]:
+                status = "timed out"
+            elif moduleResult["exitCode"] != 0:
+                status = "failed with exit code "+str(moduleResult["exitCode"])
+            else:
+                status = "done"
+            print(f"{moduleResult['module']}: {status} in {moduleResult['seconds']:.1f} seconds" + ("" if len(moduleResult["steps"]) > 0 else ", nothing to clean"))
+            sys.stdout.flush()
+            moduleResults.append(moduleResult)
+    return moduleResults
+
+
+# cleanupModules.py [<workers>] [--timeout <seconds per module>] [--report <report json path>]
+# Exits with 1 if any submodule failed or timed out
+if __name__ == "__main__":
+    workers = None
+    timeoutSeconds = None
+    reportPath = None
+    argIdx = 1
+    while argIdx < len(sys.argv):
+        if sys.argv[argIdx] == "--timeout":
+            timeoutSeconds = float(sys.argv[argIdx+1])
+            argIdx += 1
+        elif sys.argv[argIdx] == "--report":
+            reportPath = sys.argv[argIdx+1]
+            argIdx += 1
+        else:
+            workers = int(sys.argv[argIdx])
+        argIdx += 1
+    cloneDir = path.dirname(path.abspath(__file__))
+    startTime = time.monotonic()
+    moduleResults = cleanModules(cloneDir, workers, timeoutSeconds)
+    failedModules = [moduleResult["module"] for moduleResult in moduleResults if moduleResult["exitCode"] != 0]
+    print(f"Cleaned {len(moduleResults)} submodules in {time.monotonic() - startTime:.1f} seconds" + (", failed: "+", ".join(failedModules) if len(failedModules) > 0 else ""))
+    if reportPath is not None:
+        atomicWriteBytes(reportPath, json.dumps({"seconds" : time.monotonic() - startTime, "modules" : moduleResults}, indent=4).encode())
+    if len(failedModules) > 0:
+        exit(1)
@@ -113,8 +113,11 @@ if __name__ == "__main__":
                 cleanupFileContents = f.read()
             with open("hdwx_productTypeManagement.service.template", "r") as f:
                 productTypeManagementFileContents = f.read()
+            with open("hdwx_renderWorker.service.template", "r") as f:
+                renderWorkerFileContents = f.read()
             print("Installing HDWX services...")
             installServiceFile("hdwx.target", targetFileContents, destDir, pathToPython, cloneDir, timeToPurge, myUsername, shouldGIS)
+            installServiceFile("hdwx_renderWorker.service", renderWorkerFileContents, destDir, pathToPython, cloneDir, timeToPurge, myUsername, shouldGIS)
             if remoteInstall == False:
                 installServiceFile("hdwx_cleanup.service", cleanupFileContents, destDir, pathToPython, cloneDir, timeToPurge, myUsername, shouldGIS)
                 installServiceFile("hdwx_productTypeManagement.service", productTypeManagementFileContents, destDir, pathToPython, cloneDir, timeToPurge, myUsername, shouldGIS)
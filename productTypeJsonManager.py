@@ -2,34 +2,294 @@
 # Combines product metadata of the same productType distributed across different submodules
 # Created 10 Janurary 2022 by Sam Gardner <stgardner4@tamu.edu>
 
-from os import path, listdir, chmod
+from os import path, listdir, scandir, read, fsencode
+import ctypes
+import ctypes.util
+import hashlib
 import json
+import select
+import struct
 import sys
+import time
 from pathlib import Path
+from HDWX_helpers import productTypeRegistry, metadataOutput, writeMetadataJson, atomicWriteBytes, metadataIndexName, openMetadataIndex, indexedProductTypes, timingSpan
 
+# Remembers the mtime, size, and hash of every submodule's productType json from the last merge, so that unchanged productTypes aren't rebuilt
+stateFileName = ".productTypeJsonManager-state.json"
+
+
+def _indexedProductTypes(basePath, productMod):
+    # productType json name to list of products, from a submodule's metadata index, or None if the submodule doesn't have one
+    indexPath = path.join(basePath, productMod, metadataIndexName)
+    if not path.exists(indexPath):
+        return None
+    return {str(productTypeID)+".json" : products for productTypeID, products in indexedProductTypes(openMetadataIndex(indexPath)).items()}
+
+
+def scanSources(basePath, previousSources):
+    """
+    Finds every submodule's productType json and fingerprints it, re-hashing only files whose mtime or size changed since the last scan
+    Submodules with a metadata index (HDWX_METADATA_INDEX) are queried instead, and fingerprinted by the products they contain
+    Parameters:
+    ----------
+    basePath: the hdwx-operational clone
+    previousSources: the "sources" dict of the previous state
+    Returns a dict of "<submodule>/<productType json>" to {"mtime", "size", "sha256"}, in merge order
+
+    """
+    sources = dict()
+    productModules = [productModule for productModule in sorted(listdir(basePath)) if path.isdir(path.join(basePath, productModule)) and productModule != ".git"]
+    for productMod in productModules:
+        indexedTypes = _indexedProductTypes(basePath, productMod)
+        if indexedTypes is not None:
+            for jsonName, products in sorted(indexedTypes.items()):
+                sources[productMod+"/"+jsonName] = {"mtime" : None, "size" : None, "sha256" : hashlib.sha256(json.dumps(products).encode()).hexdigest()}
+            continue
+        prodProductTypesDir = path.join(basePath, productMod, "output", "metadata", "productTypes")
+        if not path.exists(prodProductTypesDir):
+            continue
+        for jsonEntry in sorted(scandir(prodProductTypesDir), key=lambda entry: entry.name):
+            if not jsonEntry.name.endswith(".json"):
+                continue
+            sourceKey = productMod+"/"+jsonEntry.name
+            jsonStat = jsonEntry.stat()
+            previousSource = previousSources.get(sourceKey)
+            if previousSource is not None and previousSource["mtime"] == jsonStat.st_mtime_ns and previousSource["size"] == jsonStat.st_size:
+                sources[sourceKey] = previousSource
+                continue
+            with open(jsonEntry.path, "rb") as jsonRead:
+                sourceHash = hashlib.sha256(jsonRead.read()).hexdigest()
+            sources[sourceKey] = {"mtime" : jsonStat.st_mtime_ns, "size" : jsonStat.st_size, "sha256" : sourceHash}
+    return sources
+
+
+def _sourcesByProductType(sources):
+    # Groups source fingerprints by productType json name, keeping merge order
+    productTypeSources = dict()
+    for sourceKey, source in sources.items():
+        productTypeSources.setdefault(sourceKey.split("/")[-1], list()).append([sourceKey, source["sha256"]])
+    return productTypeSources
+
+
+def _outputSettings():
+    # Anything other than the sources that changes the merged output, a change here rebuilds every productType
+    return hashlib.sha256(json.dumps([sorted(productTypeRegistry.items()), metadataOutput], sort_keys=True).encode()).hexdigest()
+
+
+def mergeProductType(basePath, sourceKeys):
+    """
+    Merges the products of every submodule's copy of one productType json
+    Parameters:
+    ----------
+    basePath: the hdwx-operational clone
+    sourceKeys: "<submodule>/<productType json>" of each copy, in merge order
+
+    """
+    mergedProductType = None
+    for sourceKey in sourceKeys:
+        productMod, jsonFile = sourceKey.split("/")
+        indexedTypes = _indexedProductTypes(basePath, productMod)
+        if indexedTypes is not None:
+            productTypeID = int(path.splitext(jsonFile)[0])
+            jsonForProdType = {"productTypeID" : productTypeID, "productTypeDescription" : productTypeRegistry[productTypeID].productTypeDescription, "products" : indexedTypes.get(jsonFile, list())}
+        else:
+            with open(path.join(basePath, productMod, "output", "metadata", "productTypes", jsonFile), "r") as jsonRead:
+                jsonForProdType = json.load(jsonRead)
+        if mergedProductType is None:
+            mergedProductType = jsonForProdType
+        else:
+            [mergedProductType["products"].append(product) for product in jsonForProdType["products"]]
+    # Use the shared registry's description so that submodules with an outdated copy of HDWX_helpers can't rename a productType
+    if mergedProductType["productTypeID"] in productTypeRegistry.keys():
+        mergedProductType["productTypeDescription"] = productTypeRegistry[mergedProductType["productTypeID"]].productTypeDescription
+    return mergedProductType
+
+
+def updateProductTypes(basePath, targetDir, state):
+    """
+    Rebuilds the merged productType json in targetDir for every productType whose sources changed since the previous call
+    Parameters:
+    ----------
+    basePath: the hdwx-operational clone
+    targetDir: the HDWX server root
+    state: the state dict returned by the previous call (or loaded from the state file), an empty dict to rebuild everything
+    Returns (the new state, list of productType json names that were rewritten)
+
+    """
+    with timingSpan("productTypes.scan"):
+        sources = scanSources(basePath, state.get("sources", dict()))
+    productTypeSources = _sourcesByProductType(sources)
+    previousProductTypeSources = _sourcesByProductType(state.get("sources", dict()))
+    outputSettings = _outputSettings()
+    masterProductTypesDir = path.join(targetDir, "metadata", "productTypes")
+    Path(masterProductTypesDir).mkdir(parents=True, exist_ok=True)
+    rewrittenProductTypes = list()
+    for jsonName, sourceFingerprints in productTypeSources.items():
+        masterJsonPath = path.join(masterProductTypesDir, jsonName)
+        if sourceFingerprints == previousProductTypeSources.get(jsonName) and outputSettings == state.get("outputSettings") and path.exists(masterJsonPath):
+            continue
+        with timingSpan("productTypes.merge"):
+            mergedProductType = mergeProductType(basePath, [sourceKey for sourceKey, sourceHash in sourceFingerprints])
+        with timingSpan("productTypes.write"):
+            if writeMetadataJson(masterJsonPath, mergedProductType, skipUnchanged=True):
+                rewrittenProductTypes.append(jsonName)
+    return {"outputSettings" : outputSettings, "sources" : sources}, rewrittenProductTypes
+
+
+def loadState(basePath):
+    statePath = path.join(basePath, stateFileName)
+    if path.exists(statePath):
+        try:
+            with open(statePath, "r") as jsonRead:
+                return json.load(jsonRead)
+        except ValueError:
+            pass
+    return dict()
+
+
+def saveState(basePath, state):
+    atomicWriteBytes(path.join(basePath, stateFileName), json.dumps(state).encode(), skipUnchanged=True)
+
+
+# Daemon mode: merge within maxDelaySeconds of a change, once changes have been quiet for debounceSeconds. Without inotify, fall back to polling every pollSeconds.
+debounceSeconds = 0.25
+maxDelaySeconds = 1
+rescanSeconds = 60
+pollSeconds = 5
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_inotifyEventHeader = struct.Struct("iIII")
+
+
+def _openInotify():
+    # Returns the inotify state dict, or None if inotify isn't available (not Linux)
+    libcName = ctypes.util.find_library("c")
+    if libcName is None:
+        return None
+    libc = ctypes.CDLL(libcName, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    inotifyFd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if inotifyFd < 0:
+        return None
+    return {"libc" : libc, "fd" : inotifyFd, "watches" : dict()}
+
+
+# Directories from a submodule down to its productTypes directory. Each one is watched as soon as it exists, so that a submodule's first productType json is seen right away.
+productTypesDirPath = ["output", "metadata", "productTypes"]
+
+
+def _onProductTypesPath(basePath, dirPath):
+    # Whether dirPath is a submodule, or a directory between a submodule and its productTypes directory (or that directory itself)
+    dirParts = path.relpath(dirPath, basePath).split(path.sep)
+    return dirParts[0] not in [".", "..", ".git"] and dirParts[1:] == productTypesDirPath[:len(dirParts)-1]
+
+
+def _updateWatches(inotifyState, basePath):
+    # Watches the clone (for new submodules), and every submodule along with whichever of the directories down to its productTypes directory currently exist
+    watchedDirs = [basePath]
+    for productMod in sorted(listdir(basePath)):
+        if productMod == ".git":
+            continue
+        for dirDepth in range(len(productTypesDirPath)+1):
+            watchedDirs.append(path.join(basePath, productMod, *productTypesDirPath[:dirDepth]))
+    for watchedDir in watchedDirs:
+        if watchedDir in inotifyState["watches"].values() or not path.isdir(watchedDir):
+            continue
+        watchDescriptor = inotifyState["libc"].inotify_add_watch(inotifyState["fd"], fsencode(watchedDir), IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+        if watchDescriptor >= 0:
+            inotifyState["watches"][watchDescriptor] = watchedDir
+    # The kernel drops watches on directories that were removed, so forget those too
+    for watchDescriptor, watchedDir in list(inotifyState["watches"].items()):
+        if not path.isdir(watchedDir):
+            del inotifyState["watches"][watchDescriptor]
+
+
+def _readInotifyEvents(inotifyState, basePath):
+    # Drains pending events, returns True if any of them could change a merged productType
+    relevantChange = False
+    while True:
+        try:
+            eventBuffer = read(inotifyState["fd"], 65536)
+        except BlockingIOError:
+            return relevantChange
+        offset = 0
+        while offset < len(eventBuffer):
+            watchDescriptor, eventMask, eventCookie, nameLength = _inotifyEventHeader.unpack_from(eventBuffer, offset)
+            eventName = eventBuffer[offset+_inotifyEventHeader.size:offset+_inotifyEventHeader.size+nameLength].rstrip(b"\0").decode(errors="replace")
+            offset += _inotifyEventHeader.size + nameLength
+            watchedDir = inotifyState["watches"].get(watchDescriptor)
+            if eventMask & IN_Q_OVERFLOW:
+                relevantChange = True
+            elif eventMask & IN_ISDIR:
+                # A submodule, or a directory on the way to its productTypes directory, was added or removed. The merge this triggers watches it first.
+                if watchedDir is not None and _onProductTypesPath(basePath, path.join(watchedDir, eventName)):
+                    relevantChange = True
+            elif watchedDir is not None and path.basename(watchedDir) == productTypesDirPath[-1] and eventName.endswith(".json"):
+                relevantChange = True
+
+
+def runDaemon(basePath, targetDir):
+    """
+    Keeps the merged productType json in targetDir up to date, merging within about a second of a submodule writing its productType json
+    Parameters:
+    ----------
+    basePath: the hdwx-operational clone
+    targetDir: the HDWX server root
+
+    """
+    state = loadState(basePath)
+    inotifyState = _openInotify()
+    if inotifyState is None:
+        print("inotify is not available, polling for productType changes every "+str(pollSeconds)+" seconds")
+    fullRescanInterval = rescanSeconds if inotifyState is not None else pollSeconds
+    lastMerge = float("-inf")
+    firstChange = None
+    lastChange = None
+    while True:
+        now = time.monotonic()
+        if now - lastMerge >= fullRescanInterval or (firstChange is not None and (now - lastChange >= debounceSeconds or now - firstChange >= maxDelaySeconds)):
+            if inotifyState is not None:
+                _updateWatches(inotifyState, basePath)
+            try:
+                state, rewrittenProductTypes = updateProductTypes(basePath, targetDir, state)
+                saveState(basePath, state)
+            except (OSError, ValueError) as e:
+                # Usually a submodule's json disappearing mid-scan, the next change or rescan will retry
+                print("Failed to merge productTypes: "+str(e))
+            lastMerge = time.monotonic()
+            firstChange = None
+            lastChange = None
+            continue
+        wakeTime = lastMerge + fullRescanInterval
+        if firstChange is not None:
+            wakeTime = min(wakeTime, lastChange + debounceSeconds, firstChange + maxDelaySeconds)
+        if inotifyState is None:
+            time.sleep(max(0, wakeTime - now))
+            continue
+        readable, _, _ = select.select([inotifyState["fd"]], [], [], max(0, wakeTime - now))
+        if readable and _readInotifyEvents(inotifyState, basePath):
+            lastChange = time.monotonic()
+            if firstChange is None:
+                firstChange = lastChange
+
+
+# productTypeJsonManager.py <HDWX server root> [--daemon]
 if __name__ == '__main__':
     targetDir = sys.argv[1]
     if "@" in targetDir:
         exit()
     basePath = path.realpath(path.dirname(__file__))
-    productModules = list()
-    [productModules.append(productModule) for productModule in sorted(listdir(basePath)) if path.isdir(path.join(basePath, productModule)) and productModule != ".git"]
-    productTypes = dict()
-    for productMod in productModules:
-        prodProductTypesDir = path.join(basePath, productMod, "output", "metadata", "productTypes")
-        if path.exists(prodProductTypesDir):
-            for jsonFile in sorted(listdir(prodProductTypesDir)):
-                if ".json" in jsonFile:
-                    with open(path.join(prodProductTypesDir, jsonFile), "r") as jsonRead:
-                        jsonForProdType = json.load(jsonRead)
-                    if jsonFile in productTypes.keys():
-                        prevProdTypeJson = productTypes[jsonFile]
-                        [prevProdTypeJson["products"].append(product) for product in jsonForProdType["products"]]
-                    else:
-                        productTypes[jsonFile] = jsonForProdType
-    masterProductTypesDir = path.join(targetDir, "metadata", "productTypes")
-    Path(masterProductTypesDir).mkdir(parents=True, exist_ok=True)
-    for jsonName in productTypes.keys():
-        with open(path.join(masterProductTypesDir, jsonName), "w") as jsonWrite:
-            json.dump(productTypes[jsonName], jsonWrite, indent=4)
-        chmod(path.join(masterProductTypesDir, jsonName), 0o644)
+    if "--daemon" in sys.argv[2:]:
+        runDaemon(basePath, targetDir)
+    else:
+        state, rewrittenProductTypes = updateProductTypes(basePath, targetDir, loadState(basePath))
+        saveState(basePath, state)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Warm render worker for python-based HDWX: keeps matplotlib, cartopy, and friends imported so plotting scripts don't pay for it on every run
+# Created 18 October 2026 by Sam Gardner <stgardner4@tamu.edu>
+
+from os import path, chdir, remove, umask, environ, cpu_count
+import atexit
+import json
+import runpy
+import signal
+import socket
+import socketserver
+import sys
+import time
+import traceback
+
+# The worker listens here, so that every submodule's client finds the same worker
+socketPath = environ.get("HDWX_RENDER_SOCKET", path.join(path.abspath(path.dirname(__file__)), ".renderWorker.sock"))
+# Jobs running at once, each in its own process forked from the warm worker. More jobs wait for a free slot.
+maxJobs = int(environ.get("HDWX_RENDER_WORKERS", str(cpu_count() or 1)))
+# A job still running after this long is killed, so a hung plot can't hold a slot forever
+jobTimeoutSeconds = 3600
+# Imported once by the worker. Anything that isn't installed is skipped.
+preloadModules = ["numpy", "matplotlib.pyplot", "PIL.Image", "xarray", "pandas", "cartopy.crs", "cartopy.feature", "metpy.calc", "metpy.plots", "pyart"]
+
+
+def jobEnviron(environment):
+    """
+    Returns the HDWX_* variables of environment that configure a job, leaving out the worker's own HDWX_RENDER_* settings
+    """
+    return {name : value for name, value in environment.items() if name.startswith("HDWX_") and not name.startswith("HDWX_RENDER_")}
+
+
+def runJob(job):
+    """
+    Runs a plotting script as if it were started with "python3 <script> <argv...>" from job["cwd"], in this process
+    Parameters:
+    ----------
+    job: {"script" : path to the script, "argv" : list of arguments, "cwd" : directory to run the script from, "environ" : (optional) the submitting service's jobEnviron}
+    Returns {"exitCode", "seconds", "error"}, where error is the traceback of an uncaught exception, or None
+
+    """
+    startTime = time.monotonic()
+    # The script sees its service's HDWX_* variables instead of the worker's. HDWX_helpers reads them when it's imported, so if they differ, the script imports it again.
+    if "environ" in job.keys() and job["environ"] != jobEnviron(environ):
+        [environ.pop(name) for name in jobEnviron(environ).keys()]
+        environ.update(job["environ"])
+        sys.modules.pop("HDWX_helpers", None)
+    chdir(job["cwd"])
+    scriptPath = path.abspath(job["script"])
+    sys.argv = [job["script"]] + list(job["argv"])
+    # Like the interpreter would, so the script can import the other modules of its submodule
+    sys.path[0] = path.dirname(scriptPath)
+    exitCode = 0
+    error = None
+    try:
+        runpy.run_path(scriptPath, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exitCode = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exitCode = 1
+    except BaseException:
+        error = traceback.format_exc()
+        print(error, file=sys.stderr)
+        exitCode = 1
+    # Everything a normal exit would do, such as HDWX_helpers writing images still in its background encoding pool
+    try:
+        atexit._run_exitfuncs()
+    except BaseException:
+        error = traceback.format_exc() if error is None else error
+        exitCode = exitCode or 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return {"exitCode" : exitCode, "seconds" : time.monotonic() - startTime, "error" : error}
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    # Runs in the forked process: reads one job, runs it, and replies with the result
+    def handle(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.alarm(jobTimeoutSeconds)
+        jobLine = self.rfile.readline()
+        # submitJob connects without sending a job to check whether a worker is listening
+        if len(jobLine) == 0:
+            return
+        result = runJob(json.loads(jobLine))
+        self.wfile.write((json.dumps(result)+"\n").encode())
+
+
+class _RenderServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    max_children = maxJobs
+    request_queue_size = 128
+
+
+def warmUp():
+    # Imports preloadModules and renders a branded frame, so fonts, the Agg renderer, and the logo are ready before the first job
+    import importlib
+    import matplotlib
+    matplotlib.use("agg")
+    for moduleName in preloadModules:
+        try:
+            importlib.import_module(moduleName)
+        except ImportError:
+            print("Not preloading "+moduleName+", it isn't installed")
+    import HDWX_helpers
+    from datetime import datetime as dt
+    from matplotlib import pyplot as plt
+    fig = plt.figure()
+    ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
+    HDWX_helpers.dressImage(fig, ax, "Warm up", dt(2000, 1, 1), colorbarLabel="Warm up")
+    HDWX_helpers._renderRGB(fig, False, None)
+    plt.close(fig)
+
+
+def serve():
+    """
+    Warms up and runs plotting jobs sent to socketPath until stopped
+    """
+    # A worker that's already listening owns the socket, one that died left a stale socket file behind
+    if submitJob(None) is not None:
+        print("A render worker is already listening on "+socketPath)
+        exit(1)
+    if path.exists(socketPath):
+        remove(socketPath)
+    warmUp()
+    # Only this user can submit jobs, which run as this user
+    previousUmask = umask(0o177)
+    try:
+        renderServer = _RenderServer(socketPath, _JobHandler)
+    finally:
+        umask(previousUmask)
+    # Stopping the service removes the socket, so clients run their scripts themselves instead of trying to connect
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Render worker ready on "+socketPath+", running up to "+str(maxJobs)+" jobs at once")
+    sys.stdout.flush()
+    try:
+        renderServer.serve_forever()
+    finally:
+        renderServer.server_close()
+        if path.exists(socketPath):
+            remove(socketPath)
+
+
+def submitJob(script, argv=(), cwd=None):
+    """
+    Runs a plotting script on the render worker and waits for it to finish
+    Parameters:
+    ----------
+    script: path to the script, relative to cwd. None only checks whether a worker is listening.
+    argv: the script's arguments
+    cwd: directory to run the script from, defaults to the current directory
+    The script runs with this process's HDWX_* environment variables (see jobEnviron)
+    Returns the job's result (see runJob), or None if no worker is listening
+
+    """
+    jobSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        jobSocket.connect(socketPath)
+    except OSError:
+        jobSocket.close()
+        return None
+    with jobSocket, jobSocket.makefile("rwb") as jobStream:
+        if script is None:
+            return dict()
+        jobStream.write((json.dumps({"script" : script, "argv" : [str(arg) for arg in argv], "cwd" : path.abspath(cwd or "."), "environ" : jobEnviron(environ)})+"\n").encode())
+        jobStream.flush()
+        resultLine = jobStream.readline()
+    if len(resultLine) == 0:
+        # The job's process died without replying, usually the job timeout
+        return {"exitCode" : 1, "seconds" : None, "error" : "The render worker's job process exited without a result"}
+    return json.loads(resultLine)
+
+
+# renderWorker.py --serve
+# renderWorker.py <script> [<script arguments>...]  (from the directory the script should run in, runs the script itself if no worker is listening)
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--serve"]:
+        serve()
+    else:
+        jobResult = submitJob(sys.argv[1], sys.argv[2:])
+        if jobResult is None:
+            jobResult = runJob({"script" : sys.argv[1], "argv" : sys.argv[2:], "cwd" : "."})
+        elif jobResult["error"] is not None:
+            # The job's output went to the worker's log, but the calling service should show why it failed too
+            print(jobResult["error"], file=sys.stderr)
+        exit(jobResult["exitCode"])
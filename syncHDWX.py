@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# Ships a module's output to the HDWX server root, sending only the files writeJson recorded as changed instead of rescanning the whole output tree
+# Created 18 October 2026 by Sam Gardner <stgardner4@tamu.edu>
+
+from os import path, listdir, remove, replace, stat, utime, walk
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+import fcntl
+import json
+import shutil
+import subprocess
+import sys
+import time
+from HDWX_helpers import syncLogEnabled, syncLogPath, atomicWriteBytes, runLock, timingSpan, fileDigest
+
+# Changed images are shipped this many at a time, a batch that fails is retried (with everything after it) on the next pass
+batchSize = 500
+# Daemon mode: ship changes every intervalSeconds
+intervalSeconds = 5
+# Everything in output/ is compared with the target this often, catching files written without being recorded (or by a module without HDWX_SYNC_LOG)
+reconcileSeconds = 3600
+# Same flags the services used to rsync output/ with. A module's productTypes/ json only has its own products, the merged copy on the server belongs to productTypeJsonManager.py.
+rsyncFlags = ["-ulrH", "--exclude=productTypes/", "--exclude=*.tmp"]
+# Everything under these (relative to output/) is metadata, shipped only after the images it references. Publish manifests go before the rest of it.
+metadataPrefix = "metadata/"
+manifestPrefix = "metadata/manifests/"
+
+
+def _isRemote(targetDir):
+    # Same rule as install.py, user@host:/path targets are shipped over ssh
+    return "@" in targetDir
+
+
+def _isExcluded(relativePath):
+    # Whether rsyncFlags' --exclude rules leave a path relative to output/ out, for local targets
+    return "productTypes" in relativePath.split("/")[:-1] or relativePath.endswith(".tmp")
+
+
+def claimChangedPaths(modulePath):
+    """
+    Takes the module's changed path log, so that writers start a new one, and returns every path claimed but not yet shipped
+    Parameters:
+    ----------
+    modulePath: the path of the module
+    Returns (list of claimed log files, list of unique paths relative to output/, oldest first)
+
+    """
+    logPath = syncLogPath(modulePath)
+    claimedDir = path.join(path.dirname(logPath), "claimed")
+    Path(claimedDir).mkdir(parents=True, exist_ok=True)
+    if path.exists(logPath):
+        with open(logPath, "a") as logLock:
+            # Writers append while holding this lock and check the log hasn't been renamed first, see HDWX_helpers.recordChangedPaths
+            fcntl.flock(logLock, fcntl.LOCK_EX)
+            replace(logPath, path.join(claimedDir, str(time.time_ns())+".log"))
+    claimedLogs = sorted([path.join(claimedDir, claimedName) for claimedName in listdir(claimedDir) if claimedName.endswith(".log")])
+    changedPaths = dict()
+    for claimedLog in claimedLogs:
+        with open(claimedLog, "r") as logRead:
+            for logLine in logRead:
+                if logLine.endswith("\n"):
+                    # A file written again is shipped once, in the position of its latest write
+                    changedPaths.pop(logLine[:-1], None)
+                    changedPaths[logLine[:-1]] = None
+    return claimedLogs, list(changedPaths.keys())
+
+
+def _copyToTemporary(sourcePath, destPath, sourceStat):
+    # Copies sourcePath to a temporary file next to destPath with the same mode and mtime, returns the temporary file's path
+    Path(path.dirname(destPath)).mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile(dir=path.dirname(destPath), delete=False) as tmpWrite:
+        try:
+            with open(sourcePath, "rb") as sourceRead:
+                shutil.copyfileobj(sourceRead, tmpWrite)
+            tmpWrite.flush()
+            shutil.copymode(sourcePath, tmpWrite.name)
+            utime(tmpWrite.name, ns=(sourceStat.st_atime_ns, sourceStat.st_mtime_ns))
+        except BaseException:
+            remove(tmpWrite.name)
+            raise
+    return tmpWrite.name
+
+
+def _shipLocal(outputDir, targetDir, relativePaths, syncStats, knownDigests, delayUpdates=False):
+    # Copies each file unless the target's copy is newer, or the same age and size (like rsync -u), or has the hash its publish manifest lists.
+    # Files are renamed into place, so the web server never serves a partial file. With delayUpdates, nothing is renamed until every file has been copied.
+    stagedFiles = list()
+    try:
+        for relativePath in relativePaths:
+            sourcePath = path.join(outputDir, relativePath)
+            destPath = path.join(targetDir, relativePath)
+            try:
+                sourceStat = stat(sourcePath)
+            except FileNotFoundError:
+                # Already removed by cleanup
+                syncStats["missing"] += 1
+                continue
+            try:
+                destStat = stat(destPath)
+                if destStat.st_mtime_ns > sourceStat.st_mtime_ns or (destStat.st_mtime_ns == sourceStat.st_mtime_ns and destStat.st_size == sourceStat.st_size):
+                    syncStats["skipped"] += 1
+                    continue
+                # A frame that was published again with identical contents only gets its mtime updated
+                if relativePath in knownDigests.keys() and destStat.st_size == sourceStat.st_size and fileDigest(destPath) == knownDigests[relativePath]:
+                    utime(destPath, ns=(sourceStat.st_atime_ns, sourceStat.st_mtime_ns))
+                    syncStats["unchangedByHash"] += 1
+                    continue
+            except FileNotFoundError:
+                pass
+            tmpPath = _copyToTemporary(sourcePath, destPath, sourceStat)
+            if delayUpdates:
+                stagedFiles.append((tmpPath, destPath))
+            else:
+                replace(tmpPath, destPath)
+            syncStats["shipped"] += 1
+            syncStats["bytes"] += sourceStat.st_size
+        while len(stagedFiles) > 0:
+            tmpPath, destPath = stagedFiles[0]
+            replace(tmpPath, destPath)
+            stagedFiles.pop(0)
+    finally:
+        for tmpPath, destPath in stagedFiles:
+            remove(tmpPath)
+
+
+def _rsync(rsyncArgs, filesFrom=None):
+    rsyncResult = subprocess.run(["rsync"] + rsyncFlags + rsyncArgs, input=filesFrom)
+    # 24 is files that vanished during the transfer, which cleanup does
+    if rsyncResult.returncode not in [0, 24]:
+        raise OSError(f"rsync exited with {rsyncResult.returncode}")
+
+
+def _shipRemote(outputDir, targetDir, relativePaths, syncStats, delayUpdates=False):
+    # rsync only the listed files over ssh. Files removed since they were recorded would fail the whole transfer (exit code 23), so they're left out.
+    # --delay-updates keeps every file in a temporary directory until all of them have been transferred, and then renames them into place together.
+    existingPaths = [relativePath for relativePath in relativePaths if path.exists(path.join(outputDir, relativePath))]
+    syncStats["missing"] += len(relativePaths) - len(existingPaths)
+    _rsync((["--delay-updates"] if delayUpdates else []) + ["--files-from=-", outputDir+"/", targetDir], "\n".join(existingPaths).encode())
+    syncStats["shipped"] += len(existingPaths)
+
+
+def publishPhases(relativePaths):
+    """
+    Splits files to ship into the two phases of a publish, so that metadata never references an image the target doesn't have yet
+    Parameters:
+    ----------
+    relativePaths: paths relative to a module's output/
+    Returns (images and anything else outside of metadata/, then publish manifests followed by the rest of metadata/), each in the order given
+
+    """
+    imagePaths = [relativePath for relativePath in relativePaths if not relativePath.startswith(metadataPrefix)]
+    manifestPaths = [relativePath for relativePath in relativePaths if relativePath.startswith(manifestPrefix)]
+    metadataPaths = [relativePath for relativePath in relativePaths if relativePath.startswith(metadataPrefix) and not relativePath.startswith(manifestPrefix)]
+    return imagePaths, manifestPaths + metadataPaths
+
+
+def _manifestDigests(outputDir, metadataPaths):
+    # Size and sha256 of every file listed in the publish manifests being shipped, by path relative to output/
+    knownDigests = dict()
+    for metadataPath in metadataPaths:
+        if metadataPath.startswith(manifestPrefix) and metadataPath.endswith(".json"):
+            try:
+                with open(path.join(outputDir, metadataPath), "r") as jsonRead:
+                    knownDigests.update(json.load(jsonRead)["files"])
+            except (FileNotFoundError, ValueError):
+                continue
+    return knownDigests
+
+
+def shipPaths(outputDir, targetDir, relativePaths, syncStats):
+    """
+    Ships files from a module's output/ to the same paths under targetDir: first the images in batches, then once they're all in place, the metadata,
+    which is only swapped in after all of it has been transferred
+    Parameters:
+    ----------
+    outputDir: the module's output directory
+    targetDir: the HDWX server root, either a local directory or user@host:/path
+    relativePaths: paths of the files relative to outputDir
+    syncStats: dict whose "shipped", "skipped", "unchangedByHash", "missing", "bytes", and "batches" are incremented
+
+    """
+    imagePaths, metadataPaths = publishPhases([relativePath for relativePath in relativePaths if not _isExcluded(relativePath)])
+    knownDigests = _manifestDigests(outputDir, metadataPaths)
+    for batchStart in range(0, len(imagePaths), batchSize):
+        with timingSpan("sync.ship"):
+            if _isRemote(targetDir):
+                _shipRemote(outputDir, targetDir, imagePaths[batchStart:batchStart+batchSize], syncStats)
+            else:
+                _shipLocal(outputDir, targetDir, imagePaths[batchStart:batchStart+batchSize], syncStats, knownDigests)
+        syncStats["batches"] += 1
+    if len(metadataPaths) > 0:
+        with timingSpan("sync.shipMetadata"):
+            if _isRemote(targetDir):
+                _shipRemote(outputDir, targetDir, metadataPaths, syncStats, delayUpdates=True)
+            else:
+                _shipLocal(outputDir, targetDir, metadataPaths, syncStats, knownDigests, delayUpdates=True)
+        syncStats["batches"] += 1
+
+
+def reconcile(outputDir, targetDir, syncStats):
+    """
+    Brings targetDir up to date with everything in outputDir, whether or not it was recorded as changed, images first like shipPaths
+    """
+    with timingSpan("sync.reconcile"):
+        if _isRemote(targetDir):
+            _rsync(["--exclude=/"+metadataPrefix, outputDir+"/.", targetDir])
+            _rsync(["--delay-updates", outputDir+"/.", targetDir])
+            return
+        allPaths = list()
+        for dirPath, dirNames, fileNames in walk(outputDir):
+            dirNames[:] = [dirName for dirName in dirNames if dirName != "productTypes"]
+            # Temporary files of writes in progress are shipped once they're renamed into place, and run locks only matter to the module's own writers
+            allPaths.extend([path.relpath(path.join(dirPath, fileName), outputDir) for fileName in fileNames if not fileName.startswith("tmp") and not fileName.endswith(".lock")])
+        shipPaths(outputDir, targetDir, allPaths, syncStats)
+
+
+def _loadState(modulePath):
+    try:
+        with open(path.join(modulePath, "sync", "state.json"), "r") as jsonRead:
+            return json.load(jsonRead)
+    except (FileNotFoundError, ValueError):
+        return {"lastReconcile" : None}
+
+
+def syncModule(modulePath, targetDir, fullReconcile=False):
+    """
+    Ships every change the module has recorded since the last pass, and reconciles the whole output tree if it hasn't been in reconcileSeconds.
+    Without HDWX_SYNC_LOG=1 (which the module's writers need too), nothing is recorded, so every pass reconciles.
+    Parameters:
+    ----------
+    modulePath: the path of the module
+    targetDir: the HDWX server root, either a local directory or user@host:/path
+    fullReconcile: reconcile now no matter when the last reconcile was
+    Returns a dict of stats about the pass
+
+    """
+    startTime = time.monotonic()
+    outputDir = path.join(modulePath, "output")
+    syncStats = {"paths" : 0, "shipped" : 0, "skipped" : 0, "unchangedByHash" : 0, "missing" : 0, "bytes" : 0, "batches" : 0, "reconciled" : False}
+    if not path.isdir(outputDir):
+        return syncStats
+    Path(path.join(modulePath, "sync")).mkdir(parents=True, exist_ok=True)
+    # A pass from the daemon and one from a service's ExecStartPost could otherwise ship the same claimed logs twice
+    with runLock(path.join(modulePath, "sync", "sync.lock"), timeout=None, staleAfter=float("inf")):
+        syncState = _loadState(modulePath)
+        with timingSpan("sync.claim"):
+            claimedLogs, changedPaths = claimChangedPaths(modulePath)
+        syncStats["paths"] = len(changedPaths)
+        if fullReconcile or not syncLogEnabled or syncState["lastReconcile"] is None or time.time() - syncState["lastReconcile"] >= reconcileSeconds:
+            # Claimed before reconciling, so anything recorded during the reconcile is still shipped next pass
+            reconcileStart = time.time()
+            reconcile(outputDir, targetDir, syncStats)
+            syncState["lastReconcile"] = reconcileStart
+            syncStats["reconciled"] = True
+        else:
+            shipPaths(outputDir, targetDir, changedPaths, syncStats)
+        for claimedLog in claimedLogs:
+            remove(claimedLog)
+        atomicWriteBytes(path.join(modulePath, "sync", "state.json"), json.dumps(syncState).encode())
+    syncStats["seconds"] = time.monotonic() - startTime
+    return syncStats
+
+
+def runDaemon(modulePath, targetDir):
+    """
+    Ships the module's changes every intervalSeconds until stopped
+    """
+    while True:
+        passStart = time.monotonic()
+        try:
+            syncStats = syncModule(modulePath, targetDir)
+            if syncStats["reconciled"]:
+                print("Reconciled "+path.join(modulePath, "output")+" with "+targetDir+f" in {syncStats['seconds']:.1f} seconds, {syncStats['shipped']} files shipped")
+        except (OSError, ValueError) as e:
+            # The claimed logs are kept, so the next pass retries them
+            print("Failed to sync "+modulePath+": "+str(e))
+        sys.stdout.flush()
+        time.sleep(max(0, intervalSeconds - (time.monotonic() - passStart)))
+
+
+# syncHDWX.py <module path> <HDWX server root> [--daemon] [--full]
+# Without --daemon, ships one pass and exits, in place of "rsync -ulrH ./output/. $targetDir"
+if __name__ == "__main__":
+    modulePath = path.abspath(sys.argv[1])
+    targetDir = sys.argv[2]
+    if "--daemon" in sys.argv[3:]:
+        runDaemon(modulePath, targetDir)
+    else:
+        syncStats = syncModule(modulePath, targetDir, fullReconcile=("--full" in sys.argv[3:]))
+        print(json.dumps(syncStats))